@@ -0,0 +1,240 @@
+"""Micro-benchmarks of the data structures used to summarize results.
+
+``current_data_lookups`` compares the current data results against
+the dict they replaced, using a real organisation's results. It
+reports the memory taken (as measured by ``tracemalloc``) and the
+time taken by the lookups ``utils.summarize_results`` makes.
+``aggregation`` times ``iatidq.aggregations``, and ``publisher_summary``
+the way ``iatidq.summary`` arranges a publisher's aggregate results, on
+synthetic data. (The implementations these replaced are kept in the
+unit tests, which check the output hasn't changed.) Run them using
+``flask benchmark``.
+"""
+from collections import namedtuple
+from os import listdir
+from os.path import getsize, isdir, join
+import random
+from time import perf_counter
+import tracemalloc
+
+from iatidq import aggregations, summary
+from . import results, utils
+
+
+def largest_organisation(snapshot_result_path):
+    """Return the code of the organisation with the most results."""
+    sizes = {}
+    for organisation_code in listdir(snapshot_result_path):
+        output_path = join(snapshot_result_path, organisation_code)
+        if not isdir(output_path):
+            continue
+        sizes[organisation_code] = sum(
+            getsize(filepath)
+            for filepath in results.result_filepaths(output_path))
+    if not sizes:
+        return None
+    return max(sizes, key=lambda code: (sizes[code], code))
+
+
+def _measure(load):
+    """Return what ``load`` returns, and the memory it holds on to."""
+    tracemalloc.start()
+    try:
+        before, _ = tracemalloc.get_traced_memory()
+        loaded = load()
+        after, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return loaded, after - before
+
+
+def _time(fn, repeat):
+    """Return the best time of ``repeat`` calls to ``fn``."""
+    best = None
+    for _ in range(repeat):
+        start = perf_counter()
+        fn()
+        duration = perf_counter() - start
+        if best is None or duration < best:
+            best = duration
+    return best
+
+
+def _load_current_data_dict(org, snapshot_result_path):
+    """The old ``utils.load_current_data_results``: a dict of dataset
+    name -> activity index -> whether it's current."""
+    current_data_results = {}
+    reader = results.open_results(
+        join(snapshot_result_path, org.organisation_code))
+    for row in reader.rows(utils.load_current_data_test().name):
+        current_data_results.setdefault(row['dataset'], {})[
+            int(row['index'])] = row['result'] == 'pass'
+    return current_data_results
+
+
+def current_data_lookups(org, snapshot_result_path, repeat=5):
+    """Compare the current data results, as a dict of dicts and as
+    a DatasetMasks (looked up one at a time, and decoded once per
+    dataset, as ``utils.summarize_results`` does). Returns a list of
+    dicts, one per structure, with its ``name``, ``memory`` (in
+    bytes), the number of ``lookups`` and the best ``lookup_time``
+    (in seconds) for all of them."""
+    # Parse the test definition first, so it isn't counted.
+    utils.load_current_data_test()
+    as_dict, dict_memory = _measure(
+        lambda: _load_current_data_dict(org, snapshot_result_path))
+    as_masks, masks_memory = _measure(
+        lambda: utils.load_current_data_results(org, snapshot_result_path))
+
+    # Look up every activity, plus one past the end of each dataset.
+    probes = [(dataset, idx)
+              for dataset, current in as_dict.items()
+              for idx in range(len(current) + 1)]
+
+    def dict_lookups():
+        for dataset, idx in probes:
+            as_dict.get(dataset, {}).get(idx, 'not relevant') is False
+
+    def masks_lookups():
+        for dataset, idx in probes:
+            as_masks.get(dataset, idx) is False
+
+    def decoded_lookups():
+        decoded = None
+        for dataset, idx in probes:
+            if dataset != decoded:
+                decoded = dataset
+                current = as_masks.decode(dataset)
+            idx < len(current) and not current[idx]
+
+    return [
+        {'name': 'dict', 'memory': dict_memory, 'lookups': len(probes),
+         'lookup_time': _time(dict_lookups, repeat)},
+        {'name': 'DatasetMasks', 'memory': masks_memory,
+         'lookups': len(probes),
+         'lookup_time': _time(masks_lookups, repeat)},
+        {'name': 'decoded', 'memory': masks_memory,
+         'lookups': len(probes),
+         'lookup_time': _time(decoded_lookups, repeat)},
+    ]
+
+
+def synthetic_results(packages, tests=60, hierarchies=3,
+                      organisations=50, seed=0):
+    """Return rows like those ``aggregations.aggregate_percentages_org``
+    is given: a pass and a fail count per package, test, hierarchy and
+    organisation. Each package belongs to one organisation, and has
+    results for one or two hierarchies of each test."""
+    rng = random.Random(seed)
+    rows = []
+    for package_id in range(packages):
+        organisation_id = package_id % organisations
+        for test_id in range(tests):
+            for hierarchy in rng.sample(range(hierarchies),
+                                        rng.randint(1, 2)):
+                for status in (aggregations.RESULT_FAILURE,
+                               aggregations.RESULT_SUCCESS):
+                    rows.append((test_id, status, hierarchy,
+                                 rng.randint(0, 100), package_id,
+                                 organisation_id))
+    return rows
+
+
+def aggregation(packages=200, repeat=5):
+    """Time the ways of calculating the percentage passed per package,
+    test, hierarchy and organisation. Returns a list of dicts, one per
+    implementation, with its ``name``, the number of input ``rows``
+    and output ``cells``, and the best ``time`` (in seconds)."""
+    data = synthetic_results(packages)
+    dims = [
+        ("package_id", lambda x: x[aggregations.FIELD_PACKAGE]),
+        ("test_id", lambda x: x[aggregations.FIELD_TEST]),
+        ("hierarchy", lambda x: x[aggregations.FIELD_HIERARCHY]),
+        ("organisation_id", lambda x: x[aggregations.FIELD_ORGANISATION]),
+    ]
+    implementations = [('sparse', aggregations._sparse_percentages)]
+    if aggregations.numpy is not None:
+        implementations.append(('sparse (numpy)',
+                                aggregations._numpy_percentages))
+
+    rows = []
+    for name, fn in implementations:
+        cells = len(fn(data, dims))
+        rows.append({'name': name, 'rows': len(data), 'cells': cells,
+                     'time': _time(lambda: fn(data, dims), repeat)})
+    return rows
+
+
+def format_aggregation_table(rows):
+    """Return aggregation benchmark results as a text table."""
+    lines = ['{:<16} {:>10} {:>10} {:>14}'.format(
+        '', 'rows', 'cells', 'time (ms)')]
+    for row in rows:
+        lines.append('{:<16} {:>10} {:>10} {:>14.3f}'.format(
+            row['name'], row['rows'], row['cells'], row['time'] * 1000))
+    return '\n'.join(lines)
+
+
+# Like an OrganisationCondition, for ``summary.OrgConditions``
+SyntheticCondition = namedtuple('SyntheticCondition', [
+    'test_id', 'condition', 'condition_value', 'operation', 'description'])
+
+
+def synthetic_summary(hierarchies, tests, filled=0.2, conditions=0.01,
+                      seed=0):
+    """Return the arguments ``summary.nest_summaries`` is given, for a
+    publisher with results for a fraction (``filled``) of the
+    combinations of hierarchy and test, and conditions on another
+    fraction."""
+    rng = random.Random(seed)
+    hierarchy_ids = list(range(hierarchies))
+    test_ids = list(range(1, tests + 1))
+    data = {}
+    cdtns = []
+    for hierarchy in hierarchy_ids:
+        for test_id in test_ids:
+            if rng.random() < filled:
+                data[(hierarchy, test_id)] = (
+                    hierarchy, test_id, rng.random() * 100,
+                    rng.randint(1, 1000))
+            if rng.random() < conditions:
+                cdtns.append(SyntheticCondition(
+                    test_id, 'activity hierarchy', str(hierarchy),
+                    rng.randint(0, 1), 'Condition'))
+
+    def summary_f(hierarchy, test_id):
+        aresult = data[(hierarchy, test_id)]
+        return {"test": {"id": test_id},
+                "results_pct": aresult[2],
+                "results_num": aresult[3]}
+
+    return (hierarchy_ids, test_ids, data, summary_f,
+            summary.OrgConditions(0, cdtns))
+
+
+def publisher_summary(hierarchies=10, tests=400, repeat=5):
+    """Time arranging a publisher's aggregate results by hierarchy
+    and test. Returns a dict with the number of ``cells`` filled in,
+    and the best ``time`` (in seconds)."""
+    args = synthetic_summary(hierarchies, tests)
+    out = summary.nest_summaries(*args)
+    return {'cells': sum(len(test_data) for test_data in out.values()),
+            'time': _time(lambda: summary.nest_summaries(*args), repeat)}
+
+
+def format_summary_table(row):
+    """Return publisher summary benchmark results as a text table."""
+    return '\n'.join([
+        '{:>10} {:>14}'.format('cells', 'time (ms)'),
+        '{:>10} {:>14.3f}'.format(row['cells'], row['time'] * 1000)])
+
+
+def format_table(rows):
+    """Return benchmark results as a text table."""
+    lines = ['{:<16} {:>12} {:>10} {:>14}'.format(
+        '', 'memory (KB)', 'lookups', 'time (ms)')]
+    for row in rows:
+        lines.append('{:<16} {:>12.1f} {:>10} {:>14.3f}'.format(
+            row['name'], row['memory'] / 1024., row['lookups'],
+            row['lookup_time'] * 1000))
+    return '\n'.join(lines)
@@ -0,0 +1,92 @@
+"""Checkpoints for resuming an interrupted test run.
+
+Result files are written to a temporary file alongside their final
+location, and renamed into place only once complete, so a crash never
+leaves a partially written file where ``aggregate_results`` (or a
+resumed run) would read it.
+
+Once a test's results for an organisation are in place, a completion
+marker is written for that (organisation, test) pair. A resumed run
+skips any test that has a marker. Once every test has been run, the
+organisation as a whole is marked complete.
+
+Results from a ``--current-only`` run are marked as such, since they
+can't be used for the "All data" aggregation.
+"""
+from contextlib import contextmanager
+from os import makedirs, remove, replace
+from os.path import exists, join
+
+from . import utils
+
+
+MARKER_DIRNAME = 'completed'
+TEMP_SUFFIX = '.partial'
+ORG_MARKER_FILENAME = 'complete'
+CURRENT_ONLY_FILENAME = 'current_only'
+
+
+@contextmanager
+def atomic_write(filepath, mode='w'):
+    """Open a file for writing, that only appears at ``filepath``
+    if the block completes without an exception."""
+    temp_filepath = filepath + TEMP_SUFFIX
+    try:
+        with open(temp_filepath, mode) as handler:
+            yield handler
+    except BaseException:
+        if exists(temp_filepath):
+            remove(temp_filepath)
+        raise
+    replace(temp_filepath, filepath)
+
+
+def marker_filepath(output_path, test_name):
+    return join(output_path, MARKER_DIRNAME, utils.slugify(test_name))
+
+
+def is_complete(output_path, test_name):
+    """Return True if a test has already been run for the
+    organisation with results in ``output_path``."""
+    return exists(marker_filepath(output_path, test_name))
+
+
+def start(output_path, resume=False, current_only=False):
+    """Create the results directory for an organisation, marking it
+    if only current activities are tested."""
+    makedirs(join(output_path, MARKER_DIRNAME), exist_ok=resume)
+    if current_only:
+        filepath = join(output_path, CURRENT_ONLY_FILENAME)
+        with atomic_write(filepath) as handler:
+            handler.write('')
+
+
+def is_current_only(output_path):
+    """Return True if an organisation's activity tests were only run
+    on current activities (so its results don't cover all data)."""
+    return exists(join(output_path, CURRENT_ONLY_FILENAME))
+
+
+def mark_complete(output_path, test_name):
+    with atomic_write(marker_filepath(output_path, test_name)) as handler:
+        handler.write(test_name)
+
+
+def mark_organisation_complete(output_path):
+    with atomic_write(join(output_path, ORG_MARKER_FILENAME)) as handler:
+        handler.write('')
+
+
+def organisation_marked_complete(output_path):
+    return exists(join(output_path, ORG_MARKER_FILENAME))
+
+
+def organisation_is_complete(output_path):
+    """Return True unless an organisation's results are from a test
+    run that hasn't finished.
+
+    (Results from before checkpoints were introduced have no markers
+    at all, and are assumed to be complete.)"""
+    if not exists(join(output_path, MARKER_DIRNAME)):
+        return True
+    return organisation_marked_complete(output_path)
@@ -0,0 +1,353 @@
+"""Test IATI data with workers consuming a kombu queue.
+
+``flask test_dispatch`` publishes one message per (organisation,
+dataset) unit. Any number of ``flask test_worker`` processes, on any
+number of hosts sharing the results directory, consume them. Each
+unit's results are written as a shard::
+
+    <IATI_RESULT_PATH>/<date>/<organisation code>/shards/<n>/results.bin
+
+where ``n`` is the position of the dataset in the publisher's
+datasets. Whichever worker completes the last unit for an organisation
+merges its shards (in dataset order) into the usual results file, and
+then runs the info tests. The merged results are the same as those
+from ``flask test_data``, however many workers there are.
+
+A unit that fails is requeued, up to ``MAX_ATTEMPTS`` times in all
+(counted in an ``attempt`` message header). After that, the traceback
+is written to a ``failed`` marker in its shard directory instead, and
+the organisation is left unmerged; ``failed_units`` lists them.
+
+The broker is configured with ``BROKER_URL`` (and optionally
+``BROKER_TRANSPORT_OPTIONS``). ``memory://`` works within a single
+process, and ``filesystem://`` works across processes on one box, so
+neither needs RabbitMQ.
+"""
+import errno
+import json
+import os
+from os import listdir
+from os.path import exists, join
+import shutil
+import socket
+import traceback
+
+from flask import current_app
+import iatikit
+from kombu import Connection, Exchange, Queue
+
+from . import checkpoint, incremental, results, runner, utils
+from .masks import DatasetMasks
+
+
+exchange = Exchange('iatidq', type='direct', durable=True)
+test_queue = Queue('iatidq.test', exchange, routing_key='iatidq.test',
+                   durable=True)
+
+SHARDS_DIRNAME = 'shards'
+UNITS_FILENAME = 'units.json'
+SHARD_MARKER_FILENAME = 'complete'
+SHARD_FAILED_FILENAME = 'failed'
+FINALIZE_FILENAME = 'finalizing'
+MAX_ATTEMPTS = 3
+
+
+def broker_connection():
+    """Return a kombu connection to the configured broker.
+
+    If ``BROKER_URL`` isn't set, connect to AMQP using the
+    ``BROKER_HOST``, ``BROKER_PORT``, etc. settings."""
+    config = current_app.config
+    transport_options = config.get('BROKER_TRANSPORT_OPTIONS', {})
+    if config.get('BROKER_URL'):
+        return Connection(config['BROKER_URL'],
+                          transport_options=transport_options)
+    return Connection(hostname=config.get('BROKER_HOST', 'localhost'),
+                      port=config.get('BROKER_PORT', 5672),
+                      userid=config.get('BROKER_USER', 'guest'),
+                      password=config.get('BROKER_PASSWORD', 'guest'),
+                      virtual_host=config.get('BROKER_VHOST', '/'),
+                      transport_options=transport_options)
+
+
+def shards_path(root_output_path, org):
+    return join(root_output_path, org.organisation_code, SHARDS_DIRNAME)
+
+
+def publish_unit(producer, body, attempt=1):
+    producer.publish(body, headers={'attempt': attempt},
+                     exchange=exchange, routing_key=test_queue.routing_key,
+                     declare=[test_queue])
+
+
+def dispatch(connection, orgs, publishers, root_output_path, snapshot_date,
+             fingerprint, current_only=False):
+    """Publish a message for each dataset of each organisation.
+
+    Returns the number of messages published."""
+    total = 0
+    producer = connection.Producer(serializer='json')
+    for org in orgs:
+        publisher = publishers[org.registry_slug]
+        datasets = [dataset.name for dataset in publisher.datasets]
+        path = shards_path(root_output_path, org)
+        # Shards left behind by an earlier dispatch would be merged
+        # as if they were complete, so are cleared out.
+        if exists(path):
+            shutil.rmtree(path)
+        os.makedirs(path)
+        checkpoint.start(join(root_output_path, org.organisation_code),
+                         current_only=current_only)
+        with checkpoint.atomic_write(join(path, UNITS_FILENAME)) as handler:
+            json.dump({
+                'datasets': datasets,
+                'fingerprint': fingerprint,
+            }, handler)
+        # An organisation without any datasets still needs its
+        # (empty) results written, so gets a single empty unit.
+        units = list(enumerate(datasets)) or [(0, None)]
+        for shard, dataset in units:
+            publish_unit(producer, {
+                'snapshot_date': snapshot_date,
+                'organisation': dict(org._asdict()),
+                'shard': shard,
+                'dataset': dataset,
+                'current_only': current_only,
+            })
+            total += 1
+    return total
+
+
+class Worker(object):
+    """Consume test units from the queue."""
+
+    def __init__(self, connection, all_tests, codelists, streaming=False,
+                 echo=None, max_attempts=MAX_ATTEMPTS):
+        self.connection = connection
+        self.all_tests = [test for test in all_tests
+                          if utils.test_level(test) is not None]
+        self.codelists = codelists
+        self.streaming = streaming
+        self.echo = echo
+        self.max_attempts = max_attempts
+        # (organisation code, dataset) of each unit given up on.
+        self.failures = []
+        self._publishers = {}
+
+    def log(self, msg):
+        if self.echo is not None:
+            self.echo(msg)
+
+    def publishers(self, snapshot_date):
+        if snapshot_date not in self._publishers:
+            snapshot_xml_path = join(
+                current_app.config.get('IATI_DATA_PATH'), snapshot_date)
+            self._publishers[snapshot_date] = iatikit.data(
+                path=snapshot_xml_path).publishers
+        return self._publishers[snapshot_date]
+
+    def run(self, burst=False, timeout=1):
+        """Process messages until interrupted, or (if ``burst`` is
+        set) until the queue is empty. Returns the number of units
+        processed, and the number that failed (after every attempt).
+        Units that will be retried aren't counted."""
+        processed = [0, 0]
+
+        def on_message(body, message):
+            try:
+                self.run_unit(body)
+            except Exception:
+                error = traceback.format_exc()
+                self.log(error)
+                attempt = (message.headers or {}).get('attempt', 1)
+                if attempt < self.max_attempts:
+                    self.log('Requeueing (attempt {} of {}) ...'.format(
+                        attempt + 1, self.max_attempts))
+                    publish_unit(self.connection.Producer(serializer='json'),
+                                 body, attempt + 1)
+                    message.ack()
+                    return
+                self.fail_unit(body, error)
+                processed[1] += 1
+            message.ack()
+            processed[0] += 1
+
+        with self.connection.Consumer(test_queue, callbacks=[on_message],
+                                      accept=['json']) as consumer:
+            consumer.qos(prefetch_count=1)
+            while True:
+                try:
+                    self.connection.drain_events(timeout=timeout)
+                except socket.timeout:
+                    if burst:
+                        break
+        return tuple(processed)
+
+    def fail_unit(self, body, error):
+        """Give up on a unit, recording the error in its shard."""
+        org = runner.OrgUnit(**body['organisation'])
+        root_output_path = join(
+            current_app.config.get('IATI_RESULT_PATH'), body['snapshot_date'])
+        shard_path = join(shards_path(root_output_path, org),
+                          str(body['shard']))
+        os.makedirs(shard_path, exist_ok=True)
+        with checkpoint.atomic_write(
+                join(shard_path, SHARD_FAILED_FILENAME)) as handler:
+            handler.write(error)
+        self.failures.append((org.organisation_code, body['dataset']))
+        self.log('Gave up testing {} ({}) after {} attempts; its results '
+                 'won\'t be merged.'.format(
+                     org.registry_slug, body['dataset'] or 'no datasets',
+                     self.max_attempts))
+
+    def run_unit(self, body):
+        """Test one dataset for an organisation, writing the results
+        to a shard, and finalize the organisation if it was the last
+        one outstanding."""
+        org = runner.OrgUnit(**body['organisation'])
+        snapshot_date = body['snapshot_date']
+        root_output_path = join(
+            current_app.config.get('IATI_RESULT_PATH'), snapshot_date)
+        publisher = self.publishers(snapshot_date).get(org.registry_slug)
+        self.log('Testing {} ({})'.format(
+            org.registry_slug, body['dataset'] or 'no datasets'))
+
+        datasets = []
+        if body['dataset'] is not None:
+            datasets = [dataset for dataset in publisher.datasets
+                        if dataset.name == body['dataset']]
+        current_data_test = None
+        if body['current_only']:
+            current_data_test = next(
+                (test for test in self.all_tests
+                 if test.name == runner.CURRENT_DATA_TEST), None)
+
+        shard_path = join(shards_path(root_output_path, org),
+                          str(body['shard']))
+        os.makedirs(shard_path, exist_ok=True)
+        condition_masks = utils.run_tests(
+            self.all_tests, publisher, shard_path, org.condition,
+            streaming=self.streaming, current_data_test=current_data_test,
+            datasets=datasets, codelists=self.codelists,
+            today=snapshot_date)
+        save_shard_masks(shard_path, condition_masks)
+        with checkpoint.atomic_write(
+                join(shard_path, SHARD_MARKER_FILENAME)) as handler:
+            handler.write('')
+
+        if claim_finalize(root_output_path, org):
+            self.log('Merging results for {}'.format(org.registry_slug))
+            try:
+                self.finalize(org, publisher, root_output_path,
+                              snapshot_date)
+            except Exception:
+                # Give up the claim, so the retry can finalize.
+                release_finalize(root_output_path, org)
+                raise
+
+    def finalize(self, org, publisher, root_output_path, snapshot_date):
+        path = shards_path(root_output_path, org)
+        with open(join(path, UNITS_FILENAME)) as handler:
+            units = json.load(handler)
+        output_path = join(root_output_path, org.organisation_code)
+        shard_paths = [join(path, str(shard))
+                       for shard in range(max(len(units['datasets']), 1))]
+
+        merge_shards(shard_paths, output_path,
+                     [test.name for test in self.all_tests])
+        for test in self.all_tests:
+            checkpoint.mark_complete(output_path, test.name)
+        utils.save_condition_masks(org, root_output_path,
+                                   merge_shard_masks(shard_paths))
+
+        runner.run_infotests(org, root_output_path, snapshot_date,
+                             echo=self.echo, streaming=self.streaming,
+                             publisher=publisher)
+        if units['fingerprint'] is not None:
+            incremental.save_manifest(org, root_output_path,
+                                      incremental.build_manifest(
+                                          org, publisher,
+                                          units['fingerprint']))
+        shutil.rmtree(path)
+        checkpoint.mark_organisation_complete(output_path)
+
+
+def save_shard_masks(shard_path, condition_masks):
+    with checkpoint.atomic_write(
+            join(shard_path, 'condition_mask.json')) as handler:
+        json.dump({level: masks.as_dict()
+                   for level, masks in condition_masks.items()},
+                  handler, sort_keys=True)
+
+
+def merge_shard_masks(shard_paths):
+    condition_masks = {}
+    for shard_path in shard_paths:
+        with open(join(shard_path, 'condition_mask.json')) as handler:
+            data = json.load(handler)
+        for level, masks in data.items():
+            masks = DatasetMasks.from_dict(masks)
+            merged = condition_masks.setdefault(level, DatasetMasks())
+            for dataset in masks:
+                merged.update(masks, dataset)
+    return condition_masks
+
+
+def merge_shards(shard_paths, output_path, test_names):
+    """Concatenate the results of each test in the shards (in order)
+    into a single results file."""
+    shards = [results.open_results(shard_path)
+              for shard_path in shard_paths]
+    with results.ResultStoreWriter(output_path) as store:
+        for test_name in test_names:
+            writer = store.writer(test_name)
+            for shard in shards:
+                if test_name in shard:
+                    writer.writerows(shard.rows(test_name))
+
+
+def failed_units(root_output_path, org):
+    """Return the datasets (by shard number) of an organisation's
+    units that failed on every attempt, and so were never merged."""
+    path = shards_path(root_output_path, org)
+    if not exists(join(path, UNITS_FILENAME)):
+        return {}
+    with open(join(path, UNITS_FILENAME)) as handler:
+        datasets = json.load(handler)['datasets']
+    return {int(x): datasets[int(x)] if datasets else None
+            for x in listdir(path)
+            if exists(join(path, x, SHARD_FAILED_FILENAME))}
+
+
+def claim_finalize(root_output_path, org):
+    """Return True if every unit for an organisation is complete,
+    and no other worker has already claimed it for merging."""
+    path = shards_path(root_output_path, org)
+    with open(join(path, UNITS_FILENAME)) as handler:
+        units = json.load(handler)
+    shards = [str(shard)
+              for shard in range(max(len(units['datasets']), 1))]
+    completed = set(x for x in listdir(path)
+                    if exists(join(path, x, SHARD_MARKER_FILENAME)))
+    if not completed.issuperset(shards):
+        return False
+    try:
+        # Creating the file is atomic, so only one worker wins.
+        fd = os.open(join(path, FINALIZE_FILENAME),
+                     os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except OSError as e:
+        if e.errno == errno.EEXIST:
+            return False
+        raise
+    os.close(fd)
+    return True
+
+
+def release_finalize(root_output_path, org):
+    """Undo ``claim_finalize``, after finalizing failed."""
+    try:
+        os.remove(join(shards_path(root_output_path, org),
+                       FINALIZE_FILENAME))
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
@@ -0,0 +1,255 @@
+"""Reuse test results from a previous snapshot for unchanged datasets.
+
+Each organisation's results directory gets a manifest, recording a
+content hash for each of its datasets, along with a fingerprint of
+the test definitions and codelists used. On the next run, datasets
+whose hash (and the fingerprint) match the previous snapshot have
+their rows copied forward from the previous results, rather than
+being retested.
+
+Rows are only copied for tests that don't depend on the snapshot
+date; anything that does (e.g. "is less than 12 months ago") gives
+a different answer for the same data on a different day, so is
+always rerun. When only current activities are tested, that includes
+every activity test, since which activities are current (and so
+which are skipped) depends on the date.
+
+Aggregation is incremental in the same way: a hash of each
+organisation's results is recorded when its aggregate results
+are saved, so organisations whose results haven't changed since
+can be skipped.
+"""
+from glob import glob
+import hashlib
+from inspect import unwrap
+import json
+from os import listdir
+from os.path import basename, exists, isdir, join, relpath
+from types import CodeType, FunctionType
+
+from . import results, utils
+from .checkpoint import atomic_write
+
+
+MANIFEST_FILENAME = 'manifest.json'
+# Kept in the root of IATI_RESULT_PATH, since the aggregate results
+# in the database may come from any snapshot
+AGGREGATED_FILENAME = 'aggregated.json'
+
+
+def _hash_file(filepath, hasher=None):
+    if hasher is None:
+        hasher = hashlib.sha1()
+    with open(filepath, 'rb') as handler:
+        for chunk in iter(lambda: handler.read(1 << 20), b''):
+            hasher.update(chunk)
+    return hasher
+
+
+def tests_fingerprint(codelists, current_only=False):
+    """Return a hash of the test definitions and codelists (and
+    whether only current activities are being tested)."""
+    base_path = utils.test_definitions_path()
+    hasher = hashlib.sha1()
+    filepaths = [join(base_path, 'step_definitions.py')]
+    filepaths += sorted(glob(join(base_path, '*.feature')))
+    filepaths += sorted(glob(join(base_path, '*', '*.feature')))
+    for filepath in filepaths:
+        hasher.update(relpath(filepath, base_path).encode('utf-8'))
+        _hash_file(filepath, hasher)
+    for name in sorted(codelists):
+        hasher.update(name.encode('utf-8'))
+        hasher.update('\n'.join(sorted(codelists[name])).encode('utf-8'))
+    if current_only:
+        hasher.update(b'current-only')
+    return hasher.hexdigest()
+
+
+def build_manifest(org, publisher, fingerprint):
+    datasets = []
+    for dataset in publisher.datasets:
+        if dataset.data_path is None:
+            continue
+        datasets.append(
+            [dataset.name, _hash_file(dataset.data_path).hexdigest()])
+    return {
+        'fingerprint': fingerprint,
+        'condition': org.condition,
+        'datasets': datasets,
+    }
+
+
+def save_manifest(org, snapshot_result_path, manifest):
+    filepath = join(snapshot_result_path, org.organisation_code,
+                    MANIFEST_FILENAME)
+    with atomic_write(filepath) as handler:
+        json.dump(manifest, handler, indent=2, sort_keys=True)
+
+
+def load_manifest(org, snapshot_result_path):
+    filepath = join(snapshot_result_path, org.organisation_code,
+                    MANIFEST_FILENAME)
+    if not exists(filepath):
+        return None
+    with open(filepath) as handler:
+        return json.load(handler)
+
+
+def previous_snapshot(iati_result_path, snapshot_date):
+    """Return the path to the most recent results snapshot
+    before ``snapshot_date``, or None."""
+    if not exists(iati_result_path):
+        return None
+    dates = [x for x in listdir(iati_result_path)
+             if x < snapshot_date and isdir(join(iati_result_path, x))]
+    if not dates:
+        return None
+    return join(iati_result_path, max(dates))
+
+
+def _uses_today(code, namespace, seen):
+    if code in seen:
+        return False
+    seen.add(code)
+    if 'today' in code.co_names or 'today' in code.co_consts:
+        return True
+    for const in code.co_consts:
+        if isinstance(const, CodeType) and \
+                _uses_today(const, namespace, seen):
+            return True
+    for name in code.co_names:
+        fn = namespace.get(name)
+        if isinstance(fn, FunctionType) and \
+                _uses_today(fn.__code__, fn.__globals__, seen):
+            return True
+    return False
+
+
+def is_date_dependent(test):
+    """Return True if any step of a test (or any step definition
+    function it calls) refers to the ``today`` keyword argument."""
+    seen = set()
+    for step in test.steps:
+        fn = unwrap(step.expr_fn)
+        if _uses_today(fn.__code__, fn.__globals__, seen):
+            return True
+    return False
+
+
+class PreviousResults(object):
+    """Result rows from a previous snapshot, for the datasets of
+    one organisation that haven't changed since."""
+
+    def __init__(self, output_path, manifest, reusable, condition_masks,
+                 current_only=False):
+        self.output_path = output_path
+        self.results = results.open_results(output_path)
+        self.reusable = reusable
+        self.condition_masks = condition_masks
+        self.current_only = current_only
+        self._positions = dict((name, pos) for pos, (name, _)
+                               in enumerate(manifest['datasets']))
+        self._readers = {}
+        self._date_dependent = {}
+
+    def can_reuse(self, test):
+        """Return True if previous results for a test can be reused
+        (i.e. it doesn't depend on the snapshot date).
+
+        With ``current_only``, no activity test can be reused: the
+        current data test is rerun, and may find different activities
+        are current, so the skipped rows would be wrong."""
+        if test.name not in self._date_dependent:
+            self._date_dependent[test.name] = is_date_dependent(test) or (
+                self.current_only and
+                utils.test_level(test) == 'iati-activity')
+        return not self._date_dependent[test.name]
+
+    def _reader(self, test):
+        if test.name not in self._readers:
+            self._readers[test.name] = (self.results.rows(test.name), [])
+        return self._readers[test.name]
+
+    def rows(self, test, dataset_name):
+        """Yield the previous result rows of a test, for a dataset.
+
+        Datasets must be requested in the same order they were
+        tested, i.e. the order of the previous manifest."""
+        reader, pushback = self._reader(test)
+        position = self._positions[dataset_name]
+        for row in reader if not pushback else _chain(pushback, reader):
+            if row['dataset'] == dataset_name:
+                yield row
+                continue
+            if self._positions.get(row['dataset'], -1) < position:
+                # an earlier dataset, that isn't being reused
+                continue
+            pushback.append(row)
+            return
+
+    def close(self):
+        for reader, _ in self._readers.values():
+            reader.close()
+        self._readers = {}
+
+
+def _chain(pushback, reader):
+    while pushback:
+        yield pushback.pop(0)
+    for row in reader:
+        yield row
+
+
+def load_previous(org, previous_result_path, manifest,
+                  current_only=False):
+    """Work out which of an organisation's datasets are unchanged
+    since a previous snapshot. Returns a PreviousResults, or None
+    if nothing can be reused."""
+    if previous_result_path is None:
+        return None
+    previous_manifest = load_manifest(org, previous_result_path)
+    if previous_manifest is None:
+        return None
+    if previous_manifest['fingerprint'] != manifest['fingerprint'] or \
+            previous_manifest['condition'] != manifest['condition']:
+        return None
+    previous_hashes = dict(
+        (name, sha) for name, sha in previous_manifest['datasets'])
+    reusable = set(name for name, sha in manifest['datasets']
+                   if previous_hashes.get(name) == sha)
+    if not reusable:
+        return None
+    condition_masks = utils.load_condition_masks(org, previous_result_path)
+    return PreviousResults(
+        join(previous_result_path, org.organisation_code),
+        previous_manifest, reusable, condition_masks,
+        current_only=current_only)
+
+
+def results_hash(org, snapshot_result_path, test_ids):
+    """Return a hash of an organisation's results, along with the
+    database IDs their aggregate results refer to."""
+    output_path = join(snapshot_result_path, org.organisation_code)
+    hasher = hashlib.sha1()
+    hasher.update(json.dumps(
+        [org.id, sorted(test_ids.items())]).encode('utf-8'))
+    for filepath in results.result_filepaths(output_path):
+        hasher.update(basename(filepath).encode('utf-8'))
+        _hash_file(filepath, hasher)
+    return hasher.hexdigest()
+
+
+def load_aggregated(iati_result_path):
+    """Return the results hash of each organisation, as of when its
+    aggregate results were last saved."""
+    filepath = join(iati_result_path, AGGREGATED_FILENAME)
+    if not exists(filepath):
+        return {}
+    with open(filepath) as handler:
+        return json.load(handler)
+
+
+def save_aggregated(iati_result_path, aggregated):
+    filepath = join(iati_result_path, AGGREGATED_FILENAME)
+    with atomic_write(filepath) as handler:
+        json.dump(aggregated, handler, indent=2, sort_keys=True)
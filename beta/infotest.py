@@ -1,76 +1,210 @@
-import csv
-from os.path import dirname, join
+from datetime import datetime, timedelta
+from os.path import join
 
 from flask import current_app
 import iatikit
-from bdd_tester import BDDTester
 
-from . import utils
+from . import results, utils
+from .xpath_cache import xpath
 
 
-def get_current_countries(publisher, current_data):
-    country_codes = []
+MOU_XPATH = 'document-link[category/@code="A09"]'
+ORG_STRATEGY_XPATH = 'document-link[category/@code="B03" or ' + \
+                     'category/@code="B13"]/recipient-country/@code'
 
-    for dataset in publisher.datasets:
-        for idx, activity in enumerate(dataset.activities):
-            if dataset.name not in current_data or idx not in current_data[dataset.name] or current_data[dataset.name][idx] is False:
-                continue
-            country_codes += activity.etree.xpath('recipient-country/@code')
-            country_codes = list(set(country_codes))
-    return country_codes
 
+BUDGET_YEARS = (1, 2, 3)
 
-def country_strategy_or_mou(org, snapshot_date, test_name,
-                            current_data_results):
-    iati_result_path = current_app.config.get('IATI_RESULT_PATH')
-    output_filepath = join(iati_result_path,
-                           snapshot_date, org.organisation_code,
-                           utils.slugify(test_name) + '.csv')
 
+def org_condition(condition):
+    """Return the organisation part of a test condition, or None."""
+    if condition and condition.split('|')[1].strip():
+        return condition.split('|')[1]
+    return None
+
+
+def _mkdate(date_str):
+    try:
+        return datetime.strptime(date_str, '%Y-%m-%d').date()
+    except (TypeError, ValueError):
+        return None
+
+
+def budget_index(etree):
+    """Return the country budgets of an organisation, as a dict of
+    country code -> list of (period end date, value), ordered by
+    period end date. Budgets without a valid period end are left
+    out."""
+    budgets = {}
+    for budget in xpath(etree, 'recipient-country-budget'):
+        period_end = budget.find('period-end')
+        if period_end is None:
+            continue
+        budget_end = _mkdate(period_end.get('iso-date'))
+        if budget_end is None:
+            continue
+        value = budget.findtext('value')
+        for country_code in set(xpath(budget, 'recipient-country/@code')):
+            budgets.setdefault(str(country_code), []).append(
+                (budget_end, value))
+    for country_budgets in budgets.values():
+        country_budgets.sort(key=lambda x: x[0])
+    return budgets
+
+
+def budget_available(country_budgets, years, today):
+    """Return True if there's a budget ending between ``years`` - 1
+    and ``years`` years (of 365 days) from ``today``."""
+    future_date = today + timedelta(days=(365 * (years - 1)))
+    future_plus_oneyear = future_date + timedelta(days=365)
+    return any(future_date <= budget_end <= future_plus_oneyear
+               for budget_end, _ in country_budgets)
+
+
+class CountryIndex(object):
+    """The recipient countries of each of a publisher's activities,
+    the country strategies / MoUs that cover them, and each
+    organisation's budgets by country.
+
+    Both infotests are answered from the index, so the data is read
+    (at most) once. It can be filled in by the main test run as it
+    goes (see ``utils.run_tests``), in which case the data isn't read
+    again at all; ``fill`` then reads any datasets the test run
+    didn't (e.g. because their results were reused).
+
+    If an organisation ``condition`` is given, whether each
+    organisation meets it is recorded too.
+    """
+
+    def __init__(self, condition=None):
+        self.org_condition = org_condition(condition)
+        self._seen = {'activity': set(), 'organisation': set()}
+        self._activities = {}
+        self._organisations = {}
+        self._dataset_names = None
+
+    def add_dataset(self, filetype, dataset_name):
+        self._seen[filetype].add(dataset_name)
+
+    def add(self, filetype, dataset_name, idx, item):
+        # Only plain strings are kept, so as not to keep the
+        # parsed data alive.
+        etree = item.etree
+        if filetype == 'activity':
+            countries = [str(c) for c in
+                         xpath(etree, 'recipient-country/@code')]
+            if countries:
+                self._activities.setdefault(dataset_name, []).append((
+                    idx, str(item.id), etree.get('hierarchy', '1'),
+                    countries, bool(xpath(etree, MOU_XPATH))))
+        else:
+            countries = set(str(c) for c in
+                            xpath(etree, ORG_STRATEGY_XPATH))
+            in_scope = True
+            if self.org_condition:
+                in_scope = bool(xpath(etree, self.org_condition))
+            self._organisations.setdefault(dataset_name, []).append(
+                (idx, str(item.id), countries, in_scope,
+                 budget_index(etree)))
+
+    def fill(self, publisher, streaming=False):
+        """Read any of the publisher's datasets not yet indexed."""
+        dataset_names = []
+        for dataset in publisher.datasets:
+            dataset_names.append(dataset.name)
+            for filetype in ('activity', 'organisation'):
+                if dataset.name in self._seen[filetype]:
+                    continue
+                self.add_dataset(filetype, dataset.name)
+                for idx, item in enumerate(
+                        utils.dataset_items(dataset, filetype, streaming)):
+                    self.add(filetype, dataset.name, idx, item)
+        self._dataset_names = dataset_names
+
+    def current_countries(self, current_data):
+        """Return the recipient countries of current activities,
+        in the order they're first found. (``current_data`` is a
+        DatasetMasks, from ``utils.load_current_data_results``.)"""
+        countries = {}
+        for dataset_name in self._dataset_names:
+            current = current_data.decode(dataset_name)
+            for idx, _, _, codes, _ in \
+                    self._activities.get(dataset_name, []):
+                if idx < len(current) and current[idx]:
+                    for code in codes:
+                        countries.setdefault(code, None)
+        return list(countries)
+
+    def country_strategies(self, current_data):
+        """Return the evidence of a country strategy or MoU for each
+        country that has one. Where there's more than one, the last
+        found is used."""
+        country_strategies = {}
+        for dataset_name in self._dataset_names:
+            current = current_data.decode(dataset_name)
+            for idx, identifier, hierarchy, codes, has_mou in \
+                    self._activities.get(dataset_name, []):
+                if not has_mou or idx >= len(current) or not current[idx]:
+                    continue
+                for c in codes:
+                    country_strategies[c] = {
+                        'dataset': dataset_name,
+                        'identifier': identifier,
+                        'index': idx,
+                        'result': 'pass',
+                        'hierarchy': hierarchy,
+                        'explanation': 'A09 found for {}',
+                    }
+            for idx, identifier, codes, _, _ in \
+                    self._organisations.get(dataset_name, []):
+                for c in codes:
+                    country_strategies[c] = {
+                        'dataset': dataset_name,
+                        'identifier': identifier,
+                        'index': idx,
+                        'result': 'pass',
+                        'hierarchy': 1,
+                        'explanation': 'B03 or B13 found for {}',
+                    }
+        return country_strategies
+
+    def organisations(self):
+        """Return (dataset name, index, identifier, in scope, budget
+        index) for each organisation, in dataset order."""
+        return [(dataset_name, idx, identifier, in_scope, budgets)
+                for dataset_name in self._dataset_names
+                for idx, identifier, _, in_scope, budgets
+                in self._organisations.get(dataset_name, [])]
+
+
+def load_publisher(org, snapshot_date):
     iati_data_path = current_app.config.get('IATI_DATA_PATH')
     snapshot_xml_path = join(iati_data_path, snapshot_date)
-    publisher = iatikit.data(snapshot_xml_path).publishers.get(
+    return iatikit.data(snapshot_xml_path).publishers.get(
         org.registry_slug)
 
-    current_country_codes = get_current_countries(
-        publisher, current_data_results)
+
+def country_strategy_or_mou(org, snapshot_date, test_name,
+                            current_data_results, streaming=False,
+                            publisher=None, country_index=None):
+    iati_result_path = current_app.config.get('IATI_RESULT_PATH')
+    output_path = join(iati_result_path,
+                       snapshot_date, org.organisation_code)
+
+    if publisher is None:
+        publisher = load_publisher(org, snapshot_date)
+    if country_index is None:
+        country_index = CountryIndex()
+    country_index.fill(publisher, streaming)
+
+    current_country_codes = country_index.current_countries(
+        current_data_results)
 
     if current_country_codes == []:
         return
 
-    country_strategies = {}
-    for dataset in publisher.datasets:
-        for idx, activity in enumerate(dataset.activities):
-            if dataset.name not in current_data_results or idx not in current_data_results[dataset.name] or current_data_results[dataset.name][idx] is False:
-                continue
-            mous = activity.etree.xpath('document-link[category/@code="A09"]')
-            if mous == []:
-                continue
-            for c in activity.etree.xpath('recipient-country/@code'):
-                country_strategies[c] = {
-                    'dataset': dataset.name,
-                    'identifier': activity.id,
-                    'index': idx,
-                    'result': 'pass',
-                    'hierarchy': activity.etree.get('hierarchy', '1'),
-                    'explanation': 'A09 found for {}',
-                }
-
-        for idx, organisation in enumerate(dataset.organisations):
-            org_level_docs = organisation.etree.xpath(
-                'document-link[category/@code="B03"]/recipient-country/@code')
-            org_level_docs += organisation.etree.xpath(
-                'document-link[category/@code="B13"]/recipient-country/@code')
-            org_level_docs = list(set(org_level_docs))
-            for c in org_level_docs:
-                country_strategies[c] = {
-                    'dataset': dataset.name,
-                    'identifier': organisation.id,
-                    'index': idx,
-                    'result': 'pass',
-                    'hierarchy': 1,
-                    'explanation': 'B03 or B13 found for {}',
-                }
+    country_strategies = country_index.country_strategies(
+        current_data_results)
 
     default_row = {
         'dataset': '',
@@ -80,11 +214,8 @@ def country_strategy_or_mou(org, snapshot_date, test_name,
         'hierarchy': 1,
         'explanation': 'No country strategy or MoU found for {}',
     }
-    fieldnames = ['dataset', 'identifier', 'index', 'result',
-                  'hierarchy', 'explanation']
-    with open(output_filepath, 'w') as handler:
-        writer = csv.DictWriter(handler, fieldnames=fieldnames)
-        writer.writeheader()
+    with results.ResultStoreWriter(output_path) as store:
+        writer = store.writer(test_name)
         for country_code in current_country_codes:
             row = country_strategies.get(country_code, dict(default_row))
             row['explanation'] = row['explanation'].format(country_code)
@@ -92,76 +223,57 @@ def country_strategy_or_mou(org, snapshot_date, test_name,
 
 
 def disaggregated_budget(org, snapshot_date, test_name,
-                         current_data_results, condition):
+                         current_data_results, condition, streaming=False,
+                         publisher=None, country_index=None):
+    """Test whether each organisation has a budget for each current
+    recipient country, 1, 2 and 3 years forward."""
     iati_result_path = current_app.config.get('IATI_RESULT_PATH')
-    output_filepath = join(iati_result_path,
-                           snapshot_date, org.organisation_code,
-                           utils.slugify(test_name) + '.csv')
-
-    iati_data_path = current_app.config.get('IATI_DATA_PATH')
-    snapshot_xml_path = join(iati_data_path, snapshot_date)
-    publisher = iatikit.data(snapshot_xml_path).publishers.get(
-        org.registry_slug)
-
-    codelists = iatikit.codelists()
-    current_country_codes = get_current_countries(
-        publisher, current_data_results)
-
-    disaggregated_budget_tmpl = '''@iati-organisation
-Feature: Total disaggregated budget
+    output_path = join(iati_result_path,
+                       snapshot_date, org.organisation_code)
 
-  Scenario: Country budget available one year forward
-    Given file is an organisation file
-     Then `recipient-country-budget[recipient-country/@code="{country_code}"]` should be available 1 year forward
+    if publisher is None:
+        publisher = load_publisher(org, snapshot_date)
+    if country_index is None:
+        country_index = CountryIndex(condition)
+    country_index.fill(publisher, streaming)
 
-  Scenario: Country budget available two years forward
-    Given file is an organisation file
-     Then `recipient-country-budget[recipient-country/@code="{country_code}"]` should be available 2 years forward
+    today = _mkdate(snapshot_date)
+    condition_mask = utils.load_condition_masks(
+        org, join(iati_result_path, snapshot_date)).get('iati-organisation')
+    current_country_codes = country_index.current_countries(
+        current_data_results)
 
-  Scenario: Country budget available three years forward
-    Given file is an organisation file
-     Then `recipient-country-budget[recipient-country/@code="{country_code}"]` should be available 3 years forward
-    '''
-    base_path = join(dirname(current_app.root_path),
-                     'index_indicator_definitions', 'test_definitions')
-    step_definitions = join(base_path, 'step_definitions.py')
-    tester = BDDTester(step_definitions)
+    organisations = []
+    for dataset_name, idx, identifier, in_scope, budgets in \
+            country_index.organisations():
+        if country_index.org_condition and condition_mask is not None:
+            # Where the test run recorded it, use the same answer.
+            masked = condition_mask.get(dataset_name, idx)
+            if masked is not None:
+                in_scope = masked
+        if in_scope:
+            organisations.append((dataset_name, idx, identifier, budgets))
 
     explanation_tmpl = 'Budget for {country_code} {found} ' + \
                        '{year} year{plural} forward'
-    fieldnames = ['dataset', 'identifier', 'index', 'result',
-                  'hierarchy', 'explanation']
-    with open(output_filepath, 'w') as handler:
-        writer = csv.DictWriter(handler, fieldnames=fieldnames)
-        writer.writeheader()
+    with results.ResultStoreWriter(output_path) as store:
+        writer = store.writer(test_name)
         for country_code in current_country_codes:
-            feature = tester._gherkinify_feature(
-                disaggregated_budget_tmpl.format(country_code=country_code))
-            for dataset in publisher.datasets:
-                for idx, organisation in enumerate(dataset.organisations):
-
-                    if condition:
-                        activity_condition, org_condition = condition.split('|')
-
-                        if org_condition.strip() and not organisation.etree.xpath(org_condition):
-                            continue
-
-                    for year, test in enumerate(feature.tests):
-                        result = test(
-                            organisation.etree,
-                            today=snapshot_date,
-                            codelists=codelists)
-                        explanation = explanation_tmpl.format(
-                            country_code=country_code,
-                            found='found' if result else 'not found',
-                            year=year + 1,
-                            plural='s' if year > 0 else '',
-                        )
-                        writer.writerow({
-                            'dataset': dataset.name,
-                            'identifier': organisation.id,
-                            'index': idx,
-                            'result': 'pass' if result else 'fail',
-                            'hierarchy': 1,
-                            'explanation': explanation,
-                        })
+            for dataset_name, idx, identifier, budgets in organisations:
+                country_budgets = budgets.get(country_code, [])
+                for year in BUDGET_YEARS:
+                    result = budget_available(country_budgets, year, today)
+                    explanation = explanation_tmpl.format(
+                        country_code=country_code,
+                        found='found' if result else 'not found',
+                        year=year,
+                        plural='s' if year > 1 else '',
+                    )
+                    writer.writerow({
+                        'dataset': dataset_name,
+                        'identifier': identifier,
+                        'index': idx,
+                        'result': 'pass' if result else 'fail',
+                        'hierarchy': 1,
+                        'explanation': explanation,
+                    })
@@ -0,0 +1,87 @@
+from base64 import b64decode, b64encode
+from itertools import chain
+
+
+# The bits of each possible byte, lowest first
+_BYTE_BITS = [tuple(byte >> bit & 1 == 1 for bit in range(8))
+              for byte in range(256)]
+
+
+class DatasetMasks(object):
+    """A bit array per dataset, with one bit per item index
+    (i.e. the position of an activity or organisation within
+    its dataset)."""
+
+    def __init__(self):
+        self._masks = {}
+
+    def __contains__(self, dataset):
+        return dataset in self._masks
+
+    def __iter__(self):
+        return iter(self._masks)
+
+    def __len__(self):
+        return len(self._masks)
+
+    def __eq__(self, other):
+        return isinstance(other, DatasetMasks) and \
+            self._masks == other._masks
+
+    def length(self, dataset):
+        """Return the number of items recorded for a dataset."""
+        return self._masks[dataset][1]
+
+    def set(self, dataset, idx, value):
+        bits, length = self._masks.get(dataset, (bytearray(), 0))
+        byte, bit = divmod(idx, 8)
+        if byte >= len(bits):
+            bits.extend(bytes(byte + 1 - len(bits)))
+        if value:
+            bits[byte] |= 1 << bit
+        else:
+            bits[byte] &= ~(1 << bit) & 0xff
+        self._masks[dataset] = (bits, max(length, idx + 1))
+
+    def get(self, dataset, idx, default=None):
+        """Return the bit for an item, or ``default`` if nothing
+        was recorded for it."""
+        mask = self._masks.get(dataset)
+        if mask is None or idx >= mask[1]:
+            return default
+        return mask[0][idx >> 3] >> (idx & 7) & 1 == 1
+
+    def decode(self, dataset):
+        """Return a list of the bit for each item recorded for a
+        dataset (empty if there are none). Quicker than ``get`` for
+        looking up many items of the same dataset."""
+        if dataset not in self._masks:
+            return []
+        bits, length = self._masks[dataset]
+        return list(chain.from_iterable(
+            map(_BYTE_BITS.__getitem__, bits)))[:length]
+
+    def update(self, other, dataset):
+        """Copy the mask for a dataset from another DatasetMasks
+        (if it has one)."""
+        if dataset in other._masks:
+            bits, length = other._masks[dataset]
+            self._masks[dataset] = (bytearray(bits), length)
+
+    def count(self, dataset):
+        """Return the number of set bits for a dataset."""
+        bits, _ = self._masks[dataset]
+        return sum(bin(byte).count('1') for byte in bits)
+
+    def as_dict(self):
+        return {dataset: {'length': length,
+                          'bits': b64encode(bytes(bits)).decode('ascii')}
+                for dataset, (bits, length) in self._masks.items()}
+
+    @classmethod
+    def from_dict(cls, data):
+        masks = cls()
+        for dataset, mask in data.items():
+            masks._masks[dataset] = (bytearray(b64decode(mask['bits'])),
+                                     mask['length'])
+        return masks
@@ -0,0 +1,117 @@
+"""Aggregate results as tests are run, rather than from saved results.
+
+A ResultCounter is handed every result row (see ``utils.run_tests``),
+and keeps pass / fail counts per test, dataset and hierarchy, for both
+the "All data" and "Current data" aggregations. So an organisation's
+aggregate results can be saved as soon as it's tested, without
+saving every result (and its explanation), then reading them all
+back in.
+
+For the "Current data" counts, each activity's current data result
+has to be known before its other results are counted, so the current
+data test needs to run first.
+"""
+from . import utils
+from .masks import DatasetMasks
+
+
+class _CountingWriter(object):
+    """Counts result rows, passing them on to another writer (if
+    any). Used in place of a ``results.ResultStoreWriter`` writer."""
+
+    def __init__(self, counter, test_name, writer=None):
+        self._counts = counter._counts.setdefault(test_name, ({}, {}))
+        self._current_data_results = counter.current_data_results
+        self._is_current_data_test = \
+            test_name == counter.current_data_test_name
+        self._writer = writer
+
+    def writerow(self, row):
+        dataset = row['dataset']
+        result = row['result']
+        if self._is_current_data_test:
+            self._current_data_results.set(
+                dataset, int(row['index']), result == 'pass')
+        if result in ('pass', 'fail'):
+            all_counts, current_counts = self._counts
+            hierarchy = row['hierarchy']
+            scores = all_counts.setdefault(dataset, {}).setdefault(
+                hierarchy, {'pass': 0, 'fail': 0})
+            scores[result] += 1
+            is_current = self._current_data_results.get(
+                dataset, int(row['index']))
+            if is_current is not False:
+                scores = current_counts.setdefault(dataset, {}).setdefault(
+                    hierarchy, {'pass': 0, 'fail': 0})
+                scores[result] += 1
+        if self._writer is not None:
+            self._writer.writerow(row)
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+
+class ResultCounter(object):
+    """Pass / fail counts for one organisation's test results."""
+
+    def __init__(self, current_data_test_name):
+        self.current_data_test_name = current_data_test_name
+        # Which activities are current, as returned by
+        # ``utils.load_current_data_results``.
+        self.current_data_results = DatasetMasks()
+        # Test name -> (all data, current data) counts, each a dict
+        # of dataset name -> hierarchy -> pass / fail counts.
+        self._counts = {}
+
+    def writer(self, test_name, writer=None):
+        """Return a writer that counts the results of a test,
+        passing them on to ``writer`` if given."""
+        return _CountingWriter(self, test_name, writer)
+
+    def summary_rows(self, org, test_ids, all_data=True):
+        """Return AggregateResult rows (as dicts) for each of the
+        tests in ``test_ids`` (a dict of test name to database ID),
+        like ``utils.summarize_results`` does from saved results.
+        Unless ``all_data`` is set, only the current data aggregation
+        is returned."""
+        # (As with summarize_results, if there are no current data
+        # results, the current data aggregation falls back to type 1.)
+        current_type = 2 if self.current_data_results else 1
+        aggregations = [(current_type, 1)]
+        if all_data:
+            aggregations.insert(0, (1, 0))
+        rows = []
+        for aggregateresulttype, counts_idx in aggregations:
+            for test_name, test_id in test_ids.items():
+                if test_name not in self._counts:
+                    continue
+                counts = self._counts[test_name][counts_idx]
+                for dataset, dataset_test_results in counts.items():
+                    rows.extend(utils.summary_rows(
+                        dataset, dataset_test_results, test_id, org,
+                        aggregateresulttype))
+        return rows
+
+
+def summarize_organisation(org, counter, snapshot_result_path, all_tests,
+                           test_ids, saved_test_names=(), all_data=True):
+    """Return the AggregateResult rows for an organisation, from the
+    counter. Tests named in ``saved_test_names`` (e.g. the info tests,
+    which aren't run by ``utils.run_tests``) are summarized from their
+    saved results instead. Unless ``all_data`` is set, the "All data"
+    aggregation is left out."""
+    rows = counter.summary_rows(
+        org, {test_name: test_id for test_name, test_id in test_ids.items()
+              if test_name not in saved_test_names},
+        all_data=all_data)
+    saved_tests = [test for test in all_tests
+                   if test.name in saved_test_names]
+    if saved_tests:
+        if all_data:
+            rows += utils.summarize_results(
+                org, snapshot_result_path, saved_tests)
+        rows += utils.summarize_results(
+            org, snapshot_result_path, saved_tests,
+            counter.current_data_results)
+    return rows
@@ -0,0 +1,288 @@
+"""Opt-in timing of tests, test steps and XPath expressions.
+
+``instrument`` times each of the loaded tests (and each of their
+steps), and switches the XPath cache to compile timed expressions.
+Nothing is timed unless profiling is turned on, so there's no
+overhead otherwise.
+
+Durations are recorded between calls to ``start`` and ``stop``.
+Each one is binned into a histogram as it's recorded, with buckets
+~5% apart, so only the counts are kept in memory (and saved)
+however big the snapshot. Percentiles are accurate to within a
+bucket.
+"""
+import json
+from math import floor, log
+from os.path import exists
+from time import perf_counter
+
+from bdd_tester.core import Step, Test
+from lxml import etree
+
+from . import xpath_cache
+from .checkpoint import atomic_write
+
+
+BUCKET_RATIO = 1.05
+_LOG_RATIO = log(BUCKET_RATIO)
+MIN_DURATION = 1e-9
+
+# Written as <name>.json and <name>.txt
+PROFILE_FILENAME = 'profile'
+
+SECTIONS = ('tests', 'steps', 'xpaths')
+SORT_KEYS = ('total', 'calls', 'mean', 'p50', 'p99')
+
+# A [calls, total, buckets] list of the durations recorded since
+# ``start``, keyed on (section, name). (Reset in place, since each
+# is bound to a recorder.)
+_timings = {}
+_active = False
+
+
+def _bucket(seconds):
+    return floor(log(max(seconds, MIN_DURATION)) / _LOG_RATIO)
+
+
+class Timings(object):
+    """Call counts, total time and a histogram of durations for
+    each of a set of keys."""
+
+    def __init__(self):
+        self._timings = {}
+
+    def add(self, key, durations):
+        buckets = {}
+        for seconds in durations:
+            bucket = _bucket(seconds)
+            buckets[bucket] = buckets.get(bucket, 0) + 1
+        self.add_counts(key, len(durations), sum(durations), buckets)
+
+    def add_counts(self, key, calls, total, buckets):
+        timing = self._timings.setdefault(key, [0, 0., {}])
+        timing[0] += calls
+        timing[1] += total
+        for bucket, count in buckets.items():
+            timing[2][bucket] = timing[2].get(bucket, 0) + count
+
+    def merge(self, other):
+        for key, (calls, total, buckets) in other._timings.items():
+            self.add_counts(key, calls, total, buckets)
+
+    @staticmethod
+    def _percentile(buckets, calls, fraction):
+        rank = fraction * calls
+        seen = 0
+        for bucket in sorted(buckets):
+            seen += buckets[bucket]
+            if seen >= rank:
+                # The upper bound of the bucket.
+                return BUCKET_RATIO ** (bucket + 1)
+        return 0.
+
+    def summary(self):
+        """Return a list of dicts, one per key, with the number of
+        calls, and the total, mean, median and 99th percentile time
+        (in seconds)."""
+        rows = []
+        for key, (calls, total, buckets) in self._timings.items():
+            rows.append({
+                'key': key,
+                'calls': calls,
+                'total': total,
+                'mean': total / calls,
+                'p50': self._percentile(buckets, calls, 0.5),
+                'p99': self._percentile(buckets, calls, 0.99),
+            })
+        return rows
+
+    def as_dict(self):
+        return {key: {'calls': calls, 'total': total,
+                      'buckets': {str(bucket): count
+                                  for bucket, count in buckets.items()}}
+                for key, (calls, total, buckets) in self._timings.items()}
+
+    @classmethod
+    def from_dict(cls, data):
+        timings = cls()
+        for key, timing in data.items():
+            timings._timings[key] = [
+                timing['calls'], timing['total'],
+                {int(bucket): count
+                 for bucket, count in timing['buckets'].items()}]
+        return timings
+
+
+class Profile(object):
+    def __init__(self):
+        self.sections = {section: Timings() for section in SECTIONS}
+
+    def merge(self, other):
+        for section in SECTIONS:
+            self.sections[section].merge(other.sections[section])
+
+    def as_dict(self):
+        return {section: self.sections[section].as_dict()
+                for section in SECTIONS}
+
+    @classmethod
+    def from_dict(cls, data):
+        profile = cls()
+        for section in SECTIONS:
+            profile.sections[section] = Timings.from_dict(
+                data.get(section, {}))
+        return profile
+
+    def format_table(self, sort='total', limit=None):
+        """Return the timings as a text table, per section, sorted
+        (descending) by ``sort``."""
+        lines = []
+        header = '{:>10} {:>12} {:>10} {:>10} {:>10}  {}'.format(
+            'calls', 'total (s)', 'mean (ms)', 'p50 (ms)', 'p99 (ms)', '')
+        for section in SECTIONS:
+            rows = sorted(self.sections[section].summary(),
+                          key=lambda row: row[sort], reverse=True)
+            if limit is not None:
+                rows = rows[:limit]
+            lines.append(section.title())
+            lines.append(header)
+            for row in rows:
+                lines.append(
+                    '{calls:>10} {total:>12.3f} {mean:>10.3f} {p50:>10.3f} '
+                    '{p99:>10.3f}  {key}'.format(
+                        calls=row['calls'], total=row['total'],
+                        mean=row['mean'] * 1000, p50=row['p50'] * 1000,
+                        p99=row['p99'] * 1000, key=row['key']))
+            lines.append('')
+        return '\n'.join(lines)
+
+
+def _recorder(key):
+    """Return a function that records a duration against ``key``."""
+    timing = _timings.setdefault(key, [0, 0., {}])
+    buckets = timing[2]
+
+    def record(seconds):
+        timing[0] += 1
+        timing[1] += seconds
+        bucket = _bucket(seconds)
+        buckets[bucket] = buckets.get(bucket, 0) + 1
+    return record
+
+
+def timed_xpath(expression, namespaces=None):
+    """Compile an XPath expression, returning a function that
+    evaluates it, recording how long each evaluation takes."""
+    compiled = etree.XPath(expression, namespaces=namespaces)
+    record = _recorder(('xpaths', expression))
+
+    def evaluate(*args, **kwargs):
+        start = perf_counter()
+        result = compiled(*args, **kwargs)
+        if _active:
+            record(perf_counter() - start)
+        return result
+    return evaluate
+
+
+class TimedTest(Test):
+    """A test that records how long each call takes.
+
+    (Replaces ``Test.__call__``, rather than wrapping it, so as not
+    to add another call per test.)"""
+
+    def __call__(self, obj, *args, **kwargs):
+        verbose = kwargs.pop('bdd_verbose', False)
+        start = perf_counter()
+        res, msg = self.loop(obj, self.steps, *args, **kwargs)
+        if _active:
+            self.record(perf_counter() - start)
+        if verbose:
+            return res, msg
+        return res
+
+
+class TimedStep(Step):
+    """A test step that records how long each call takes.
+
+    (Replaces ``Step.__call__``, rather than wrapping the step
+    function, so as not to add another call per step.)"""
+
+    def __call__(self, *args, **kwargs):
+        if self.expr_groups:
+            args = args + self.expr_groups
+        start = perf_counter()
+        try:
+            return self.expr_fn(*args, **kwargs)
+        finally:
+            if _active:
+                self.record(perf_counter() - start)
+
+
+def instrument(tests):
+    """Time every test in ``tests``, and each of their steps (and
+    every XPath expression compiled from now on). Tests that are
+    already timed are left as they are."""
+    xpath_cache.set_factory(timed_xpath)
+    for test in tests:
+        if isinstance(test, TimedTest):
+            continue
+        test.__class__ = TimedTest
+        test.record = _recorder(('tests', test.name))
+        patterns = {fn: pattern for pattern, (_, fn, _)
+                    in test.feature.tester.store.items()}
+        for step in test.steps:
+            pattern = patterns.get(step.expr_fn, step.text)
+            step.__class__ = TimedStep
+            step.record = _recorder(('steps', pattern))
+
+
+def _clear():
+    for timing in _timings.values():
+        timing[0] = 0
+        timing[1] = 0.
+        timing[2].clear()
+
+
+def start():
+    """Start recording, discarding anything recorded before."""
+    global _active
+    _clear()
+    _active = True
+
+
+def stop():
+    """Stop recording, and return a Profile of everything recorded
+    since ``start``."""
+    global _active
+    _active = False
+    profile = Profile()
+    for (section, name), (calls, total, buckets) in _timings.items():
+        if calls:
+            profile.sections[section].add_counts(name, calls, total,
+                                                 buckets)
+    _clear()
+    return profile
+
+
+def save(profile, output_path, sort='total'):
+    """Write a profile as both JSON and a text table."""
+    with atomic_write(output_path + '.json') as handler:
+        json.dump(profile.as_dict(), handler, sort_keys=True)
+    with atomic_write(output_path + '.txt') as handler:
+        handler.write(profile.format_table(sort=sort))
+
+
+def load(filepath):
+    with open(filepath) as handler:
+        return Profile.from_dict(json.load(handler))
+
+
+def merge_files(filepaths):
+    """Return the combined profile from a number of JSON profiles.
+    Missing files are ignored."""
+    profile = Profile()
+    for filepath in filepaths:
+        if exists(filepath):
+            profile.merge(load(filepath))
+    return profile
@@ -0,0 +1,334 @@
+"""Compact storage for test results.
+
+Each organisation's results are kept in a single file
+(``results.bin``), with a table per test. Each row of a table is the
+result of the test for one item: its dataset, index, identifier,
+hierarchy, result and explanation. Rather than repeating the dataset,
+identifier, hierarchy and explanation on every row (as the CSVs did),
+each distinct string is stored once, in a string table shared by all
+the tests, and rows refer to strings by number. The result is a one
+byte code.
+
+The file is laid out as follows (integers are little-endian):
+
+    8 bytes     ``MAGIC``
+    8 bytes     header length
+    header      JSON, with the number of strings and the position and
+                number of rows of each table, padded to 8 bytes
+    strings     uint64 offsets (one more than the number of strings),
+                then the UTF-8 encoded strings, padded to 8 bytes
+    tables      for each table, uint32 dataset, index, identifier,
+                hierarchy and explanation columns, then a uint8 result
+                column, padded to 8 bytes
+
+so columns can be read straight out of a memory map (on little-endian
+machines; elsewhere, they're copied and byteswapped). Results from
+before this format (a CSV per test) can still be read, using
+``open_results``, and ``export_csv`` writes a table out as a CSV.
+"""
+from array import array
+import csv
+from glob import glob
+import json
+import mmap
+from os.path import exists, join
+import struct
+import sys
+
+from . import utils
+from .checkpoint import atomic_write
+
+
+MAGIC = b'IATIRES1'
+RESULTS_FILENAME = 'results.bin'
+
+RESULT_CODES = {'pass': 0, 'fail': 1, 'not relevant': 2, 'skipped': 3}
+UNKNOWN_RESULT = 255
+_RESULT_NAMES = [''] * 256
+for _name, _code in RESULT_CODES.items():
+    _RESULT_NAMES[_code] = _name
+
+# uint32 columns, in the order they're stored, followed by the
+# uint8 result column.
+COLUMNS = ('dataset', 'index', 'identifier', 'hierarchy', 'explanation')
+
+
+_BIG_ENDIAN = sys.byteorder == 'big'
+
+
+def _padding(length):
+    return -length % 8
+
+
+def _read_uints(view, typecode):
+    """Return the little-endian unsigned ints in ``view``, as a
+    sequence."""
+    if not _BIG_ENDIAN:
+        return view.cast(typecode)
+    column = array(typecode, bytes(view))
+    column.byteswap()
+    return column
+
+
+def _little_endian(column):
+    """Return an array of unsigned ints, byteswapped if need be so
+    that its bytes are little-endian."""
+    if _BIG_ENDIAN:
+        column = array(column.typecode, column)
+        column.byteswap()
+    return column
+
+
+def _table_size(rows):
+    size = (4 * len(COLUMNS) + 1) * rows
+    return size + _padding(size)
+
+
+class ResultTable(object):
+    """The results of one test, as columns. Strings are stored as
+    numbers; use ``ResultStore.string`` to look them up."""
+
+    def __init__(self, store, view, rows):
+        self._store = store
+        (self.datasets, self.indexes, self.identifiers, self.hierarchies,
+         self.explanations) = [
+            _read_uints(view[pos * 4 * rows:(pos + 1) * 4 * rows], 'I')
+            for pos in range(len(COLUMNS))]
+        self.results = view[len(COLUMNS) * 4 * rows:
+                            (len(COLUMNS) * 4 + 1) * rows]
+
+    def __len__(self):
+        return len(self.results)
+
+    def rows(self):
+        """Yield each row as a dict, like a ``csv.DictReader`` over
+        the old CSV would (except that the index is an int)."""
+        string = self._store.string
+        for dataset, index, identifier, hierarchy, explanation, result in \
+                zip(self.datasets, self.indexes, self.identifiers,
+                    self.hierarchies, self.explanations, self.results):
+            yield {
+                'dataset': string(dataset),
+                'identifier': string(identifier),
+                'index': index,
+                'result': _RESULT_NAMES[result],
+                'hierarchy': string(hierarchy),
+                'explanation': string(explanation),
+            }
+
+
+class ResultStore(object):
+    """Reads an organisation's results file, via a memory map."""
+
+    def __init__(self, filepath):
+        with open(filepath, 'rb') as handler:
+            self._mmap = mmap.mmap(handler.fileno(), 0,
+                                   access=mmap.ACCESS_READ)
+        if self._mmap[:len(MAGIC)] != MAGIC:
+            raise ValueError('Not a results file: {}'.format(filepath))
+        header_length, = struct.unpack_from('<Q', self._mmap, len(MAGIC))
+        start = len(MAGIC) + 8
+        header = json.loads(self._mmap[start:start + header_length]
+                            .decode('utf-8'))
+        body = start + header_length
+        self._view = memoryview(self._mmap)[body:]
+        count = self._string_count = header['strings']
+        self._offsets = _read_uints(self._view[:8 * (count + 1)], 'Q')
+        self._strings_start = 8 * (count + 1)
+        self._cache = {}
+        # Test name -> (position, rows), relative to the body.
+        self._tables = {name: (offset, rows)
+                        for name, offset, rows in header['tables']}
+
+    def __contains__(self, test_name):
+        return test_name in self._tables
+
+    def __iter__(self):
+        return iter(self._tables)
+
+    def __len__(self):
+        return len(self._tables)
+
+    def string(self, string_id):
+        try:
+            return self._cache[string_id]
+        except KeyError:
+            start = self._strings_start + self._offsets[string_id]
+            end = self._strings_start + self._offsets[string_id + 1]
+            value = self._cache[string_id] = \
+                bytes(self._view[start:end]).decode('utf-8')
+            return value
+
+    def strings(self):
+        return [self.string(string_id)
+                for string_id in range(self._string_count)]
+
+    def table_bytes(self, test_name):
+        """Return the raw bytes of a test's table, and its number
+        of rows."""
+        offset, rows = self._tables[test_name]
+        return self._view[offset:offset + _table_size(rows)], rows
+
+    def table(self, test_name):
+        view, rows = self.table_bytes(test_name)
+        return ResultTable(self, view, rows)
+
+    def rows(self, test_name):
+        return self.table(test_name).rows()
+
+
+class CsvResults(object):
+    """Reads results from before the results file, i.e. one CSV per
+    test."""
+
+    def __init__(self, output_path):
+        self.output_path = output_path
+
+    def _filepath(self, test_name):
+        return join(self.output_path, utils.slugify(test_name) + '.csv')
+
+    def __contains__(self, test_name):
+        return exists(self._filepath(test_name))
+
+    def rows(self, test_name):
+        with open(self._filepath(test_name)) as handler:
+            for row in csv.DictReader(handler):
+                yield row
+
+
+def open_results(output_path):
+    """Return a reader for an organisation's results, with a
+    ``rows(test_name)`` method (and supporting ``in``)."""
+    filepath = join(output_path, RESULTS_FILENAME)
+    if exists(filepath):
+        return ResultStore(filepath)
+    return CsvResults(output_path)
+
+
+def result_filepaths(output_path):
+    """Return the paths of the files holding an organisation's
+    results."""
+    filepath = join(output_path, RESULTS_FILENAME)
+    if exists(filepath):
+        return [filepath]
+    return sorted(glob(join(output_path, '*.csv')))
+
+
+class _TableWriter(object):
+    """Adds rows to a table. Has the same ``writerow`` and
+    ``writerows`` methods as a ``csv.DictWriter``."""
+
+    def __init__(self, store_writer, columns):
+        self._intern = store_writer.intern
+        self._columns = columns
+
+    def writerow(self, row):
+        intern = self._intern
+        datasets, indexes, identifiers, hierarchies, explanations, \
+            results = self._columns
+        datasets.append(intern(row['dataset']))
+        indexes.append(int(row['index']))
+        identifiers.append(intern(row['identifier']))
+        hierarchies.append(intern(row['hierarchy']))
+        explanations.append(intern(row['explanation']))
+        results.append(RESULT_CODES.get(row['result'], UNKNOWN_RESULT))
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+
+class ResultStoreWriter(object):
+    """Writes an organisation's results file.
+
+    Tables already in the file are kept, unless a table for the same
+    test is written. Use as a context manager; the file is only
+    replaced if the block completes without an exception."""
+
+    def __init__(self, output_path):
+        self.filepath = join(output_path, RESULTS_FILENAME)
+        self._strings = []
+        self._ids = {}
+        self._tables = {}
+        self._existing = None
+        if exists(self.filepath):
+            self._existing = ResultStore(self.filepath)
+            # Keep the same numbering, so existing tables can be
+            # copied as they are.
+            for value in self._existing.strings():
+                self.intern(value)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.save()
+
+    def intern(self, value):
+        """Return the number of a string, adding it if it's new.
+        (None is stored as an empty string, as in a CSV.)"""
+        value = '' if value is None else str(value)
+        try:
+            return self._ids[value]
+        except KeyError:
+            string_id = self._ids[value] = len(self._strings)
+            self._strings.append(value)
+            return string_id
+
+    def writer(self, test_name):
+        """Return a writer for a test's results, replacing any
+        existing table for the test."""
+        columns = tuple(array('I') for _ in COLUMNS) + (bytearray(),)
+        self._tables[test_name] = columns
+        return _TableWriter(self, columns)
+
+    def save(self):
+        offsets = array('Q', [0])
+        encoded = bytearray()
+        for value in self._strings:
+            encoded += value.encode('utf-8')
+            offsets.append(len(encoded))
+        encoded += bytes(_padding(len(encoded)))
+
+        tables = []
+        if self._existing is not None:
+            tables += [(name, self._existing.table_bytes(name))
+                       for name in self._existing
+                       if name not in self._tables]
+        for name, columns in self._tables.items():
+            table = bytearray()
+            for column in columns[:-1]:
+                table += _little_endian(column)
+            table += columns[-1]
+            table += bytes(_padding(len(table)))
+            tables.append((name, (table, len(columns[-1]))))
+
+        position = len(offsets) * 8 + len(encoded)
+        header_tables = []
+        for name, (table, rows) in tables:
+            header_tables.append([name, position, rows])
+            position += len(table)
+        header = json.dumps({
+            'strings': len(self._strings),
+            'tables': header_tables,
+        }).encode('utf-8')
+        header += b' ' * _padding(len(header))
+
+        with atomic_write(self.filepath, 'wb') as handler:
+            handler.write(MAGIC)
+            handler.write(struct.pack('<Q', len(header)))
+            handler.write(header)
+            handler.write(_little_endian(offsets))
+            handler.write(encoded)
+            for _, (table, _) in tables:
+                handler.write(table)
+
+
+def export_csv(reader, test_name, filepath):
+    """Write a test's results out as a CSV, in the format
+    ``test_data`` used to write."""
+    with atomic_write(filepath) as handler:
+        writer = csv.DictWriter(handler, fieldnames=utils.RESULT_FIELDNAMES)
+        writer.writeheader()
+        writer.writerows(reader.rows(test_name))
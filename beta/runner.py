@@ -0,0 +1,290 @@
+from collections import namedtuple
+import multiprocessing
+from os.path import join
+import traceback
+
+import iatikit
+
+from . import checkpoint, incremental, infotest, profiling, utils, \
+    xpath_cache
+
+
+# A plain copy of the organisation fields the test run needs. Unlike
+# the ORM object, it is safe to hand to a worker process.
+OrgUnit = namedtuple('OrgUnit', ['organisation_name', 'organisation_code',
+                                 'registry_slug', 'condition'])
+
+
+def org_unit(org):
+    return OrgUnit(org.organisation_name, org.organisation_code,
+                   org.registry_slug, org.condition)
+
+
+def load_all_tests():
+    """Load the index tests, plus the current data test."""
+    all_tests = utils.load_tests()
+    all_tests.append(utils.load_current_data_test())
+    return all_tests
+
+
+CURRENT_DATA_TEST = 'Current data'
+COUNTRY_STRATEGY_TEST = \
+    'Strategy (country/sector) or Memorandum of Understanding'
+DISAGGREGATED_BUDGET_TEST = 'Disaggregated budget'
+INFOTESTS = (COUNTRY_STRATEGY_TEST, DISAGGREGATED_BUDGET_TEST)
+
+
+def run_organisation(org, publisher, all_tests, root_output_path,
+                     snapshot_date, codelists, echo=None, streaming=False,
+                     fingerprint=None, previous_result_path=None,
+                     resume=False, current_only=False, profile=False,
+                     counter=None, write_results=True):
+    """Run every test for a single organisation, saving the results
+    to a directory named after the organisation code.
+
+    ``fingerprint`` identifies the tests and codelists in use (see
+    ``incremental.tests_fingerprint``). If ``previous_result_path``
+    is also given, results for datasets that are unchanged since
+    that snapshot are reused, rather than retested.
+
+    If ``resume`` is set, tests already completed for this
+    organisation (by an earlier, interrupted run) are skipped.
+
+    If ``current_only`` is set, activity tests are only run on
+    current activities (according to the current data test), and
+    are recorded as skipped for everything else.
+
+    If ``profile`` is set, the time taken by each test step and
+    XPath expression is recorded, and written to ``profile.json``
+    and ``profile.txt`` alongside the results.
+
+    If ``counter`` (a ``pipeline.ResultCounter``) is given, the
+    results are counted as they're written, so they can be aggregated
+    without reading them back. Unless ``write_results`` is also set,
+    only the info test results are saved; the organisation isn't
+    marked complete then, since its results can't be reused, resumed
+    or aggregated from the saved results. A counter can't be used
+    with ``resume``.
+
+    Returns a dict of the number of datasets ``reused`` and
+    ``retested``.
+    """
+    def log(msg):
+        if echo is not None:
+            echo(msg)
+
+    output_path = join(root_output_path, org.organisation_code)
+    if resume and checkpoint.organisation_marked_complete(output_path):
+        log('Already tested.')
+        return {'reused': 0, 'retested': 0}
+    checkpoint.start(output_path, resume=resume, current_only=current_only)
+
+    def pending(test_name):
+        return not (resume and checkpoint.is_complete(output_path, test_name))
+
+    # (Tests without a level are never run, so never complete.)
+    all_tests = [test for test in all_tests
+                 if utils.test_level(test) is not None]
+    pending_tests = [test for test in all_tests if pending(test.name)]
+    pending_infotests = [test_name for test_name in INFOTESTS
+                         if pending(test_name)]
+    if len(pending_tests) < len(all_tests):
+        log('Resuming: {} of {} tests already run ...'.format(
+            len(all_tests) - len(pending_tests), len(all_tests)))
+
+    manifest = incremental.build_manifest(org, publisher, fingerprint)
+    previous = None
+    if fingerprint is not None:
+        previous = incremental.load_previous(
+            org, previous_result_path, manifest, current_only=current_only)
+    stats = {'reused': 0, 'retested': len(manifest['datasets'])}
+    if previous is not None:
+        stats['reused'] = len(previous.reusable)
+        stats['retested'] -= stats['reused']
+        log('Reusing results for {} unchanged dataset(s) ...'.format(
+            stats['reused']))
+
+    current_data_test = None
+    if current_only:
+        current_data_test = next((test for test in pending_tests
+                                  if test.name == CURRENT_DATA_TEST), None)
+
+    # Gathered as the activities are tested, for the info tests.
+    country_index = infotest.CountryIndex(org.condition)
+    condition_masks = {}
+    if resume:
+        condition_masks = utils.load_condition_masks(org, root_output_path)
+    if profile:
+        profiling.instrument(all_tests)
+        profiling.start()
+    log('Running {} tests ...'.format(len(pending_tests)))
+    try:
+        # Checkpoint after each level, since each is a separate
+        # pass over the data.
+        for level in ('iati-activity', 'iati-organisation'):
+            level_tests = [test for test in pending_tests
+                           if utils.test_level(test) == level]
+            if not level_tests:
+                continue
+            if counter is not None:
+                # The current data results are needed to count the
+                # other tests' results.
+                level_tests.sort(
+                    key=lambda test: test.name != CURRENT_DATA_TEST)
+            condition_masks.update(utils.run_tests(
+                level_tests, publisher, output_path, org.condition,
+                streaming=streaming, previous=previous,
+                current_data_test=current_data_test,
+                collector=country_index, counter=counter,
+                write_results=write_results, codelists=codelists,
+                today=snapshot_date))
+            utils.save_condition_masks(org, root_output_path,
+                                       condition_masks)
+            if write_results:
+                for test in level_tests:
+                    checkpoint.mark_complete(output_path, test.name)
+
+        run_infotests(org, root_output_path, snapshot_date,
+                      pending_infotests, echo=echo, streaming=streaming,
+                      publisher=publisher, country_index=country_index,
+                      current_data_results=(counter.current_data_results
+                                            if counter is not None
+                                            else None))
+    finally:
+        if previous is not None:
+            previous.close()
+        if profile:
+            # Stopped even if testing fails, so that nothing else is
+            # recorded until the next organisation starts.
+            timings = profiling.stop()
+
+    if profile:
+        profiling.save(timings, join(output_path, profiling.PROFILE_FILENAME))
+    if not write_results:
+        return stats
+    if fingerprint is not None:
+        # Written last, so results are only ever reused from
+        # organisations that finished testing.
+        incremental.save_manifest(org, root_output_path, manifest)
+    checkpoint.mark_organisation_complete(output_path)
+    return stats
+
+
+def run_infotests(org, root_output_path, snapshot_date,
+                  test_names=INFOTESTS, echo=None, streaming=False,
+                  publisher=None, country_index=None,
+                  current_data_results=None):
+    """Run the country strategy / MoU and disaggregated budget tests
+    for an organisation. These depend on the current data results,
+    so must be run after the other tests.
+
+    Both tests share a single ``infotest.CountryIndex``, which is read
+    from the publisher's data (loaded from the snapshot if not given),
+    unless ``country_index`` was already filled in while testing.
+    Likewise, the current data results are loaded from the saved
+    results, unless ``current_data_results`` is given."""
+    def log(msg):
+        if echo is not None:
+            echo(msg)
+
+    if not test_names:
+        return
+    output_path = join(root_output_path, org.organisation_code)
+    if current_data_results is None:
+        current_data_results = utils.load_current_data_results(
+            org, root_output_path)
+    if publisher is None:
+        publisher = infotest.load_publisher(org, snapshot_date)
+    if country_index is None:
+        country_index = infotest.CountryIndex(org.condition)
+
+    if COUNTRY_STRATEGY_TEST in test_names:
+        log(COUNTRY_STRATEGY_TEST)
+        infotest.country_strategy_or_mou(
+            org, snapshot_date, COUNTRY_STRATEGY_TEST, current_data_results,
+            streaming=streaming, publisher=publisher,
+            country_index=country_index)
+        checkpoint.mark_complete(output_path, COUNTRY_STRATEGY_TEST)
+
+    if DISAGGREGATED_BUDGET_TEST in test_names:
+        log(DISAGGREGATED_BUDGET_TEST)
+        infotest.disaggregated_budget(
+            org, snapshot_date, DISAGGREGATED_BUDGET_TEST,
+            current_data_results, org.condition, streaming=streaming,
+            publisher=publisher,
+            country_index=country_index)
+        checkpoint.mark_complete(output_path, DISAGGREGATED_BUDGET_TEST)
+
+
+# Per-process state, populated once by the pool initializer.
+_worker = {}
+
+
+def _init_worker(app, snapshot_xml_path, root_output_path, snapshot_date,
+                 codelists, streaming, fingerprint, previous_result_path,
+                 resume, current_only, profile):
+    ctx = app.app_context()
+    ctx.push()
+    _worker['ctx'] = ctx
+    _worker['publishers'] = iatikit.data(path=snapshot_xml_path).publishers
+    _worker['root_output_path'] = root_output_path
+    _worker['snapshot_date'] = snapshot_date
+    _worker['codelists'] = codelists
+    _worker['streaming'] = streaming
+    _worker['fingerprint'] = fingerprint
+    _worker['previous_result_path'] = previous_result_path
+    _worker['resume'] = resume
+    _worker['current_only'] = current_only
+    _worker['profile'] = profile
+    _worker['all_tests'] = load_all_tests()
+
+
+def _run_worker(org):
+    before = xpath_cache.stats()
+    error = None
+    stats = {'reused': 0, 'retested': 0}
+    try:
+        publisher = _worker['publishers'].get(org.registry_slug)
+        stats = run_organisation(
+            org, publisher, _worker['all_tests'],
+            _worker['root_output_path'], _worker['snapshot_date'],
+            _worker['codelists'], streaming=_worker['streaming'],
+            fingerprint=_worker['fingerprint'],
+            previous_result_path=_worker['previous_result_path'],
+            resume=_worker['resume'],
+            current_only=_worker['current_only'],
+            profile=_worker['profile'])
+    except Exception:
+        error = traceback.format_exc()
+    after = xpath_cache.stats()
+    stats['hits'] = after['hits'] - before['hits']
+    stats['misses'] = after['misses'] - before['misses']
+    return org, error, stats
+
+
+def run_organisations_parallel(app, orgs, snapshot_xml_path,
+                               root_output_path, snapshot_date, codelists,
+                               workers, streaming=False, fingerprint=None,
+                               previous_result_path=None, resume=False,
+                               current_only=False, profile=False):
+    """Fan organisations out to a pool of worker processes.
+
+    Each worker loads the tests once, then tests whole organisations,
+    so the output of each organisation is written by exactly the same
+    code as in a serial run. Yields an
+    ``(org, error, stats)`` tuple as each organisation finishes,
+    where ``error`` is a formatted traceback, or None on success, and
+    ``stats`` holds the number of datasets reused and retested, and
+    the XPath cache hits and misses incurred while testing it.
+    """
+    # Workers inherit the app (and its config) by forking. This
+    # also means the codelists are shared copy-on-write, rather
+    # than pickled and rebuilt in each worker.
+    mp = multiprocessing.get_context('fork')
+    initargs = (app, snapshot_xml_path, root_output_path, snapshot_date,
+                codelists, streaming, fingerprint, previous_result_path,
+                resume, current_only, profile)
+    with mp.Pool(workers, initializer=_init_worker,
+                 initargs=initargs) as pool:
+        for result in pool.imap_unordered(_run_worker, orgs):
+            yield result
@@ -0,0 +1,96 @@
+"""Stream activities and organisations out of IATI datasets.
+
+iatikit parses a whole dataset into memory before yielding any of
+its activities. Here, datasets are read with ``lxml.etree.iterparse``
+instead, and each item is freed as soon as the caller moves on to
+the next one, so peak memory is bounded by the largest single item
+rather than the largest file.
+
+Items are wrapped in the usual iatikit ``Activity`` and
+``Organisation`` classes, so they can be used interchangeably.
+Since preceding items are discarded, XPath expressions that look
+at sibling items won't find anything.
+"""
+from iatikit.data.activity import Activity
+from iatikit.data.organisation import Organisation
+from iatikit.standard.schema import get_schema
+from iatikit.utils.exceptions import SchemaError
+from lxml import etree
+
+
+FILETYPES = {
+    'activity': ('iati-activities', 'iati-activity', Activity),
+    'organisation': ('iati-organisations', 'iati-organisation',
+                     Organisation),
+}
+
+
+def _iterparse(filepath, **kwargs):
+    return etree.iterparse(filepath, remove_blank_text=True,
+                           huge_tree=True, **kwargs)
+
+
+def _metadata_filetype(dataset):
+    try:
+        return dataset.metadata['extras']['filetype']
+    except KeyError:
+        return None
+
+
+def _is_well_formed(filepath):
+    """Check a file parses, without holding it in memory."""
+    try:
+        for _, element in _iterparse(filepath):
+            element.clear()
+    except etree.XMLSyntaxError:
+        return False
+    return True
+
+
+def iter_dataset(dataset, filetype):
+    """Yield each activity or organisation (according to
+    ``filetype``) in a dataset, one at a time.
+
+    As with iatikit, datasets of a different filetype, with invalid
+    XML or an unknown IATI version are skipped entirely.
+    """
+    root_tag, item_tag, item_class = FILETYPES[filetype]
+    if dataset.data_path is None:
+        return
+    metadata_filetype = _metadata_filetype(dataset)
+    if metadata_filetype in FILETYPES and metadata_filetype != filetype:
+        return
+    if not _is_well_formed(dataset.data_path):
+        return
+
+    root = None
+    schema = None
+    events = _iterparse(dataset.data_path, events=('start', 'end'),
+                        tag=(root_tag, item_tag))
+    for event, element in events:
+        if root is None:
+            if event != 'start' or element.tag != root_tag:
+                # Not the expected kind of file
+                return
+            root = element
+            try:
+                schema = get_schema(filetype,
+                                    root.get('version', '1.01'))
+            except SchemaError:
+                return
+            continue
+        if event != 'end' or element.getparent() is not root:
+            continue
+        yield item_class(element, dataset, schema)
+        # Free this item, and anything before it.
+        element.clear()
+        while element.getprevious() is not None:
+            del root[0]
+
+
+def iter_publisher(publisher, filetype):
+    """Yield each activity or organisation in a publisher's
+    datasets, one at a time."""
+    for dataset in publisher.datasets:
+        for item in iter_dataset(dataset, filetype):
+            yield item
@@ -0,0 +1,131 @@
+"""A cache of parsed test definitions.
+
+Loading the tests means importing the step definitions, and parsing
+each feature file with gherkin. This is done at least once per
+command, and (for the current data and disaggregated budget tests)
+once per organisation.
+
+Here, the step definitions are imported once per process, and parsed
+features are kept in a pickle on disk, so they're only parsed again
+when a feature file (or the step definitions) changes. Only the
+gherkin output is pickled; tests are rebuilt from it against the
+imported step definitions each time.
+"""
+import hashlib
+from os import chmod, fdopen, remove, replace, stat
+from os.path import dirname, exists, join
+import pickle
+from tempfile import mkstemp
+
+from flask import current_app
+from bdd_tester import BDDTester
+from bdd_tester.core import Feature
+
+from . import utils
+
+
+CACHE_VERSION = 1
+
+# Per-process state.
+_tester = {}
+_cache = {}
+
+
+def cache_filepath():
+    return current_app.config.get(
+        'TEST_PLAN_CACHE_FILENAME',
+        join(dirname(current_app.root_path), 'test_plan_cache.pickle'))
+
+
+def step_definitions_filepath():
+    return join(utils.test_definitions_path(), 'step_definitions.py')
+
+
+def _step_definitions_hash(filepath):
+    with open(filepath, 'rb') as handler:
+        return hashlib.sha1(handler.read()).hexdigest()
+
+
+def get_tester():
+    """Return a BDDTester for the index step definitions, importing
+    them only if they've changed since the last call."""
+    filepath = step_definitions_filepath()
+    key = (filepath, _step_definitions_hash(filepath))
+    if _tester.get('key') != key:
+        _tester['key'] = key
+        _tester['tester'] = BDDTester(filepath)
+    return _tester['tester']
+
+
+def _load_cache():
+    """Return the parsed feature cache, reading it from disk the
+    first time. Entries are discarded if the step definitions have
+    changed."""
+    step_definitions_hash = _tester['key'][1]
+    if _cache.get('step_definitions') == step_definitions_hash:
+        return _cache
+    _cache.clear()
+    filepath = cache_filepath()
+    if exists(filepath):
+        try:
+            with open(filepath, 'rb') as handler:
+                data = pickle.load(handler)
+        except (EOFError, pickle.UnpicklingError):
+            data = {}
+        if data.get('version') == CACHE_VERSION and \
+                data.get('step_definitions') == step_definitions_hash:
+            _cache.update(data)
+    if not _cache:
+        _cache.update({
+            'version': CACHE_VERSION,
+            'step_definitions': step_definitions_hash,
+            'files': {},
+        })
+    return _cache
+
+
+def _save_cache():
+    # Several processes may be saving at once, so each writes to
+    # its own temporary file.
+    filepath = cache_filepath()
+    fd, temp_filepath = mkstemp(dir=dirname(filepath),
+                                suffix='.partial')
+    try:
+        with fdopen(fd, 'wb') as handler:
+            pickle.dump(_cache, handler, pickle.HIGHEST_PROTOCOL)
+        chmod(temp_filepath, 0o644)
+    except BaseException:
+        remove(temp_filepath)
+        raise
+    replace(temp_filepath, filepath)
+
+
+def _parse(tester, feature_txt):
+    return tester.gherkinparser.parse(feature_txt)['feature']
+
+
+def load_features(feature_filepaths):
+    """Load a list of feature files, using cached parses where
+    the file hasn't been modified."""
+    tester = get_tester()
+    cache = _load_cache()
+    features = []
+    updated = False
+    for filepath in feature_filepaths:
+        file_stat = stat(filepath)
+        key = (file_stat.st_mtime_ns, file_stat.st_size)
+        cached = cache['files'].get(filepath)
+        if cached is None or cached[0] != key:
+            with open(filepath) as handler:
+                cached = (key, _parse(tester, handler.read()))
+            cache['files'][filepath] = cached
+            updated = True
+        features.append(Feature(cached[1], tester))
+    if updated:
+        _save_cache()
+    return features
+
+
+def load_feature(feature_filepath):
+    return load_features([feature_filepath])[0]
+
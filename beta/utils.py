@@ -1,23 +1,34 @@
+from contextlib import ExitStack
 import csv
+import io
 from glob import glob
+import json
 from os.path import dirname, exists, join
 
 from flask import current_app
-from bdd_tester import BDDTester
+import iatikit
 
 from iatidataquality import db
 from iatidq.models import AggregateResult, Test
+from iatidq.summary_cache import bump_versions
+from . import results, test_plan
+from .checkpoint import atomic_write
+from .masks import DatasetMasks
+from .streaming import iter_dataset, iter_publisher
+from .xpath_cache import xpath
+
+
+def test_definitions_path():
+    """Return the path to the index test definitions."""
+    return join(dirname(current_app.root_path),
+                'index_indicator_definitions', 'test_definitions')
 
 
 def load_tests():
     """Load the index tests."""
-    base_path = join(dirname(current_app.root_path),
-                     'index_indicator_definitions', 'test_definitions')
-    step_definitions = join(base_path, 'step_definitions.py')
-    feature_filepaths = glob(join(base_path, '*', '*.feature'))
-    tester = BDDTester(step_definitions)
-    all_tests = [t for feature_filepath in feature_filepaths
-                 for t in tester.load_feature(feature_filepath).tests]
+    feature_filepaths = glob(join(test_definitions_path(), '*', '*.feature'))
+    all_tests = [t for feature in test_plan.load_features(feature_filepaths)
+                 for t in feature.tests]
 
     # Remove the current data condition from tests.
     for test in all_tests:
@@ -30,31 +41,71 @@ def load_tests():
 
 def load_current_data_test():
     """Load the current data test."""
-    base_path = join(dirname(current_app.root_path),
-                     'index_indicator_definitions', 'test_definitions')
-    step_definitions = join(base_path, 'step_definitions.py')
-    tester = BDDTester(step_definitions)
-    return tester.load_feature(
-        join(base_path, 'current_data.feature')).tests[0]
+    return test_plan.load_feature(
+        join(test_definitions_path(), 'current_data.feature')).tests[0]
+
+
+def load_codelists():
+    """Load all codelists, as a dict of codelist name to a frozenset
+    of its codes.
+
+    iatikit codelists are scanned (and each code rebuilt) on every
+    membership test; doing this once per run makes lookups O(1).
+    """
+    return {codelist.slug: frozenset(item.code for item in codelist)
+            for codelist in iatikit.codelists()}
 
 
 def load_current_data_results(org, snapshot_result_path):
+    """Return a DatasetMasks of which activities are current, with a
+    bit per activity (set if it passed the current data test)."""
     test = load_current_data_test()
 
-    current_data_results = {}
-    current_data_filepath = join(snapshot_result_path, org.organisation_code,
-                                 slugify(test.name) + '.csv')
-    with open(current_data_filepath) as handler:
-        data = csv.DictReader(handler)
-        for row in data:
-            idx = int(row['index'])
-            dataset = row['dataset']
-            if dataset not in current_data_results:
-                current_data_results[dataset] = {}
-            current_data_results[dataset][idx] = row['result'] == 'pass'
+    current_data_results = DatasetMasks()
+    reader = results.open_results(
+        join(snapshot_result_path, org.organisation_code))
+    for row in reader.rows(test.name):
+        current_data_results.set(row['dataset'], int(row['index']),
+                                 row['result'] == 'pass')
     return current_data_results
 
 
+def condition_masks_filepath(org, snapshot_result_path):
+    return join(snapshot_result_path, org.organisation_code,
+                'condition_mask.json')
+
+
+def save_condition_masks(org, snapshot_result_path, condition_masks):
+    """Save the organisation condition masks from a test run,
+    next to the test results."""
+    data = {
+        'condition': org.condition,
+        'masks': {level: masks.as_dict()
+                  for level, masks in condition_masks.items()},
+    }
+    with atomic_write(condition_masks_filepath(org, snapshot_result_path)) \
+            as handler:
+        json.dump(data, handler, sort_keys=True)
+
+
+def load_condition_masks(org, snapshot_result_path):
+    """Load the organisation condition masks saved by a test run.
+
+    Returns a dict of item level to DatasetMasks. Levels without
+    a mask (including everything, if the masks are missing or
+    were built from a different condition) are omitted.
+    """
+    filepath = condition_masks_filepath(org, snapshot_result_path)
+    if not exists(filepath):
+        return {}
+    with open(filepath) as handler:
+        data = json.load(handler)
+    if data['condition'] != org.condition:
+        return {}
+    return {level: DatasetMasks.from_dict(masks)
+            for level, masks in data['masks'].items()}
+
+
 def slugify(some_text):
     """Return a slugified version of an input string."""
     def safe_char(char):
@@ -62,95 +113,285 @@ def slugify(some_text):
     return ''.join(safe_char(char) for char in some_text).strip('_')
 
 
-def run_test(test, publisher, output_path, test_condition, **kwargs):
-    """Run test for a given publisher, and output results to a CSV."""
-    result_lookup = {True: 'pass', False: 'fail', None: 'not relevant'}
-    fieldnames = ['dataset', 'identifier', 'index', 'result',
-                  'hierarchy', 'explanation']
+def dataset_items(dataset, filetype, streaming=False):
+    """Return the activities or organisations (according to
+    ``filetype``) in a dataset, optionally streaming them."""
+    if streaming:
+        return iter_dataset(dataset, filetype)
+    if filetype == 'activity':
+        return dataset.activities
+    return dataset.organisations
+
+
+def publisher_items(publisher, filetype, streaming=False):
+    """Return the activities or organisations (according to
+    ``filetype``) for a publisher, optionally streaming them."""
+    if streaming:
+        return iter_publisher(publisher, filetype)
+    if filetype == 'activity':
+        return publisher.activities
+    return publisher.organisations
+
+
+RESULT_LOOKUP = {True: 'pass', False: 'fail', None: 'not relevant'}
+# Recorded instead of a result, for tests not run because the
+# activity isn't current (see ``run_tests``).
+SKIPPED = 'skipped'
+SKIPPED_EXPLANATION = 'Activity is not current'
+RESULT_FIELDNAMES = ['dataset', 'identifier', 'index', 'result',
+                     'hierarchy', 'explanation']
+
+
+def test_level(test):
+    """Return the kind of item a test runs against (either
+    "iati-activity" or "iati-organisation"), or None if it
+    isn't tagged as either."""
     tags = test.tags + test.feature.tags
-    if 'iati-activity' not in tags and 'iati-organisation' not in tags:
-        # Skipping test (it's not tagged as activity or organisation level)
-        return None
-
-    prev_dataset = None
-    with open(output_path, 'w') as handler:
-        writer = csv.DictWriter(handler, fieldnames=fieldnames)
-        writer.writeheader()
-        if 'iati-activity' in tags:
-            items = publisher.activities
-        elif 'iati-organisation' in tags:
-            items = publisher.organisations
-        for item in items:
-            if item.dataset.name != prev_dataset:
-                idx = 0
-            prev_dataset = item.dataset.name
-            if test_condition:
-                activity_condition, org_condition = test_condition.split('|')
-                if 'iati-activity' in tags:
-                    if not item.etree.xpath(activity_condition):
-                        idx += 1
-                        continue
-                if org_condition.strip() and 'iati-organisation' in tags:
-                    if not item.etree.xpath(org_condition):
-                        idx += 1
-                        continue
-            result, explanation = test(item.etree, bdd_verbose=True, **kwargs)
-            hierarchy = item.etree.get('hierarchy')
+    if 'iati-activity' in tags:
+        return 'iati-activity'
+    if 'iati-organisation' in tags:
+        return 'iati-organisation'
+    return None
+
+
+def run_tests(tests, publisher, output_path, test_condition,
+              streaming=False, previous=None, current_data_test=None,
+              datasets=None, collector=None, counter=None,
+              write_results=True, **kwargs):
+    """Run a batch of tests for a given publisher, and save the
+    results to the output directory (see ``results``).
+
+    Each activity (and organisation) is parsed once, and every
+    applicable test is run against it, rather than walking the
+    publisher's data once per test. If ``streaming`` is set, items
+    are parsed from disk one at a time, rather than a whole dataset
+    at once.
+
+    Returns the organisation condition masks, i.e. a dict of
+    item level ("iati-activity" or "iati-organisation") to a
+    DatasetMasks recording whether each item met the condition.
+    Levels without a condition are omitted.
+
+    If ``previous`` (an ``incremental.PreviousResults``) is given,
+    results for datasets that are unchanged since then are copied
+    from the previous results, rather than retested.
+
+    If ``current_data_test`` is given (and is one of ``tests``), it
+    is run first on each activity, and the other activity tests are
+    only run on activities that pass it. For the rest, a "skipped"
+    row is recorded instead.
+
+    If ``datasets`` is given, only those of the publisher's datasets
+    are tested.
+
+    If ``collector`` is given, it is passed each dataset (via
+    ``add_dataset``) and each item (via ``add``) as it's tested, so
+    other things can be gathered without reading the data again (see
+    ``infotest.CountryIndex``).
+
+    If ``counter`` (a ``pipeline.ResultCounter``) is given, every
+    result is passed to it too. In that case, ``write_results`` can be
+    turned off, so results are only counted.
+    """
+    if datasets is None:
+        datasets = publisher.datasets
+    by_level = {'iati-activity': [], 'iati-organisation': []}
+    for test in tests:
+        level = test_level(test)
+        if level is None:
+            # Skipping test (it's not tagged as activity or organisation level)
+            continue
+        tags = test.tags + test.feature.tags
+        by_level[level].append((test, 'iati-organisation' in tags))
+
+    if test_condition:
+        activity_condition, org_condition = test_condition.split('|')
+        if not org_condition.strip():
+            org_condition = None
+    else:
+        activity_condition, org_condition = None, None
+    level_conditions = {
+        'iati-activity': activity_condition,
+        'iati-organisation': org_condition,
+    }
+
+    condition_masks = {}
+    for level, filetype in (('iati-activity', 'activity'),
+                            ('iati-organisation', 'organisation')):
+        level_tests = by_level[level]
+        if not level_tests:
+            continue
+        mask = None
+        if level_conditions[level]:
+            mask = condition_masks[level] = DatasetMasks()
+        # Results only appear once every test at this level is done.
+        with ExitStack() as stack:
+            store = None
+            if write_results:
+                store = stack.enter_context(
+                    results.ResultStoreWriter(output_path))
+            writers = []
+            for test, _ in level_tests:
+                writer = None
+                if store is not None:
+                    writer = store.writer(test.name)
+                if counter is not None:
+                    writer = counter.writer(test.name, writer)
+                writers.append(writer)
+            _run_level(level, level_tests, writers, datasets, filetype,
+                       streaming, activity_condition, org_condition, mask,
+                       previous, current_data_test, collector, **kwargs)
+    return condition_masks
+
+
+def _run_level(level, level_tests, writers, datasets, filetype, streaming,
+               activity_condition, org_condition, mask, previous,
+               current_data_test, collector, **kwargs):
+    check_org = org_condition and any(
+        org_tagged for _, org_tagged in level_tests)
+    all_tests = list(zip(level_tests, writers))
+    if level != 'iati-activity':
+        current_data_test = None
+    # Move the current data test to the front, so it's run first.
+    all_tests.sort(key=lambda x: x[0][0] is not current_data_test)
+    if previous is not None:
+        # Date dependent tests can't be reused, even if the data
+        # hasn't changed.
+        reuse_tests = [(level_test, writer)
+                       for level_test, writer in all_tests
+                       if previous.can_reuse(level_test[0])]
+        rerun_tests = [(level_test, writer)
+                       for level_test, writer in all_tests
+                       if not previous.can_reuse(level_test[0])]
+    for dataset in datasets:
+        tests = all_tests
+        reused = previous is not None and dataset.name in previous.reusable
+        if reused:
+            tests = rerun_tests
+            if not tests:
+                _write_previous(previous, reuse_tests, dataset)
+                if mask is not None and level in previous.condition_masks:
+                    mask.update(previous.condition_masks[level],
+                                dataset.name)
+                continue
+        if collector is not None:
+            collector.add_dataset(filetype, dataset.name)
+        items = dataset_items(dataset, filetype, streaming)
+        for idx, item in enumerate(items):
+            etree = item.etree
+            if collector is not None:
+                collector.add(filetype, dataset.name, idx, item)
+
+            # Evaluate each condition (at most) once per item,
+            # rather than once per test.
+            if activity_condition and level == 'iati-activity':
+                activity_ok = bool(xpath(etree, activity_condition))
+                mask.set(dataset.name, idx, activity_ok)
+                if not activity_ok:
+                    continue
+            org_ok = not check_org or bool(xpath(etree, org_condition))
+            if level == 'iati-organisation' and mask is not None:
+                mask.set(dataset.name, idx, org_ok)
+
+            hierarchy = etree.get('hierarchy')
             if not hierarchy:
                 hierarchy = '1'
-            writer.writerow({
-                'dataset': item.dataset.name,
-                'identifier': item.id,
-                'index': idx,
-                'result': result_lookup.get(result),
-                'hierarchy': hierarchy,
-                'explanation': str(explanation) if not result else '',
-            })
-            idx += 1
+            identifier = item.id
+            is_current = True
+            for (test, org_tagged), writer in tests:
+                if org_tagged and not org_ok:
+                    continue
+                if not is_current:
+                    writer.writerow({
+                        'dataset': dataset.name,
+                        'identifier': identifier,
+                        'index': idx,
+                        'result': SKIPPED,
+                        'hierarchy': hierarchy,
+                        'explanation': SKIPPED_EXPLANATION,
+                    })
+                    continue
+                result, explanation = test(etree, bdd_verbose=True, **kwargs)
+                if test is current_data_test:
+                    is_current = bool(result)
+                writer.writerow({
+                    'dataset': dataset.name,
+                    'identifier': identifier,
+                    'index': idx,
+                    'result': RESULT_LOOKUP.get(result),
+                    'hierarchy': hierarchy,
+                    'explanation': str(explanation) if not result else '',
+                })
+        if reused:
+            # Written after any retested results, so a counter (see
+            # ``pipeline.ResultCounter``) knows which activities are
+            # current by then. Each test's results for a dataset are
+            # either all reused or all retested, so the results are
+            # the same either way.
+            _write_previous(previous, reuse_tests, dataset)
+
+
+def _write_previous(previous, reuse_tests, dataset):
+    for (test, _), writer in reuse_tests:
+        writer.writerows(previous.rows(test, dataset.name))
+
+
+AGGREGATE_RESULT_COLUMNS = ('package_name', 'organisation_id',
+                            'aggregateresulttype_id', 'test_id',
+                            'result_hierarchy', 'results_data',
+                            'results_num')
 
 
 def summarize_results(org, snapshot_result_path, all_tests,
                       current_data_results=None):
+    """Return a list of AggregateResult rows (as dicts) summarizing an
+    organisation's test results. Nothing is written to the database;
+    see ``save_summaries``."""
     aggregateresulttype = 2 if current_data_results else 1
+    reader = results.open_results(
+        join(snapshot_result_path, org.organisation_code))
+    rows = []
     for test in all_tests:
         t = Test.where(description=test.name).first()
         test_id = t.id
-        result_filepath = join(snapshot_result_path, org.organisation_code,
-                               slugify(test.name) + '.csv')
-        if not exists(result_filepath):
+        if test.name not in reader:
             continue
-        with open(result_filepath) as handler:
-            dataset = None
-            for row in csv.DictReader(handler):
-                if dataset is None:
-                    dataset_test_results = {}
-                    dataset = row['dataset']
-                elif dataset != row['dataset']:
-                    save_summary(dataset, dataset_test_results, test_id,
-                                 org, aggregateresulttype)
-                    dataset_test_results = {}
-                    dataset = row['dataset']
-                hierarchy = row['hierarchy']
-                if hierarchy not in dataset_test_results:
-                    dataset_test_results[hierarchy] = {
-                        'pass': 0,
-                        'fail': 0,
-                    }
-                result = row['result']
-                if result == 'not relevant':
-                    continue
+        dataset = None
+        current = None
+        for row in reader.rows(test.name):
+            if dataset != row['dataset']:
+                if dataset is not None:
+                    rows.extend(summary_rows(
+                        dataset, dataset_test_results, test_id,
+                        org, aggregateresulttype))
+                dataset_test_results = {}
+                dataset = row['dataset']
+                if current_data_results:
+                    # Decoded once per dataset, since it's looked
+                    # up for every row
+                    current = current_data_results.decode(dataset)
+            hierarchy = row['hierarchy']
+            if hierarchy not in dataset_test_results:
+                dataset_test_results[hierarchy] = {
+                    'pass': 0,
+                    'fail': 0,
+                }
+            result = row['result']
+            if result in ('not relevant', SKIPPED):
+                continue
+            if current is not None:
                 idx = int(row['index'])
-                if (current_data_results and
-                    current_data_results.get(dataset, {}).get(
-                        idx, 'not relevant') is False):
+                if idx < len(current) and not current[idx]:
                     continue
-                dataset_test_results[hierarchy][result] += 1
-            if dataset is not None:
-                save_summary(dataset, dataset_test_results, test_id,
-                             org, aggregateresulttype)
+            dataset_test_results[hierarchy][result] += 1
+        if dataset is not None:
+            rows.extend(summary_rows(
+                dataset, dataset_test_results, test_id,
+                org, aggregateresulttype))
+    return rows
 
 
-def save_summary(dataset, dataset_test_results, test_id, org,
+def summary_rows(dataset, dataset_test_results, test_id, org,
                  aggregateresulttype):
     for hierarchy, scores in list(dataset_test_results.items()):
         total = sum(scores.values())
@@ -158,14 +399,54 @@ def save_summary(dataset, dataset_test_results, test_id, org,
             continue
         results_data = 100. * scores['pass'] / total
 
-        ar = AggregateResult()
-        ar.package_name = dataset
-        ar.organisation_id = org.id
-        ar.aggregateresulttype_id = aggregateresulttype
-        ar.test_id = test_id
-        ar.result_hierarchy = hierarchy
-        ar.results_data = results_data
-        ar.results_num = total
-
-        with db.session.begin():
-            db.session.add(ar)
+        yield {
+            'package_name': dataset,
+            'organisation_id': org.id,
+            'aggregateresulttype_id': aggregateresulttype,
+            'test_id': test_id,
+            'result_hierarchy': hierarchy,
+            'results_data': results_data,
+            'results_num': total,
+        }
+
+
+def load_test_ids(all_tests):
+    """Return the database ID of each test, keyed on name."""
+    return {test.name: Test.where(description=test.name).first().id
+            for test in all_tests}
+
+
+def delete_summaries(org):
+    """Delete an organisation's AggregateResult rows."""
+    db.session.query(AggregateResult).filter_by(
+        organisation_id=org.id).delete(synchronize_session=False)
+    bump_versions([org.id])
+
+
+def save_summaries(rows):
+    """Bulk insert AggregateResult rows, as returned by
+    ``summarize_results``.
+
+    Uses COPY on PostgreSQL (with psycopg2), and a single executemany
+    otherwise. This should be called inside a transaction, so that
+    either all of the rows are written, or none of them are."""
+    if not rows:
+        return
+    bump_versions(row['organisation_id'] for row in rows)
+    connection = db.session.connection()
+    if connection.dialect.name == 'postgresql' and \
+            connection.dialect.driver == 'psycopg2':
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        for row in rows:
+            writer.writerow([row[column]
+                             for column in AGGREGATE_RESULT_COLUMNS])
+        buf.seek(0)
+        with connection.connection.cursor() as cursor:
+            cursor.copy_expert(
+                'COPY {} ({}) FROM STDIN WITH CSV'.format(
+                    AggregateResult.__tablename__,
+                    ', '.join(AGGREGATE_RESULT_COLUMNS)),
+                buf)
+    else:
+        connection.execute(AggregateResult.__table__.insert(), rows)
@@ -0,0 +1,62 @@
+"""A process-wide cache of compiled XPath expressions.
+
+``element.xpath(expression)`` compiles the expression on every call.
+The test steps evaluate the same handful of expressions against every
+activity in a snapshot, so compile each one once and reuse it.
+"""
+from functools import lru_cache
+
+from lxml import etree
+
+
+CACHE_SIZE = 2048
+
+# Called to compile each expression. (Swapped out when profiling.)
+_factory = etree.XPath
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _compile(expression, namespaces):
+    if namespaces is not None:
+        namespaces = dict(namespaces)
+    return _factory(expression, namespaces=namespaces)
+
+
+def compile_xpath(expression, namespaces=None):
+    """Return a compiled ``etree.XPath`` for an expression and
+    (optional) namespace map."""
+    if namespaces:
+        namespaces = tuple(sorted(namespaces.items()))
+    else:
+        namespaces = None
+    return _compile(expression, namespaces)
+
+
+def xpath(element, expression, namespaces=None):
+    """Evaluate an XPath expression against an element, using
+    the cached compiled expression. Equivalent to
+    ``element.xpath(expression, namespaces=namespaces)``."""
+    return compile_xpath(expression, namespaces)(element)
+
+
+def stats():
+    """Return cache hit and miss counters for this process."""
+    info = _compile.cache_info()
+    return {
+        'hits': info.hits,
+        'misses': info.misses,
+        'size': info.currsize,
+    }
+
+
+def clear():
+    _compile.cache_clear()
+
+
+def set_factory(factory):
+    """Compile expressions with ``factory`` from now on, rather than
+    ``etree.XPath``. Expressions already compiled are discarded."""
+    global _factory
+    if factory is not _factory:
+        _factory = factory
+        clear()
@@ -1,17 +1,22 @@
 from os.path import exists, join, isdir
 from os import listdir, makedirs, unlink
 import shutil
+from time import perf_counter
 
 import click
 import iatikit
 import csv
 
 from . import app, db
-from iatidq import dqimporttests, dqindicators, dqorganisations, dqusers
+from iatidq import dqimporttests, dqindicators, dqorganisations, dqusers, \
+    summary_cache
 from iatidq import setup as dqsetup
 from iatidq.models import Organisation, Test, OrganisationCondition
 from iatidq.sample_work import sample_work, db as sample_work_db
-from beta import utils, infotest
+from beta import benchmarks, checkpoint, distributed, pipeline, profiling, \
+    results, utils, runner, xpath_cache
+from beta.incremental import load_aggregated, previous_snapshot, \
+    results_hash, save_aggregated, tests_fingerprint
 
 
 @app.cli.command()
@@ -96,7 +101,8 @@ def import_users(filename):
 def setup_sampling(date, filename, org_ids, test_ids):
     iati_result_path = app.config.get('IATI_RESULT_PATH')
     try:
-        snapshot_dates = listdir(join(iati_result_path))
+        snapshot_dates = [x for x in listdir(join(iati_result_path))
+                          if isdir(join(iati_result_path, x))]
         if date == 'latest':
             snapshot_date = max(snapshot_dates)
         else:
@@ -185,17 +191,10 @@ def import_data():
                                  organisation.registry_slug))
 
 
-@app.cli.command()
-@click.option('--date', default='latest',
-              help='Date of the data to test, in YYYY-MM-DD. ' +
-                   'Defaults to most recent.')
-@click.option('--refresh/--no-refresh', default=True,
-              help='Refresh schema and codelists.')
-def test_data(date, refresh):
-    """Test a set of imported IATI data."""
-
+def get_data_snapshot_date(date):
+    """Return the date of the IATI data snapshot to test (or abort
+    if there isn't one)."""
     iati_data_path = app.config.get('IATI_DATA_PATH')
-    iati_result_path = app.config.get('IATI_RESULT_PATH')
     try:
         snapshot_dates = listdir(join(iati_data_path))
         if date == 'latest':
@@ -214,6 +213,46 @@ def test_data(date, refresh):
         click.echo('Perhaps you need to download some, using:', err=True)
         click.echo('\n    $ flask download_data\n', err=True)
         raise click.Abort()
+    return snapshot_date
+
+
+@app.cli.command()
+@click.option('--date', default='latest',
+              help='Date of the data to test, in YYYY-MM-DD. ' +
+                   'Defaults to most recent.')
+@click.option('--refresh/--no-refresh', default=True,
+              help='Refresh schema and codelists.')
+@click.option('--workers', default=1, type=click.IntRange(min=1),
+              help='Number of organisations to test in parallel. ' +
+                   'Defaults to 1.')
+@click.option('--streaming', is_flag=True,
+              help='Parse activities one at a time, rather than ' +
+                   'whole files. Uses less memory on large files.')
+@click.option('--incremental/--no-incremental', default=True,
+              help='Reuse results from the previous snapshot for ' +
+                   'datasets that haven\'t changed.')
+@click.option('--resume', is_flag=True,
+              help='Continue an interrupted run, skipping tests ' +
+                   'already completed.')
+@click.option('--current-only', is_flag=True,
+              help='Only run activity tests on current activities. ' +
+                   'Results for other activities are recorded as ' +
+                   'skipped, so "All data" isn\'t aggregated.')
+@click.option('--profile', is_flag=True,
+              help='Time each test step and XPath expression. ' +
+                   'Written to profile.json and profile.txt, per ' +
+                   'organisation and for the whole run.')
+@click.option('--profile-sort', default='total',
+              type=click.Choice(profiling.SORT_KEYS),
+              help='Column to sort the profile tables by. ' +
+                   'Defaults to total.')
+def test_data(date, refresh, workers, streaming, incremental, resume,
+              current_only, profile, profile_sort):
+    """Test a set of imported IATI data."""
+
+    iati_data_path = app.config.get('IATI_DATA_PATH')
+    iati_result_path = app.config.get('IATI_RESULT_PATH')
+    snapshot_date = get_data_snapshot_date(date)
 
     snapshot_xml_path = join(iati_data_path, snapshot_date)
     root_output_path = join(iati_result_path, snapshot_date)
@@ -221,7 +260,9 @@ def test_data(date, refresh):
     click.echo('Testing: {}'.format(snapshot_xml_path))
     click.echo('Output path: {}'.format(root_output_path))
 
-    if exists(root_output_path):
+    if resume:
+        click.echo('Resuming any previous run ...')
+    elif exists(root_output_path):
         click.secho('Warning: Output path exists.', fg='red')
         click.confirm('Overwrite and continue?', abort=True)
         shutil.rmtree(root_output_path)
@@ -229,62 +270,194 @@ def test_data(date, refresh):
     if refresh:
         click.echo('Downloading latest schemas and codelists ...')
         iatikit.download.standard()
-    codelists = iatikit.codelists()
-
-    click.echo('Loading tests ...')
-    all_tests = utils.load_tests()
-    all_tests.append(utils.load_current_data_test())
 
     click.echo('Testing IATI data snapshot ' +
                '({}) ...'.format(snapshot_date))
     publishers = iatikit.data(path=snapshot_xml_path).publishers
     name_to_publisher = dict((publisher.name, publisher) for publisher in publishers)
 
-    for org in db.session.query(Organisation).all():
+    orgs = [runner.org_unit(org)
+            for org in db.session.query(Organisation).all()
+            if org.registry_slug and org.registry_slug in name_to_publisher]
+
+    click.echo('Loading codelists ...')
+    codelists = utils.load_codelists()
+
+    fingerprint = tests_fingerprint(codelists, current_only)
+    previous_result_path = None
+    if incremental:
+        previous_result_path = previous_snapshot(iati_result_path,
+                                                 snapshot_date)
+        if previous_result_path:
+            click.echo('Previous results: {}'.format(previous_result_path))
+    dataset_stats = {'reused': 0, 'retested': 0}
+
+    if workers > 1:
+        # Don't share database connections with the worker processes.
+        db.engine.dispose()
+        click.echo('Testing {} organisations with {} workers ...'.format(
+            len(orgs), workers))
+        failed = []
+        cache_stats = {'hits': 0, 'misses': 0}
+        results = runner.run_organisations_parallel(
+            app, orgs, snapshot_xml_path, root_output_path,
+            snapshot_date, codelists, workers, streaming=streaming,
+            fingerprint=fingerprint,
+            previous_result_path=previous_result_path, resume=resume,
+            current_only=current_only, profile=profile)
+        for done, (org, error, org_stats) in enumerate(results, start=1):
+            click.echo('[{done}/{total}] {name} ({slug})'.format(
+                done=done, total=len(orgs),
+                name=org.organisation_name, slug=org.registry_slug))
+            if error:
+                failed.append(org)
+                click.secho(error, fg='red', err=True)
+            for k in cache_stats:
+                cache_stats[k] += org_stats[k]
+            for k in dataset_stats:
+                dataset_stats[k] += org_stats[k]
+        echo_dataset_stats(dataset_stats)
+        echo_xpath_cache_stats(cache_stats)
+        if profile:
+            save_run_profile(orgs, root_output_path, profile_sort)
+        if failed:
+            raise click.ClickException(
+                'Testing failed for {} organisation(s): {}'.format(
+                    len(failed),
+                    ', '.join(org.registry_slug for org in failed)))
+        return
 
-        if not org.registry_slug:
-            continue
-        if org.registry_slug not in name_to_publisher:
-            continue
+    click.echo('Loading tests ...')
+    all_tests = runner.load_all_tests()
+
+    for org in orgs:
         click.echo('\nTesting organisation: {name} ({slug}) ...'.format(
             name=org.organisation_name, slug=org.registry_slug
         ))
-        output_path = join(root_output_path, org.organisation_code)
-        makedirs(output_path)
-        for test in all_tests:
-            output_filepath = join(output_path,
-                                   utils.slugify(test.name) + '.csv')
-            click.echo(test)
-            utils.run_test(test, name_to_publisher[org.registry_slug], output_filepath,
-                           org.condition, codelists=codelists,
-                           today=snapshot_date)
-
-        current_data_results = utils.load_current_data_results(
-            org, root_output_path)
-
-        # run country strategy / MoU test
-        test_name = 'Strategy (country/sector) or Memorandum of Understanding'
-        click.echo(test_name)
-        infotest.country_strategy_or_mou(
-            org, snapshot_date, test_name, current_data_results)
-
-        # run disaggregated budget test
-        test_name = 'Disaggregated budget'
-        click.echo(test_name)
-        infotest.disaggregated_budget(
-            org, snapshot_date, test_name, current_data_results, org.condition)
+        org_stats = runner.run_organisation(
+            org, name_to_publisher[org.registry_slug], all_tests,
+            root_output_path, snapshot_date, codelists, echo=click.echo,
+            streaming=streaming, fingerprint=fingerprint,
+            previous_result_path=previous_result_path, resume=resume,
+            current_only=current_only, profile=profile)
+        for k in dataset_stats:
+            dataset_stats[k] += org_stats[k]
+    echo_dataset_stats(dataset_stats)
+    echo_xpath_cache_stats(xpath_cache.stats())
+    if profile:
+        save_run_profile(orgs, root_output_path, profile_sort)
+
+
+def echo_dataset_stats(dataset_stats):
+    click.echo('\nDatasets: {retested} retested, {reused} reused'.format(
+        **dataset_stats))
+
+
+def echo_xpath_cache_stats(cache_stats):
+    click.echo('\nXPath cache: {hits} hits, {misses} misses'.format(
+        **cache_stats))
+
+
+def save_run_profile(orgs, root_output_path, sort):
+    """Combine the per-organisation profiles into one for the whole
+    run, and show the slowest entries."""
+    profile = profiling.merge_files([
+        join(root_output_path, org.organisation_code,
+             profiling.PROFILE_FILENAME + '.json')
+        for org in orgs])
+    output_path = join(root_output_path, profiling.PROFILE_FILENAME)
+    profiling.save(profile, output_path, sort=sort)
+    click.echo('\nProfile ({}.txt):\n'.format(output_path))
+    click.echo(profile.format_table(sort=sort, limit=10))
 
 
 @app.cli.command()
 @click.option('--date', default='latest',
-              help='Date of the data to summarize, in YYYY-MM-DD. ' +
+              help='Date of the data to test, in YYYY-MM-DD. ' +
                    'Defaults to most recent.')
-def aggregate_results(date):
-    """Summarize results of IATI data tests."""
+@click.option('--current-only', is_flag=True,
+              help='Only run activity tests on current activities ' +
+                   '(so "All data" isn\'t aggregated).')
+def test_dispatch(date, current_only):
+    """Queue a set of imported IATI data for testing by test_worker."""
 
+    iati_data_path = app.config.get('IATI_DATA_PATH')
+    iati_result_path = app.config.get('IATI_RESULT_PATH')
+    snapshot_date = get_data_snapshot_date(date)
+
+    snapshot_xml_path = join(iati_data_path, snapshot_date)
+    root_output_path = join(iati_result_path, snapshot_date)
+
+    click.echo('Queueing: {}'.format(snapshot_xml_path))
+    click.echo('Output path: {}'.format(root_output_path))
+
+    if exists(root_output_path):
+        click.secho('Warning: Output path exists.', fg='red')
+        click.confirm('Overwrite and continue?', abort=True)
+        shutil.rmtree(root_output_path)
+
+    publishers = iatikit.data(path=snapshot_xml_path).publishers
+    name_to_publisher = dict((publisher.name, publisher) for publisher in publishers)
+
+    orgs = [runner.org_unit(org)
+            for org in db.session.query(Organisation).all()
+            if org.registry_slug and org.registry_slug in name_to_publisher]
+
+    fingerprint = tests_fingerprint(utils.load_codelists(), current_only)
+    with distributed.broker_connection() as connection:
+        total = distributed.dispatch(
+            connection, orgs, name_to_publisher, root_output_path,
+            snapshot_date, fingerprint, current_only=current_only)
+    click.echo('Queued {} datasets from {} organisations.'.format(
+        total, len(orgs)))
+
+
+@app.cli.command()
+@click.option('--streaming', is_flag=True,
+              help='Parse activities one at a time, rather than ' +
+                   'whole files. Uses less memory on large files.')
+@click.option('--burst', is_flag=True,
+              help='Exit once the queue is empty, rather than ' +
+                   'waiting for more work.')
+@click.option('--max-attempts', default=distributed.MAX_ATTEMPTS,
+              show_default=True,
+              help='How many times to try a dataset before giving up.')
+def test_worker(streaming, burst, max_attempts):
+    """Test IATI data queued by test_dispatch."""
+
+    click.echo('Loading codelists ...')
+    codelists = utils.load_codelists()
+    click.echo('Loading tests ...')
+    all_tests = runner.load_all_tests()
+
+    # Don't hold a database connection while waiting for work.
+    db.engine.dispose()
+
+    with distributed.broker_connection() as connection:
+        worker = distributed.Worker(connection, all_tests, codelists,
+                                    streaming=streaming, echo=click.echo,
+                                    max_attempts=max_attempts)
+        click.echo('Waiting for work ...')
+        processed, failed = worker.run(burst=burst)
+    click.echo('Processed {} datasets.'.format(processed))
+    if failed:
+        for organisation_code, dataset in worker.failures:
+            click.secho('Failed: {} ({})'.format(
+                organisation_code, dataset or 'no datasets'),
+                fg='red', err=True)
+        raise click.ClickException(
+            ('Testing failed for {} dataset(s). Their publishers\' ' +
+             'results won\'t be merged; run test_dispatch again to ' +
+             'retest them.').format(failed))
+
+
+def get_result_snapshot_date(date):
+    """Return the date of the IATI results snapshot to use (or abort
+    if there isn't one)."""
     iati_result_path = app.config.get('IATI_RESULT_PATH')
     try:
-        result_dates = listdir(join(iati_result_path))
+        result_dates = [x for x in listdir(join(iati_result_path))
+                        if isdir(join(iati_result_path, x))]
         if date == 'latest':
             result_date = max(result_dates)
         else:
@@ -302,25 +475,65 @@ def aggregate_results(date):
         click.echo('\n    $ flask test_data ' +
                    '--date {}\n'.format(date), err=True)
         raise click.Abort()
+    return result_date
+
+
+@app.cli.command()
+@click.option('--date', default='latest',
+              help='Date of the data to summarize, in YYYY-MM-DD. ' +
+                   'Defaults to most recent.')
+@click.option('--only', 'only', metavar='ORG_CODE', multiple=True,
+              help='Only summarize this organisation. Can be given ' +
+                   'more than once.')
+@click.option('--force', is_flag=True,
+              help='Summarize organisations even if their results ' +
+                   'haven\'t changed since they were last summarized.')
+def aggregate_results(date, only, force):
+    """Summarize results of IATI data tests."""
+
+    iati_result_path = app.config.get('IATI_RESULT_PATH')
+    result_date = get_result_snapshot_date(date)
+
+    snapshot_result_path = join(iati_result_path, result_date)
+    publishers = sorted(x for x in listdir(snapshot_result_path)
+                        if isdir(join(snapshot_result_path, x)))
+    if only:
+        missing = [x for x in only if x not in publishers]
+        if missing:
+            click.secho('Error: No results found for ' +
+                        '{}.'.format(', '.join(missing)),
+                        fg='red', err=True)
+            raise click.Abort()
+        publishers = [x for x in publishers if x in only]
 
     click.secho('\nWarning! This is a destructive operation!', fg='red')
-    click.echo('\nAny existing aggregate data will be deleted ' +
-               'from the database.')
+    click.echo('\nExisting aggregate data for each publisher will be ' +
+               'replaced in the database.')
     click.echo('(If you still have the raw results, you can regenerate ' +
                'old aggregate data by specifying a date.)')
     click.confirm('\nAre you really really sure?', abort=True)
-    with db.session.begin():
-        db.session.execute('''truncate aggregateresult''')
 
     click.echo('Loading tests ...')
     all_tests = utils.load_tests()
-
-    snapshot_result_path = join(iati_result_path, result_date)
+    test_ids = utils.load_test_ids(all_tests)
+
+    aggregated = load_aggregated(iati_result_path)
+    if not only:
+        # Publishers with no results in this snapshot
+        stale = Organisation.query.filter(
+            Organisation.organisation_code.notin_(publishers)).all()
+        with db.session.begin():
+            for org in stale:
+                utils.delete_summaries(org)
+        for org in stale:
+            aggregated.pop(org.organisation_code, None)
+        save_aggregated(iati_result_path, aggregated)
 
     click.echo('Summarizing results from IATI data snapshot ' +
                '({}) ...'.format(result_date))
-    publishers = [x for x in listdir(snapshot_result_path)
-                  if isdir(join(snapshot_result_path, x))]
+    total_rows = 0
+    total_time = 0.
+    unchanged = 0
     with click.progressbar(publishers) as publishers:
         for organisation_code in publishers:
             org = Organisation.where(
@@ -332,13 +545,277 @@ def aggregate_results(date):
                             'may be out of sync.',
                             fg='red', err=True)
                 raise click.Abort()
-            utils.summarize_results(org, snapshot_result_path, all_tests)
+            if not checkpoint.organisation_is_complete(
+                    join(snapshot_result_path, organisation_code)):
+                failed = distributed.failed_units(snapshot_result_path, org)
+                if failed:
+                    click.secho('\nWarning: Skipping publisher '
+                                '"{}", '.format(organisation_code) +
+                                'since testing failed for: ' +
+                                ', '.join(str(dataset) for dataset
+                                          in failed.values()) +
+                                '. The errors are in the "failed" files ' +
+                                'of its shards directory.',
+                                fg='red', err=True)
+                    continue
+                click.secho('\nWarning: Skipping publisher '
+                            '"{}", '.format(organisation_code) +
+                            'since testing didn\'t finish. You can ' +
+                            'finish it using: flask test_data --resume',
+                            fg='red', err=True)
+                continue
+            org_hash = results_hash(
+                org, snapshot_result_path, test_ids)
+            if not force and \
+                    aggregated.get(organisation_code) == org_hash:
+                unchanged += 1
+                continue
+            if checkpoint.is_current_only(
+                    join(snapshot_result_path, organisation_code)):
+                # Everything but current activities was skipped, so
+                # "All data" would only cover current activities.
+                click.secho('\nWarning: Only summarizing current data for '
+                            'publisher "{}", '.format(organisation_code) +
+                            'since it was tested with --current-only. ' +
+                            'To summarize all data, test it again ' +
+                            'without --current-only.',
+                            fg='red', err=True)
+                rows = []
+            else:
+                rows = utils.summarize_results(
+                    org, snapshot_result_path, all_tests)
 
             current_data_results = utils.load_current_data_results(
                 org, snapshot_result_path)
-            utils.summarize_results(
+            rows += utils.summarize_results(
                 org, snapshot_result_path, all_tests, current_data_results)
 
+            # Replace the publisher's results in one transaction, so a
+            # failure doesn't leave it half-written
+            started = perf_counter()
+            with db.session.begin():
+                utils.delete_summaries(org)
+                utils.save_summaries(rows)
+            total_rows += len(rows)
+            total_time += perf_counter() - started
+
+            aggregated[organisation_code] = org_hash
+            save_aggregated(iati_result_path, aggregated)
+
+    click.echo('Saved {} aggregate results ({:.0f} rows/s).'.format(
+        total_rows, total_rows / total_time if total_time else 0))
+    if unchanged:
+        click.echo('Skipped {} publishers whose results '.format(unchanged) +
+                   'haven\'t changed (use --force to summarize them).')
+
+
+@app.cli.command()
+@click.option('--date', default='latest',
+              help='Date of the results to export, in YYYY-MM-DD. ' +
+                   'Defaults to most recent.')
+@click.option('--only', 'only', metavar='ORG_CODE', multiple=True,
+              help='Only export this organisation. Can be given ' +
+                   'more than once.')
+@click.option('--output-path', type=click.Path(file_okay=False),
+              help='Directory to export to. Defaults to the ' +
+                   'results directory.')
+def export_results(date, only, output_path):
+    """Export test results as one CSV per test and organisation."""
+
+    iati_result_path = app.config.get('IATI_RESULT_PATH')
+    result_date = get_result_snapshot_date(date)
+    snapshot_result_path = join(iati_result_path, result_date)
+    if output_path is None:
+        output_path = snapshot_result_path
+
+    publishers = sorted(x for x in listdir(snapshot_result_path)
+                        if isdir(join(snapshot_result_path, x)))
+    if only:
+        publishers = [x for x in publishers if x in only]
+    for organisation_code in publishers:
+        reader = results.open_results(
+            join(snapshot_result_path, organisation_code))
+        if not isinstance(reader, results.ResultStore):
+            # Already CSVs
+            continue
+        click.echo('Exporting {} ...'.format(organisation_code))
+        org_output_path = join(output_path, organisation_code)
+        makedirs(org_output_path, exist_ok=True)
+        for test_name in reader:
+            results.export_csv(
+                reader, test_name,
+                join(org_output_path, utils.slugify(test_name) + '.csv'))
+
+
+@app.cli.command()
+@click.option('--date', default='latest',
+              help='Date of the results to use, in YYYY-MM-DD. ' +
+                   'Defaults to most recent.')
+@click.option('--org', 'organisation_code', metavar='ORG_CODE',
+              help='Organisation whose results to use. Defaults to ' +
+                   'the one with the most results.')
+@click.option('--repeat', default=5, show_default=True,
+              help='Number of times to time each benchmark.')
+@click.option('--packages', default=200, show_default=True,
+              help='Number of packages in the synthetic data used to ' +
+                   'benchmark aggregation.')
+@click.option('--hierarchies', default=10, show_default=True,
+              help='Number of hierarchies in the synthetic data used to ' +
+                   'benchmark publisher summaries.')
+@click.option('--tests', default=400, show_default=True,
+              help='Number of tests in the synthetic data used to ' +
+                   'benchmark publisher summaries.')
+def benchmark(date, organisation_code, repeat, packages, hierarchies, tests):
+    """Compare the memory and lookup time of the structures used to
+    summarize results."""
+
+    iati_result_path = app.config.get('IATI_RESULT_PATH')
+    result_date = get_result_snapshot_date(date)
+    snapshot_result_path = join(iati_result_path, result_date)
+    if organisation_code is None:
+        organisation_code = benchmarks.largest_organisation(
+            snapshot_result_path)
+    org = Organisation.where(organisation_code=organisation_code).first()
+    if not org:
+        click.secho('Error: Publisher "{}" '.format(organisation_code) +
+                    'not found in database.', fg='red', err=True)
+        raise click.Abort()
+
+    click.echo('Benchmarking results for {} ({}) ...'.format(
+        organisation_code, result_date))
+    click.echo('\nCurrent data lookups')
+    reader = results.open_results(
+        join(snapshot_result_path, organisation_code))
+    if utils.load_current_data_test().name in reader:
+        click.echo(benchmarks.format_table(benchmarks.current_data_lookups(
+            org, snapshot_result_path, repeat)))
+    else:
+        click.echo('No current data results saved; skipping.')
+
+    click.echo('\nAggregation ({} synthetic packages)'.format(packages))
+    click.echo(benchmarks.format_aggregation_table(benchmarks.aggregation(
+        packages, repeat)))
+
+    click.echo('\nPublisher summary ({} synthetic hierarchies, {} tests)'.format(
+        hierarchies, tests))
+    click.echo(benchmarks.format_summary_table(benchmarks.publisher_summary(
+        hierarchies, tests, repeat)))
+
+
+@app.cli.command()
+@click.option('--date', default='latest',
+              help='Date of the data to test, in YYYY-MM-DD. ' +
+                   'Defaults to most recent.')
+@click.option('--refresh/--no-refresh', default=True,
+              help='Refresh schema and codelists.')
+@click.option('--streaming', is_flag=True,
+              help='Parse activities one at a time, rather than ' +
+                   'whole files. Uses less memory on large files.')
+@click.option('--incremental/--no-incremental', default=True,
+              help='Reuse results from the previous snapshot for ' +
+                   'datasets that haven\'t changed.')
+@click.option('--current-only', is_flag=True,
+              help='Only run activity tests on current activities ' +
+                   '(so "All data" isn\'t aggregated).')
+@click.option('--write-results', is_flag=True,
+              help='Also save the full results, as ' +
+                   'test_data does (e.g. for sampling).')
+def run_pipeline(date, refresh, streaming, incremental, current_only,
+                 write_results):
+    """Test a set of imported IATI data, and summarize the results
+    as each organisation is tested."""
+
+    iati_data_path = app.config.get('IATI_DATA_PATH')
+    iati_result_path = app.config.get('IATI_RESULT_PATH')
+    snapshot_date = get_data_snapshot_date(date)
+
+    snapshot_xml_path = join(iati_data_path, snapshot_date)
+    root_output_path = join(iati_result_path, snapshot_date)
+
+    click.echo('Testing: {}'.format(snapshot_xml_path))
+    click.echo('Output path: {}'.format(root_output_path))
+
+    click.secho('\nWarning! This is a destructive operation!', fg='red')
+    click.echo('\nExisting aggregate data for each publisher will be ' +
+               'replaced in the database.')
+    if exists(root_output_path):
+        click.echo('The output path exists, and will be overwritten.')
+    if current_only:
+        click.echo('With --current-only, "All data" is not aggregated.')
+    click.confirm('\nAre you really really sure?', abort=True)
+    if exists(root_output_path):
+        shutil.rmtree(root_output_path)
+
+    if refresh:
+        click.echo('Downloading latest schemas and codelists ...')
+        iatikit.download.standard()
+
+    click.echo('Testing IATI data snapshot ' +
+               '({}) ...'.format(snapshot_date))
+    publishers = iatikit.data(path=snapshot_xml_path).publishers
+    name_to_publisher = dict((publisher.name, publisher) for publisher in publishers)
+
+    orgs = [org for org in db.session.query(Organisation).all()
+            if org.registry_slug and org.registry_slug in name_to_publisher]
+
+    click.echo('Loading codelists ...')
+    codelists = utils.load_codelists()
+
+    fingerprint = tests_fingerprint(codelists, current_only)
+    previous_result_path = None
+    if incremental:
+        previous_result_path = previous_snapshot(iati_result_path,
+                                                 snapshot_date)
+        if previous_result_path:
+            click.echo('Previous results: {}'.format(previous_result_path))
+    dataset_stats = {'reused': 0, 'retested': 0}
+
+    click.echo('Loading tests ...')
+    all_tests = runner.load_all_tests()
+    summary_tests = utils.load_tests()
+    test_ids = utils.load_test_ids(summary_tests)
+
+    aggregated = load_aggregated(iati_result_path)
+    total_rows = 0
+    total_time = 0.
+    for org in orgs:
+        click.echo('\nTesting organisation: {name} ({slug}) ...'.format(
+            name=org.organisation_name, slug=org.registry_slug
+        ))
+        counter = pipeline.ResultCounter(runner.CURRENT_DATA_TEST)
+        org_stats = runner.run_organisation(
+            runner.org_unit(org), name_to_publisher[org.registry_slug],
+            all_tests, root_output_path, snapshot_date, codelists,
+            echo=click.echo, streaming=streaming, fingerprint=fingerprint,
+            previous_result_path=previous_result_path,
+            current_only=current_only, counter=counter,
+            write_results=write_results)
+        for k in dataset_stats:
+            dataset_stats[k] += org_stats[k]
+
+        rows = pipeline.summarize_organisation(
+            org, counter, root_output_path, summary_tests, test_ids,
+            saved_test_names=runner.INFOTESTS, all_data=not current_only)
+        started = perf_counter()
+        with db.session.begin():
+            utils.delete_summaries(org)
+            utils.save_summaries(rows)
+        total_rows += len(rows)
+        total_time += perf_counter() - started
+
+        if write_results:
+            aggregated[org.organisation_code] = results_hash(
+                org, root_output_path, test_ids)
+        else:
+            # These aggregate results can't be reproduced from the
+            # saved results.
+            aggregated.pop(org.organisation_code, None)
+        save_aggregated(iati_result_path, aggregated)
+    echo_dataset_stats(dataset_stats)
+    echo_xpath_cache_stats(xpath_cache.stats())
+    click.echo('\nSaved {} aggregate results ({:.0f} rows/s).'.format(
+        total_rows, total_rows / total_time if total_time else 0))
+
 
 @app.cli.command()
 @click.option('--filepath', '-f', help='path to the CSV file with the list of organisation exclusions.')
@@ -407,6 +884,7 @@ def excluded_conditions(filepath):
                     pc.line = str(0)
                     pc.active = True
                     db.session.add(pc)
+                    summary_cache.bump_versions([organisation_id])
 
     with open(filepath) as fh:
         try:
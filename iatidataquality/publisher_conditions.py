@@ -13,7 +13,7 @@ from flask import render_template, flash, request, redirect, url_for, send_file
 from flask_login import current_user
 
 from . import db, usermanagement
-from iatidq import dqimportpublisherconditions, dqpublishercondition
+from iatidq import dqimportpublisherconditions, dqpublishercondition, summary_cache
 from iatidq.models import Organisation, OrganisationCondition, Test
 
 
@@ -176,6 +176,7 @@ def import_pc_row(row):
         pc.condition_value = condition_value
         pc.description = pc_form_value('description')
         db.session.add(pc)
+        summary_cache.bump_versions([int(organisation_id)])
 
 
 def ipc_step3():
@@ -13,7 +13,8 @@ from flask_login import current_user
 from . import app, api, aggregationtypes, indicators, \
               organisations_feedback, organisations, \
               packages, publisher_conditions, registry, \
-              sampling, surveys, tests, usermanagement, users
+              sampling, summarycache, surveys, tests, usermanagement, \
+              users
 
 
 @app.route("/")
@@ -71,6 +72,12 @@ def aggregationtypes_edit(aggregationtype_id=None):
     return aggregationtypes.aggregationtypes_edit(aggregationtype_id)
 
 
+@app.route("/summary_cache/", methods=['POST', 'GET'])
+@usermanagement.perms_required()
+def summary_cache_stats():
+    return summarycache.summary_cache_stats()
+
+
 @app.route("/api/")
 def api_index():
     return api.api_index()
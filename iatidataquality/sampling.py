@@ -11,7 +11,7 @@ from flask import jsonify, render_template, flash, redirect, request, url_for
 from flask_login import current_user
 
 from . import app, db, usermanagement
-from iatidq import dqorganisations, dqtests, dqindicators, dqcodelists, models
+from iatidq import dqorganisations, dqtests, dqindicators, dqcodelists, models, summary_cache
 from iatidq.sample_work import sample_work, test_mapping
 from iatidq.sample_work import db as sample_db
 
@@ -343,6 +343,7 @@ def change_status(organisation_id, test_id, status):
         if existing:
             with db.session.begin():
                 db.session.delete(existing)
+                summary_cache.bump_versions([organisation_id])
             flash('Marked as passing', 'success')
     elif status == 'fail':
         existing = models.SamplingFailure.where(
@@ -354,5 +355,6 @@ def change_status(organisation_id, test_id, status):
             )
             with db.session.begin():
                 db.session.add(failure)
+                summary_cache.bump_versions([organisation_id])
             flash('Marked as failing', 'success')
     return redirect(url_for('sampling_summary'))
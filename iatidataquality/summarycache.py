@@ -0,0 +1,29 @@
+#  IATI Data Quality, tools for Data QA on IATI-formatted  publications
+#  by Mark Brough, Martin Keegan, Ben Webb and Jennifer Smith
+#
+#  Copyright (C) 2013  Publish What You Fund
+#
+#  This programme is free software; you may redistribute and/or modify
+#  it under the terms of the GNU Affero General Public License v3.0
+
+from flask import render_template, flash, redirect, request, url_for
+from flask_login import current_user
+
+from . import db, usermanagement
+from iatidq import summary_cache
+
+
+def summary_cache_stats():
+    if request.method == 'POST':
+        # Bumping the generation stops the other web workers using
+        # their cached summaries, too.
+        with db.session.begin():
+            summary_cache.bump_generation()
+        summary_cache.get_cache().clear()
+        flash('Cleared the publisher summary cache', 'success')
+        return redirect(url_for('summary_cache_stats'))
+
+    return render_template("summary_cache.html",
+                           stats=summary_cache.get_cache().stats(),
+                           admin=usermanagement.check_perms('admin'),
+                           loggedinuser=current_user)
@@ -7,7 +7,10 @@
 #  This programme is free software; you may redistribute and/or modify
 #  it under the terms of the GNU Affero General Public License v3.0
 
-import itertools
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 RESULT_FAILURE = 0
@@ -20,61 +23,148 @@ FIELD_RESULT = 3
 FIELD_PACKAGE = 4
 FIELD_ORGANISATION = 5
 
-def prepend(prefix, tup):
-    return tuple([prefix] + list(tup))
+# Inputs with at least this many rows are grouped using numpy, if
+# it's installed
+NUMPY_THRESHOLD = 100000
 
-def _aggregate_percentages(data, dims):
-    """
-    'dims' contains a list of tuples of field names and the lambdas
-    used for extracting those fields from 'data'. These fields are
-    treated as dimensions in an n-dimensional hypercube
-
-    We generate list of the unique values in each considered dimension
 
-    We project the hypercube onto the selected dimensions by calculating
-    the cartesian product of these unique values, then mapping the
-    calc_percentage function across it
-    """
+def _percentage(dim_names, key, fail, success):
+    if 0 == fail + success:
+        return None
+    percentage = float(success) / (fail + success) * 100.0
 
-    def setmap(lam):
-        return set(map(lam, data))
+    data = {
+        "percentage_passed": percentage,
+        "total_results": fail+success,
+        }
+    for i, dim in enumerate(dim_names):
+        data[dim] = key[i]
+    return data
 
-    def generate_dimension(dimension_name):
-        return setmap(dims_dict[dimension_name])
-
-    def lookups(x):
-        return tuple([ dims_dict[i](x) for i in dim_names ])
+def _group(data, dims):
+    """
+    Group 'data' on the dimensions in 'dims', returning a dict of the
+    dimension values to a [fail, success] list of counts. Only
+    combinations present in the data are included.
 
-    dims_dict = dict(dims)
+    Each row is expected to be the count for one status of one
+    combination (i.e. already grouped, as by the database); if there's
+    more than one, the last is used.
+    """
+    lookups = [lam for _, lam in dims]
+    groups = {}
+    for x in data:
+        status = x[FIELD_STATUS]
+        if status != RESULT_FAILURE and status != RESULT_SUCCESS:
+            continue
+        key = tuple([lam(x) for lam in lookups])
+        counts = groups.get(key)
+        if counts is None:
+            counts = groups[key] = [0, 0]
+        counts[status] = x[FIELD_RESULT]
+    return groups
+
+def _sparse_percentages(data, dims):
     dim_names = [ i[0] for i in dims ]
-    dimension_lists = list(map(generate_dimension, dim_names))
-    breakdown = lambda x: (
-        prepend(x[FIELD_STATUS], lookups(x)),
-        x[FIELD_RESULT]
-        )
-
-    d = dict(list(map(breakdown, data)))
-
-    def calc_percentages(dimensions):
-        fail    = d.get(prepend(RESULT_FAILURE, dimensions), 0)
-        success = d.get(prepend(RESULT_SUCCESS, dimensions), 0)
-
-        if 0 == fail + success:
-            return None
-        percentage = float(success) / (fail + success) * 100.0
+    out = [_percentage(dim_names, key, fail, success)
+           for key, (fail, success) in _group(data, dims).items()]
+    return [i for i in out if i is not None]
 
-        data = {
-            "percentage_passed": percentage,
-            "total_results": fail+success,
+def _numpy_codes(values):
+    """
+    Number each distinct value, returning an array of the numbers and
+    a list of the values. Integers are numbered by numpy; anything
+    else (e.g. None) by a dict.
+    """
+    array = numpy.array(values)
+    if array.dtype.kind in 'iu':
+        unique, codes = numpy.unique(array, return_inverse=True)
+        return codes.ravel(), unique.tolist()
+    numbers = {}
+    codes = numpy.fromiter(
+        (numbers.setdefault(value, len(numbers)) for value in values),
+        dtype=numpy.int64, count=len(values))
+    return codes, list(numbers)
+
+def _numpy_percentages(data, dims):
+    """
+    As _sparse_percentages, but grouping using numpy. Each dimension's
+    values are numbered, and the numbers combined into a single
+    integer key per row.
+    """
+    dim_names = [ i[0] for i in dims ]
+    status = numpy.array([x[FIELD_STATUS] for x in data])
+    relevant = numpy.flatnonzero((status == RESULT_FAILURE) |
+                                 (status == RESULT_SUCCESS))
+    if len(relevant) == 0:
+        return []
+    if len(relevant) < len(data):
+        data = [data[i] for i in relevant.tolist()]
+        status = status[relevant]
+
+    keys = numpy.zeros(len(data), dtype=numpy.int64)
+    size = 1
+    dim_codes = []
+    for _, lam in dims:
+        codes, values = _numpy_codes([lam(x) for x in data])
+        dim_codes.append((codes, values))
+        if size * len(values) >= 2 ** 62:
+            # Renumber the keys so far, so they can't overflow
+            unique, keys = numpy.unique(keys, return_inverse=True)
+            keys = keys.ravel()
+            size = len(unique)
+        keys = keys * len(values) + codes
+        size *= len(values)
+    counts = numpy.array([x[FIELD_RESULT] for x in data], dtype=numpy.int64)
+
+    # Where a key and status appear more than once, the last is used
+    keys = keys * 2 + status
+    unique, last = numpy.unique(keys[::-1], return_index=True)
+    last = len(keys) - 1 - last
+    groups, group_idx = numpy.unique(unique // 2, return_inverse=True)
+    group_idx = group_idx.ravel()
+    fail = numpy.zeros(len(groups), dtype=numpy.int64)
+    success = numpy.zeros(len(groups), dtype=numpy.int64)
+    is_success = unique % 2 == RESULT_SUCCESS
+    fail[group_idx[~is_success]] = counts[last[~is_success]]
+    success[group_idx[is_success]] = counts[last[is_success]]
+    # A row of each group, to read its dimension values from
+    rows = numpy.zeros(len(groups), dtype=numpy.int64)
+    rows[group_idx] = last
+
+    total = fail + success
+    nonzero = numpy.flatnonzero(total)
+    rows = rows[nonzero]
+    total = total[nonzero]
+    # (Calculated as in _percentage, so the floats come out the same)
+    percentage = success[nonzero].astype(numpy.float64) / total * 100.0
+
+    columns = [[values[code] for code in codes[rows].tolist()]
+               for codes, values in dim_codes]
+    out = []
+    for row in zip(percentage.tolist(), total.tolist(), *columns):
+        aresult = {
+            "percentage_passed": row[0],
+            "total_results": row[1],
             }
         for i, dim in enumerate(dim_names):
-            data[dim] = dimensions[i]
-        return data
+            aresult[dim] = row[i + 2]
+        out.append(aresult)
+    return out
 
-    out = list(map(calc_percentages, itertools.product(*dimension_lists)))
-    out = [i for i in out if i is not None]
+def _aggregate_percentages(data, dims):
+    """
+    'dims' contains a list of tuples of field names and the lambdas
+    used for extracting those fields from 'data'. These fields are
+    treated as dimensions in an n-dimensional hypercube
 
-    return out
+    Rather than visiting every cell of the hypercube, the data is
+    grouped on the combinations of values actually present, and the
+    percentage passed calculated for each of those
+    """
+    if numpy is not None and len(data) >= NUMPY_THRESHOLD:
+        return _numpy_percentages(data, dims)
+    return _sparse_percentages(data, dims)
 
 def aggregate_percentages(data):
     # Aggregates results data for a specific runtime.
@@ -11,7 +11,7 @@ from io import StringIO, BytesIO
 
 import csv
 
-from . import dqorganisations, models
+from . import dqorganisations, models, summary
 from .survey import data as dqsurveys
 
 
@@ -66,8 +66,9 @@ def write_agg_csv_result(out, organisation, freq, result):
             "points": str(points)
             })
 
-def write_organisation_publications_csv(out, organisation):
-    aggregate_results = dqorganisations._organisation_indicators(organisation)
+def write_organisation_publications_csv(out, organisation, summaries=None):
+    aggregate_results = dqorganisations._organisation_indicators(
+        organisation, summaries=summaries)
 
     freq = get_frequency_multiplier(organisation.frequency)
 
@@ -320,8 +321,10 @@ def write_agg_csv_result_index(out, organisation, freq, result, iati_manual,
         csv_row = CSVRow(organisation, indicator_info, indicator_total_weighted_points, indicator_category_subcategory, iati_manual, publication_format, publication_format_points, total_points, iati_data_quality_passed, iati_data_quality_points, freq, frequency_multiplier, iati_data_quality_total_points, survey_publication_status, survey_publication_status_value, survey_ordinal_value, survey_publication_format, survey_publication_format_value, survey_total_points)
         csv_row.write_to(out, None)
 
-def write_organisation_publications_csv_index(out, organisation, history=False):
-    aggregate_results = dqorganisations._organisation_indicators_split(organisation)
+def write_organisation_publications_csv_index(out, organisation, history=False,
+                                              summaries=None):
+    aggregate_results = dqorganisations._organisation_indicators_split(
+        organisation, summaries=summaries)
 
     freq = get_frequency_multiplier(organisation.frequency)
 
@@ -407,11 +410,20 @@ def make_csv(organisations, index_data=False, history=False):
         headers[fieldname] = fieldname
     out.writerow(headers)
 
+    # Summarise all the organisations at once, rather than one by one
+    # (a single organisation's summary is likely to be cached)
+    organisations = list(organisations)
+    summaries = None
+    if len(organisations) > 1:
+        summaries = summary.BatchPublisherSummary(
+            [organisation.id for organisation in organisations], 2)
+
     for organisation in organisations:
         if index_data:
-            write_organisation_publications_csv_index(out, organisation, history)
+            write_organisation_publications_csv_index(out, organisation, history,
+                                                      summaries)
         else:
-            write_organisation_publications_csv(out, organisation)
+            write_organisation_publications_csv(out, organisation, summaries)
 
     strIO.seek(0)
 
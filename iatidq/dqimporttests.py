@@ -13,7 +13,7 @@ import urllib.request, urllib.error, urllib.parse
 import yaml
 
 from iatidataquality import db
-from . import hardcoded_test, models, test_level
+from . import hardcoded_test, models, summary_cache, test_level
 
 
 def hardcodedTests():
@@ -118,6 +118,7 @@ def _importTests(fh, filename, level=1, local=True):
         test.file = filename
         test.line = line_num
         db.session.add(test)
+        summary_cache.bump_generation()
 
     print("Imported successfully")
     return True
@@ -12,7 +12,7 @@ import pprint
 import csv
 
 from iatidataquality import db, app
-from . import models
+from . import models, summary_cache
 
 
 def importIndicatorDescriptions():
@@ -182,6 +182,7 @@ def addIndicatorGroup(data):
                 description = data["description"]
                 )
             db.session.add(newIG)
+            summary_cache.bump_generation()
         return newIG
     else:
         return False
@@ -193,6 +194,7 @@ def updateIndicatorGroup(indicatorgroup, data):
             checkIG.name = data["name"]
             checkIG.description = data["description"]
             db.session.add(checkIG)
+            summary_cache.bump_generation()
         return checkIG
     else:
         return False
@@ -211,6 +213,7 @@ def deleteIndicatorGroup(indicatorgroup):
                     db.session.delete(IT)
                 db.session.delete(I)
             db.session.delete(checkIG)
+            summary_cache.bump_generation()
         return True
     else:
         return False
@@ -234,6 +237,7 @@ def addIndicator(data):
                 indicator_weight = data.get("indicator_weight", None)
                 )
             db.session.add(newI)
+            summary_cache.bump_generation()
         return newI
     else:
         return False
@@ -258,6 +262,7 @@ def updateIndicator(indicatorgroup, indicator, data):
             checkI.indicator_order = data.get("indicator_order", None)
             checkI.indicator_weight = data.get("indicator_weight", None)
             db.session.add(checkI)
+            summary_cache.bump_generation()
         return checkI
     else:
         return False
@@ -280,6 +285,7 @@ def deleteIndicator(indicatorgroup, indicator):
                 db.session.delete(IT)
 
             db.session.delete(checkI)
+            summary_cache.bump_generation()
         return True
     else:
         return False
@@ -318,6 +324,7 @@ def addIndicatorTest(data):
                 test_id = data["test_id"]
                 )
             db.session.add(newIT)
+            summary_cache.bump_generation()
         return newIT
     else:
         return False
@@ -332,6 +339,7 @@ def addIndicatorInfoType(data):
                 indicator_id = data["indicator_id"]
                 )
             db.session.add(newIIT)
+            summary_cache.bump_generation()
         return newIIT
     else:
         return False
@@ -341,6 +349,7 @@ def deleteIndicatorTest(indicatortest_id):
     if checkIT:
         with db.session.begin():
             db.session.delete(checkIT)
+            summary_cache.bump_generation()
         return checkIT
     else:
         return False
@@ -393,5 +402,6 @@ def disableUnassociatedTests(indicatorgroup_name):
             utest.active=False
             db.session.add(utest)
             count +=1
+        summary_cache.bump_generation()
     print("Deactivated", count, "tests")
     return count
@@ -13,7 +13,7 @@ import csv
 import codecs
 
 from iatidataquality import app, db
-from . import dqindicators, models, summary
+from . import dqindicators, models, summary, summary_cache
 
 
 def checkCondition(row):
@@ -312,8 +312,8 @@ def addFeedback(data):
 
 
 def make_publisher_summary(organisation, aggregation_type):
-    s = summary.PublisherSummaryCreator(organisation, aggregation_type)
-    return s.summary.summary()  # FIXME
+    return summary_cache.publisher_summary(
+        summary.PublisherSummaryCreator, organisation, aggregation_type)
 
 
 def info_result_tuple(ir):
@@ -350,10 +350,16 @@ def info_result_tuple(ir):
             })
 
 
-def _organisation_indicators(organisation, aggregation_type=2):
-    s = summary.PublisherIndicatorsSummaryCreator(organisation,
-                                                  aggregation_type)
-    data = s.summary.summary()  # FIXME
+def _organisation_indicators(organisation, aggregation_type=2,
+                             summaries=None):
+    # summaries can be a summary.BatchPublisherSummary including this
+    # organisation, when going through many organisations
+    if summaries is None:
+        data = summary_cache.publisher_summary(
+            summary.PublisherIndicatorsSummaryCreator, organisation,
+            aggregation_type)
+    else:
+        data = summaries.summary(organisation.id)
 
     # Sorry, this is really crude
     inforesults = _organisation_indicators_inforesults(organisation)
@@ -432,8 +438,10 @@ def _organisation_indicators_complete_split(organisation, aggregation_type=2):
             "commitment": commitment_results}
 
 
-def _organisation_indicators_split(organisation, aggregation_type=2):
-    results = _organisation_indicators(organisation, aggregation_type)
+def _organisation_indicators_split(organisation, aggregation_type=2,
+                                   summaries=None):
+    results = _organisation_indicators(organisation, aggregation_type,
+                                       summaries)
     commitment_data = dqindicators.indicators_subset(
                     app.config["INDICATOR_GROUP"],
                     "commitment")
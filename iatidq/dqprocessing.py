@@ -8,7 +8,7 @@
 #  it under the terms of the GNU Affero General Public License v3.0
 
 from iatidataquality import db
-from . import aggregations, dqpackages, models
+from . import aggregations, dqpackages, models, summary_cache
 
 
 def add_hardcoded_result(test_id, runtime_id, package_id, result_data):
@@ -49,43 +49,31 @@ def aggregate_results(runtime, package_id):
     return {"status": status, "data": aresults}
 
 def get_results(runtime, package_id, agg_type):
+    """
+    Return a subquery of the ids of a package's results to aggregate.
+
+    Results with no identifier always count; the rest only count if
+    the activity passed the aggregation type's test (if it has one).
+    Expressed as a semi-join, so the ids never leave the database.
+    """
+    Result = models.Result
+
+    results = db.session.query(Result.id).filter(
+        Result.runtime_id == runtime,
+        Result.package_id == package_id)
 
     if agg_type.test_id is not None:
         # Find all activities that passed the "current" test
-        results = db.session.query(db.distinct(models.Result.result_identifier)).filter(
-            models.Result.test_id == agg_type.test_id
-            ).filter(
-            models.Result.result_data == '1'
-            )
-    else:
-        results = db.session.query(db.distinct(models.Result.result_identifier))
-
-    # Get a subset of those activities' results, by package and runtime
-    results = results.filter(
-        models.Result.runtime_id == runtime
-        ).filter(
-        models.Result.package_id == package_id
-        ).all()
-
-    result_identifiers = results # set([r.result_identifier for r in results])
-
-    if result_identifiers:
-        results = models.Result.query.filter(
-            models.Result.runtime_id == runtime,
-            models.Result.package_id == package_id,
-            models.Result.result_identifier.in_(result_identifiers)
-            ).all()
-    else:
-        results = []
-
-    results2 = models.Result.query.filter(
-        models.Result.runtime_id == runtime,
-        models.Result.package_id == package_id,
-        models.Result.result_identifier == None
-        ).all()
+        identifiers = db.session.query(Result.result_identifier).filter(
+            Result.test_id == agg_type.test_id,
+            Result.result_data == aggregations.RESULT_SUCCESS,
+            Result.runtime_id == runtime,
+            Result.package_id == package_id)
+        results = results.filter(db.or_(
+            Result.result_identifier == None,
+            Result.result_identifier.in_(identifiers)))
 
-    results += results2
-    return set([r.id for r in results])
+    return results.subquery()
 
 def delete_aggregations(sess, package_id, agg_type):
     sess.query(models.AggregateResult).filter(
@@ -133,53 +121,58 @@ def aggregate_results_single_org(runtime, package_id, agg_type):
 
 def aggregate_results_orgs(runtime, package_id, organisation_ids, agg_type):
     status = "Updating"
+    Result = models.Result
     result_ids = get_results(runtime, package_id, agg_type)
 
-    # create temp table
-    conn = db.session.connection()
-    conn.execute('begin transaction;')
-    conn.execute('''create temporary table relevant_result
-                                           (result_id int not null primary key);''')
-
-    for result_id in result_ids:
-        conn.execute('''insert into relevant_result values (%d);''' % result_id)
-
-    sql = '''
-        SELECT test.id AS test_id,
-            result.result_data AS result_result_data,
-            result.result_hierarchy AS result_result_hierarchy,
-            count(result.id) AS count_1,
-            result.package_id AS result_package_id,
-            result.organisation_id AS result_organisation_id
-        FROM test JOIN result ON test.id = result.test_id
-        WHERE result.runtime_id = %d AND result.package_id = %d AND
-              result.id IN
-                  (select result_id from relevant_result) GROUP BY result.package_id,
-            result.result_hierarchy,
-            result.organisation_id,
-            test.id,
-            result.result_data'''
-
-    stmt = sql % (runtime, package_id)
-    data = [row for row in conn.execute(stmt)]
-    conn.execute('''drop table relevant_result;''')
-    conn.execute('rollback;')
-    del(conn)
-
-    aresults = aggregations.aggregate_percentages_org(data)
+    passed = db.func.sum(Result.result_data)
+    total = db.func.count(Result.id)
+    query = db.session.query(
+        Result.package_id,
+        models.Test.id,
+        Result.result_hierarchy,
+        Result.organisation_id,
+        # (In the same order as aggregations.aggregate_percentages_org,
+        # so the floats come out the same.)
+        db.cast(passed, db.Float) / total * 100.0,
+        total,
+        db.literal(agg_type.id),
+    ).join(models.Test, models.Test.id == Result.test_id
+    ).filter(Result.runtime_id == runtime,
+             Result.package_id == package_id,
+             Result.id.in_(result_ids),
+             # Only passes and failures count towards the percentage
+             Result.result_data.in_([aggregations.RESULT_FAILURE,
+                                     aggregations.RESULT_SUCCESS])
+    ).group_by(Result.package_id,
+               Result.result_hierarchy,
+               Result.organisation_id,
+               models.Test.id)
+
+    AggregateResult = models.AggregateResult
+    insert = AggregateResult.__table__.insert().from_select(
+        ['package_id', 'test_id', 'result_hierarchy', 'organisation_id',
+         'results_data', 'results_num', 'aggregateresulttype_id'],
+        query.statement)
 
     with db.session.begin():
         delete_aggregations(db.session, package_id, agg_type)
-
-        for aresult in aresults:
-            a = models.AggregateResult()
-            a.package_id = aresult["package_id"]
-            a.test_id = aresult["test_id"]
-            a.result_hierarchy = aresult["hierarchy"]
-            a.results_data = aresult["percentage_passed"]
-            a.results_num = aresult["total_results"]
-            a.organisation_id = aresult["organisation_id"]
-            a.aggregateresulttype_id = agg_type.id
-            db.session.add(a)
+        db.session.execute(insert)
+        summary_cache.bump_versions(organisation_ids)
+        aresults = [{
+            "package_id": a.package_id,
+            "test_id": a.test_id,
+            "hierarchy": a.result_hierarchy,
+            "organisation_id": a.organisation_id,
+            "percentage_passed": a.results_data,
+            "total_results": a.results_num,
+        } for a in db.session.query(
+            AggregateResult.package_id,
+            AggregateResult.test_id,
+            AggregateResult.result_hierarchy,
+            AggregateResult.organisation_id,
+            AggregateResult.results_data,
+            AggregateResult.results_num,
+        ).filter(AggregateResult.package_id == package_id,
+                 AggregateResult.aggregateresulttype_id == agg_type.id)]
 
     return {"status": status, "data": aresults}
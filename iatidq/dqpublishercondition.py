@@ -8,11 +8,15 @@
 #  it under the terms of the GNU Affero General Public License v3.0
 
 from iatidataquality import db
-from . import models
+from . import models, summary_cache
 
 
 def configure_organisation_condition(pc, request):
     with db.session.begin():
+        # The condition may be moved to another organisation, so both
+        # organisations' summaries change.
+        organisation_ids = [pc.organisation_id,
+                            int(request.form['organisation_id'])]
         pc.description = request.form['description']
         pc.organisation_id = int(request.form['organisation_id'])
         pc.test_id = int(request.form['test_id'])
@@ -23,6 +27,7 @@ def configure_organisation_condition(pc, request):
         pc.line = int(request.form['line'])
         pc.active = bool(request.form['active'])
         db.session.add(pc)
+        summary_cache.bump_versions(organisation_ids)
 
 def get_publisher_condition(pc_id):
     return db.session.query(
@@ -70,6 +75,7 @@ def delete_publisher_condition(id):
         ).first()
     with db.session.begin():
         db.session.delete(pc)
+        summary_cache.bump_versions([pc.organisation_id])
 
 def delete_publisher_feedback(feedback):
     with db.session.begin():
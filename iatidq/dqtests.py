@@ -8,7 +8,7 @@
 #  it under the terms of the GNU Affero General Public License v3.0
 
 from iatidataquality import db
-from . import models
+from . import models, summary_cache
 
 class TestNotFound(Exception): pass
 
@@ -36,6 +36,7 @@ def updateTest(data):
             for k, v in list(data.items()):
                 setattr(checkTest, k, v)
             db.session.add(checkTest)
+            summary_cache.bump_generation()
         return checkTest
     else:
         return False
@@ -44,6 +45,7 @@ def deleteTest(test_id):
     with db.session.begin():
         checkTest = tests(test_id)
         db.session.delete(checkTest)
+        summary_cache.bump_generation()
 
 def addTest(data):
     try:
@@ -61,4 +63,5 @@ def addTest(data):
             active = data['active']
             )
         db.session.add(test)
+        summary_cache.bump_generation()
     return test
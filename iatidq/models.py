@@ -169,6 +169,23 @@ class AggregateResult(BaseModel):
     def as_dict(self):
        return {c.name: getattr(self, c.name) for c in self.__table__.columns}
 
+# SummaryVersion is bumped whenever an organisation's aggregate results,
+# sampling failures or conditions change, so that cached publisher
+# summaries (see summary_cache) built before the change aren't used
+class SummaryVersion(BaseModel):
+    __tablename__ = 'summaryversion'
+    organisation_id = db.Column(db.Integer, db.ForeignKey('organisation.id', ondelete='CASCADE'),
+                                primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+# SummaryGeneration (a single row) is bumped whenever tests or indicators
+# change, or the summary cache is cleared, so that no cached publisher
+# summary built before then is used
+class SummaryGeneration(BaseModel):
+    __tablename__ = 'summarygeneration'
+    id = db.Column(db.Integer, primary_key=True)
+    generation = db.Column(db.Integer, nullable=False, default=0)
+
 # AggregationType allows for different aggregations
 # Particularly used for looking only at current data
 class AggregationType(BaseModel):
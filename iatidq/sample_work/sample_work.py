@@ -1,6 +1,5 @@
 #!/usr/bin/env python
 
-import csv
 import os
 import random
 import re
@@ -16,7 +15,8 @@ from iatidataquality import app
 from iatidq import models
 from .test_mapping import test_to_kind
 from . import db
-from beta.utils import slugify
+from beta.results import open_results
+from beta.utils import load_current_data_results, load_current_data_test
 
 
 def all_tests():
@@ -121,39 +121,36 @@ class SampleOrgTest(object):
         else:
             indexes = sorted(random.sample(list(range(total)), num_samples))
 
-        current_data_path = os.path.join(
+        snapshot_result_path = os.path.join(
             app.config.get('IATI_RESULT_PATH'),
-            self.snapshot_date,
-            self.organisation.organisation_code,
-            'current_data.csv')
-        test_path = os.path.join(
-            app.config.get('IATI_RESULT_PATH'),
-            self.snapshot_date,
-            self.organisation.organisation_code,
-            '{}.csv'.format(slugify(self.test.description)))
+            self.snapshot_date)
+        reader = open_results(os.path.join(
+            snapshot_result_path,
+            self.organisation.organisation_code))
+        current_data_test_name = load_current_data_test().name
 
-        if not os.path.exists(current_data_path):
+        if current_data_test_name not in reader:
             print('Results with organization code %s does not exist' % self.organisation.organisation_code)
             return
 
-        with open(current_data_path) as cd_handler:
-            with open(test_path) as test_handler:
-                cd_reader = csv.DictReader(cd_handler)
-                test_reader = csv.DictReader(test_handler)
-                idx = 0
-                for cd_result in cd_reader:
-                    if indexes == []:
-                        break
-                    test_result = next(test_reader)
-                    if cd_result['result'] == 'pass' and test_result['result'] == 'pass':
-                        if idx == indexes[0]:
-                            indexes.pop(0)
-                            yield (
-                                cd_result['dataset'],
-                                int(cd_result['index']),
-                                cd_result['identifier'],
-                            )
-                        idx += 1
+        current_data = load_current_data_results(
+            self.organisation, snapshot_result_path)
+        test_reader = reader.rows(self.test.description)
+        idx = 0
+        for test_result in test_reader:
+            if indexes == []:
+                break
+            activity_idx = int(test_result['index'])
+            if test_result['result'] == 'pass' and \
+                    current_data.get(test_result['dataset'], activity_idx):
+                if idx == indexes[0]:
+                    indexes.pop(0)
+                    yield (
+                        test_result['dataset'],
+                        activity_idx,
+                        test_result['identifier'],
+                    )
+                idx += 1
 
     def xml_of_package(self, package_name):
         filename = package_name + '.xml'
@@ -7,8 +7,6 @@
 #  This programme is free software; you may redistribute and/or modify
 #  it under the terms of the GNU Affero General Public License v3.0
 
-import itertools
-
 from iatidataquality import db
 from . import models
 
@@ -28,22 +26,54 @@ def reform_dict(d):
     and returns a dict of dicts of the form
       {hierarchy1: {test1: ..., test2: ...}, hierarchy2: ...}
     """
+    out = {}
+    for (hier, test), data in d.items():
+        out.setdefault(hier, {})[test] = data
+    return dict([ (hier, out[hier]) for hier in set(out) ])
+
+def remove_empty_dicts(d):
+    return dict([
+            (hier, dict([ (test, data) for test, data in test_data.items()
+                          if len(data) ]))
+            for hier, test_data in d.items()
+            ])
 
-    def inner(hier):
-        HIER = 0
-        TEST = 1
-        matches_first = lambda ht: ht[HIER] == hier
-        return dict([ (test, d[(hier, test)]) for test in
-                      [ht[TEST] for ht in list(filter(matches_first, list(d.keys())))] ])
+def nest_summaries(hierarchies, tests, data, summary_f, conditions):
+    """
+    Returns a dict of dicts of the form
+      {hierarchy1: {test1: ..., test2: ...}, hierarchy2: ...}
+    with every one of the hierarchies (as long as there are any tests).
+    summary_f(hierarchy, test) makes the entry for each (hierarchy, test)
+    key of data; one with a condition but no data just gets the condition.
 
-    return dict([ (hier, inner(hier))
-                   for hier in set( hier for hier, test in list(d.keys()) ) ])
+    This only visits the keys of data and the conditions, rather than
+    every combination of hierarchy and test.
+    """
+    if not tests:
+        return {}
+
+    # Tests are kept in the order given
+    positions = {}
+    for test in tests:
+        positions.setdefault(test, len(positions))
+
+    out = dict([ (hier, {}) for hier in set(hierarchies) ])
+    for hier, test in data:
+        if hier in out and test in positions:
+            out[hier][test] = summary_f(hier, test)
+
+    # Conditions are on the hierarchy as a string
+    hierarchy_lookup = dict([ (str(hier), hier) for hier in out ])
+    for test, hier, condition in conditions.hierarchy_conditions():
+        hier = hierarchy_lookup.get(hier)
+        if hier is None or test not in positions:
+            continue
+        out[hier].setdefault(test, {})["condition"] = condition
 
-def remove_empty_dicts(d):
-    has_keys = lambda kvp: len(kvp[1])
     return dict([
-            (hier, dict(list(filter(has_keys, list(test_data.items())))))
-            for hier, test_data in list(d.items())
+            (hier, dict([ (test, test_data[test]) for test in
+                          sorted(test_data, key=positions.get) ]))
+            for hier, test_data in out.items()
             ])
 
 
@@ -191,29 +221,12 @@ class PublisherSummary(object):
     def summary(self):
         return self._summary
 
-    def generate_summaries(self, hierarchies, tests, summary_f):
-        for h, t in itertools.product(hierarchies, tests):
-            yield h, t, summary_f(h, t)
-
     def summarise_results(self, hierarchies,
                       tests, indicators,
                       indicators_tests, indicator_lookup,
-                      summary_f):
-
-        def add_condition(i):
-            h, t, tdata = i
-            if self.conditions.has_condition(t, h):
-                tdata["condition"] = self.conditions.get_condition(t, h)
-            return h, t, tdata
-
-        summaries = (add_condition(i) for i in self.generate_summaries(
-                hierarchies, tests, summary_f))
-
-        tmp_out = dict([ ((h, t), tdata) for h, t, tdata in summaries ])
-
-        out = reform_dict(tmp_out)
-
-        out = remove_empty_dicts(out)
+                      data, summary_f):
+        out = nest_summaries(hierarchies, tests, data, summary_f,
+                             self.conditions)
         return self.add_indicator_info(out, indicators,
                                        indicators_tests, indicator_lookup)
 
@@ -224,7 +237,7 @@ class PublisherSummary(object):
     def calculate(self, join_clause, where_clause):
         # make list of data; hand over to
         # summarise_results(hierarchies, tests, indicators,
-        #                   indicators_tests, summary_f):
+        #                   indicators_tests, data, summary_f):
         conn = db.session.connection()
 
         sql = '''SELECT DISTINCT result_hierarchy
@@ -239,10 +252,6 @@ class PublisherSummary(object):
                    %s %s;'''
         stmt = sql % (join_clause, where_clause)
         indicators_tests = [ it for it in conn.execute(stmt) ]
-        tests = [ it[1] for it in indicators_tests ]
-        indicators = [ it[0] for it in indicators_tests ]
-
-        indicator_lookup = dict([ (it[1], it[0]) for it in indicators_tests ])
 
         # The WITH-clause sets up "org_aresult" as though it were a table
         # resembling the results of the query in the clause; it contains
@@ -263,7 +272,8 @@ class PublisherSummary(object):
             )
             SELECT result_hierarchy,
                    test_id,
-                   SUM(results_data * results_num::float / t1.total) AS pct,
+                   SUM(results_data * CAST(results_num AS FLOAT) /
+                       t1.total) AS pct,
                    SUM(results_num) AS total_activities
             FROM org_aresult
             JOIN (
@@ -279,12 +289,18 @@ class PublisherSummary(object):
         conn.close()
         del(conn)
 
-        def summary_f(hierarchy, test_id):
-            key = (hierarchy, test_id)
-            if key not in data:
-                return {}
+        return self.summarise_data(hierarchies, indicators_tests, data)
 
-            aresult = data[key]
+    def summarise_data(self, hierarchies, indicators_tests, data):
+        # data is keyed by (hierarchy, test_id), with rows of
+        # (hierarchy, test_id, pct, total_activities)
+        tests = [ it[1] for it in indicators_tests ]
+        indicators = [ it[0] for it in indicators_tests ]
+
+        indicator_lookup = dict([ (it[1], it[0]) for it in indicators_tests ])
+
+        def summary_f(hierarchy, test_id):
+            aresult = data[(hierarchy, test_id)]
             sampling_ok = self.sampling_data[test_id]
             indicator_id = indicator_lookup[test_id]
 
@@ -295,13 +311,14 @@ class PublisherSummary(object):
 
         return self.summarise_results(hierarchies, tests, indicators,
                                       indicators_tests, indicator_lookup,
-                                      summary_f)
+                                      data, summary_f)
 
     def get_sampling_data(self, organisation_id):
-        sql = '''SELECT test_id FROM sampling_failure
-                   WHERE organisation_id = %s;'''
+        sql = db.text('''SELECT test_id FROM sampling_failure
+                           WHERE organisation_id = :organisation_id;''')
         failed_test_ids = [ row[0] for row in
-                            db.engine.execute(sql, (organisation_id,)) ]
+                            db.engine.execute(
+                                sql, organisation_id=organisation_id) ]
 
         def ok(t):
             return t not in failed_test_ids
@@ -323,15 +340,18 @@ class PublisherIndicatorsSummary(PublisherSummary):
 
 
 class OrgConditions(object):
-    def __init__(self, organisation_id):
+    def __init__(self, organisation_id, cc=None):
         # None is passed as organisation_id for case of no conditions wanted
         if organisation_id is None:
             self._conditions = {}
             return
 
-        cc = models.OrganisationCondition.query.filter_by(
-            organisation_id=organisation_id
-            ).all()
+        # The organisation's conditions can be passed in (as cc), if
+        # they've already been loaded
+        if cc is None:
+            cc = models.OrganisationCondition.query.filter_by(
+                organisation_id=organisation_id
+                ).all()
         self._conditions = dict([(
                     (x.test_id, x.condition, x.condition_value),
                     (x.operation, x.description)
@@ -362,6 +382,13 @@ class OrgConditions(object):
         key = self._key(test_id, hierarchy)
         return self._conditions[key]
 
+    def hierarchy_conditions(self):
+        # (test_id, hierarchy, condition) for each condition on an
+        # activity hierarchy; the hierarchy is a string
+        for (test_id, condition, value), cdtn in self._conditions.items():
+            if condition == 'activity hierarchy':
+                yield test_id, value, cdtn
+
 
 class SummaryCreator(object):
     @property
@@ -392,6 +419,131 @@ class PublisherIndicatorsSummaryCreator(SummaryCreator):
                                                    organisation_id,
                                                    aggregation_type)
 
+class _BatchedIndicatorsSummary(PublisherIndicatorsSummary):
+    # A PublisherIndicatorsSummary from data already loaded by
+    # BatchPublisherSummary
+    def __init__(self, conditions, tests, indicators, sampling_data,
+                 hierarchies, indicators_tests, data):
+        self.conditions = conditions
+        self.indicators = indicators
+        self.tests = tests
+        self.sampling_data = sampling_data
+        self._summary = self.summarise_data(hierarchies, indicators_tests,
+                                            data)
+
+
+class BatchPublisherSummary(object):
+    """
+    Publisher indicator summaries for many organisations at once, the
+    same as PublisherIndicatorsSummaryCreator makes for each of them.
+
+    The aggregate results of all the organisations come from one
+    query, grouped by organisation as well as hierarchy and test. The
+    test and indicator info is loaded once, and the conditions and
+    sampling failures are loaded for all the organisations together.
+    """
+    def __init__(self, organisation_ids, aggregation_type):
+        self.organisation_ids = sorted(set(organisation_ids))
+        self.aggregation_type = aggregation_type
+        self.tests = TestInfo()
+        self.indicators = IndicatorInfo()
+        self.indicator_lookup = dict(db.session.query(
+                models.IndicatorTest.test_id,
+                models.IndicatorTest.indicator_id).all())
+
+        self._conditions = {}
+        self._failed_test_ids = {}
+        self._results = {}
+        if self.organisation_ids:
+            self.load_conditions()
+            self.load_sampling_failures()
+            self.load_results()
+
+    def load_conditions(self):
+        cc = models.OrganisationCondition.query.filter(
+            models.OrganisationCondition.organisation_id.in_(
+                self.organisation_ids)
+            ).all()
+        for x in cc:
+            self._conditions.setdefault(x.organisation_id, []).append(x)
+
+    def load_sampling_failures(self):
+        failures = db.session.query(
+            models.SamplingFailure.organisation_id,
+            models.SamplingFailure.test_id
+            ).filter(
+            models.SamplingFailure.organisation_id.in_(self.organisation_ids)
+            ).all()
+        for organisation_id, test_id in failures:
+            self._failed_test_ids.setdefault(
+                organisation_id, set()).add(test_id)
+
+    def load_results(self):
+        # As in PublisherSummary.calculate, but for all the
+        # organisations, so grouped by organisation_id too
+        AggregateResult = models.AggregateResult
+        org_aresult = db.session.query(
+            AggregateResult.organisation_id,
+            AggregateResult.result_hierarchy,
+            AggregateResult.test_id,
+            AggregateResult.results_data,
+            AggregateResult.results_num
+            ).filter(
+            AggregateResult.organisation_id.in_(self.organisation_ids),
+            AggregateResult.aggregateresulttype_id == self.aggregation_type
+            ).cte('org_aresult')
+        keys = [org_aresult.c.organisation_id,
+                org_aresult.c.result_hierarchy,
+                org_aresult.c.test_id]
+
+        t1 = db.session.query(
+            *(keys + [db.func.sum(org_aresult.c.results_num).label('total')])
+            ).group_by(*keys).subquery('t1')
+
+        rows = db.session.query(
+            *(keys + [
+                db.func.sum(org_aresult.c.results_data *
+                            db.cast(org_aresult.c.results_num, db.Float) /
+                            t1.c.total),
+                db.func.sum(org_aresult.c.results_num)])
+            ).join(t1, db.and_(
+                org_aresult.c.organisation_id == t1.c.organisation_id,
+                org_aresult.c.result_hierarchy == t1.c.result_hierarchy,
+                org_aresult.c.test_id == t1.c.test_id)
+            ).group_by(*keys
+            ).order_by(*keys)
+
+        for ar in rows:
+            data = self._results.setdefault(ar[0], {})
+            data[(ar[1], ar[2])] = tuple(ar[1:])
+
+    def summary(self, organisation_id):
+        """
+        Returns the same as
+          PublisherIndicatorsSummaryCreator(organisation,
+                                            aggregation_type).summary.summary()
+        for one of the organisations. Each call makes a new dict, which
+        the caller is free to change.
+        """
+        data = self._results.get(organisation_id, {})
+
+        hierarchies = list(dict.fromkeys(h for h, t in data))
+        tests = list(dict.fromkeys(t for h, t in data))
+        indicators_tests = [ (self.indicator_lookup[t], t) for t in tests
+                             if t in self.indicator_lookup ]
+
+        failed_test_ids = self._failed_test_ids.get(organisation_id, set())
+        sampling_data = dict([ (t, t not in failed_test_ids)
+                               for t in self.tests.tests ])
+
+        conditions = OrgConditions(organisation_id,
+                                   self._conditions.get(organisation_id, []))
+
+        return _BatchedIndicatorsSummary(
+            conditions, self.tests, self.indicators, sampling_data,
+            hierarchies, indicators_tests, data).summary()
+
+
 # The model for the big SQL query at the core of the class:
 
 # select domain, sum(results_data * results_num::float/t1.total)
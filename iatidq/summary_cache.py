@@ -0,0 +1,237 @@
+#  IATI Data Quality, tools for Data QA on IATI-formatted  publications
+#  by Mark Brough, Martin Keegan, Ben Webb and Jennifer Smith
+#
+#  Copyright (C) 2013  Publish What You Fund
+#
+#  This programme is free software; you may redistribute and/or modify
+#  it under the terms of the GNU Affero General Public License v3.0
+
+"""Cached publisher summaries.
+
+Building a publisher summary (see ``summary``) takes several queries
+and a pass over all of an organisation's aggregate results, and the
+same summaries are built over and over: for the organisation pages,
+and for every CSV export. So summaries are cached, keyed by the kind
+of summary, the organisation, the aggregation type, a global
+generation (the ``SummaryGeneration`` row) and the organisation's
+version stamp (a ``SummaryVersion`` row).
+
+Anything that changes what an organisation's summaries are built
+from (its aggregate results, sampling failures or conditions) has to
+call ``bump_versions``, in the same transaction, so cached summaries
+built from the old data are no longer used. Changes to the tests or
+indicators, which every summary is built from, call
+``bump_generation`` instead. So does clearing the cache, so that
+every web worker stops using the summaries it has cached.
+
+There are two tiers: an LRU cache in each process, and optionally a
+directory (``SUMMARY_CACHE_PATH``) shared by all the web workers.
+Summaries are stored pickled, so each hit returns a fresh copy that
+the caller is free to change.
+"""
+from collections import OrderedDict
+from glob import glob
+import os
+from os.path import join
+import pickle
+import tempfile
+import threading
+
+from iatidataquality import app, db
+from . import models
+
+
+DEFAULT_SIZE = 128
+
+
+class SummaryCache(object):
+    """An LRU cache of pickled values, in memory and (if ``path`` is
+    given) on disk. Keys are (kind, organisation_id, aggregation_type,
+    generation, version) tuples."""
+
+    def __init__(self, size=DEFAULT_SIZE, path=None):
+        self.size = size
+        self.path = path
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def _filepath(self, key):
+        return join(self.path,
+                    '-'.join(str(part) for part in key) + '.pickle')
+
+    def _read(self, key):
+        """Return a summary from disk, pickled and unpickled, or None
+        if it isn't there (or can't be read)."""
+        try:
+            with open(self._filepath(key), 'rb') as handler:
+                data = handler.read()
+            return data, pickle.loads(data)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def _write(self, key, data):
+        os.makedirs(self.path, exist_ok=True)
+        handle, temp_filepath = tempfile.mkstemp(
+            dir=self.path, suffix='.partial')
+        with os.fdopen(handle, 'wb') as handler:
+            handler.write(data)
+        os.replace(temp_filepath, self._filepath(key))
+        # Remove any older versions of the same summary.
+        prefix = '{}-{}-{}-'.format(*key[:3])
+        for filepath in glob(join(self.path, prefix + '*.pickle')):
+            if filepath != self._filepath(key):
+                try:
+                    os.remove(filepath)
+                except OSError:
+                    pass
+
+    def _remember(self, key, data):
+        if self.size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = data
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def get(self, key, build):
+        """Return the value for ``key``, calling ``build`` to make
+        it if it isn't cached."""
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+                self.memory_hits += 1
+                return pickle.loads(data)
+
+        if self.path is not None:
+            found = self._read(key)
+            if found is not None:
+                data, value = found
+                with self._lock:
+                    self.disk_hits += 1
+                self._remember(key, data)
+                return value
+
+        with self._lock:
+            self.misses += 1
+        value = build()
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        self._remember(key, data)
+        if self.path is not None:
+            self._write(key, data)
+        return value
+
+    def clear(self):
+        """Empty both tiers (but keep the stats). Other processes'
+        memory tiers aren't affected; see ``bump_generation``."""
+        with self._lock:
+            self._entries.clear()
+        if self.path is not None:
+            for filepath in glob(join(self.path, '*.pickle')):
+                try:
+                    os.remove(filepath)
+                except OSError:
+                    pass
+
+    def disk_entries(self):
+        """Return the number of summaries on disk, and their total
+        size in bytes."""
+        if self.path is None:
+            return 0, 0
+        filepaths = glob(join(self.path, '*.pickle'))
+        size = 0
+        for filepath in filepaths:
+            try:
+                size += os.path.getsize(filepath)
+            except OSError:
+                pass
+        return len(filepaths), size
+
+    def stats(self):
+        with self._lock:
+            memory_entries = len(self._entries)
+            memory_size = sum(len(data) for data in self._entries.values())
+            stats = {
+                'memory_hits': self.memory_hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'memory_entries': memory_entries,
+                'memory_size': memory_size,
+                'size': self.size,
+                'path': self.path,
+            }
+        stats['disk_entries'], stats['disk_size'] = self.disk_entries()
+        lookups = stats['memory_hits'] + stats['disk_hits'] + stats['misses']
+        stats['lookups'] = lookups
+        stats['hit_rate'] = (
+            100.0 * (lookups - stats['misses']) / lookups if lookups else None)
+        return stats
+
+
+_cache = None
+
+
+def get_cache():
+    """Return this process's cache, configured by ``SUMMARY_CACHE_SIZE``
+    and ``SUMMARY_CACHE_PATH``."""
+    global _cache
+    if _cache is None:
+        _cache = SummaryCache(app.config.get('SUMMARY_CACHE_SIZE',
+                                             DEFAULT_SIZE),
+                              app.config.get('SUMMARY_CACHE_PATH'))
+    return _cache
+
+
+def summary_generation():
+    generation = db.session.query(
+        db.func.max(models.SummaryGeneration.generation)).scalar()
+    return generation or 0
+
+
+def summary_version(organisation_id):
+    version = db.session.query(models.SummaryVersion.version).filter(
+        models.SummaryVersion.organisation_id == organisation_id).scalar()
+    return version or 0
+
+
+def bump_generation():
+    """Invalidate every cached summary, in every process. Call this
+    in the same transaction as the change."""
+    updated = models.SummaryGeneration.query.update(
+        {models.SummaryGeneration.generation:
+         models.SummaryGeneration.generation + 1},
+        synchronize_session=False)
+    if not updated:
+        db.session.add(models.SummaryGeneration(generation=1))
+    db.session.flush()
+
+
+def bump_versions(organisation_ids):
+    """Invalidate the cached summaries of each of the organisations.
+    Call this in the same transaction as the change."""
+    for organisation_id in set(organisation_ids):
+        if organisation_id is None:
+            continue
+        updated = models.SummaryVersion.query.filter(
+            models.SummaryVersion.organisation_id == organisation_id
+        ).update({models.SummaryVersion.version:
+                  models.SummaryVersion.version + 1},
+                 synchronize_session=False)
+        if not updated:
+            db.session.add(models.SummaryVersion(
+                organisation_id=organisation_id, version=1))
+    db.session.flush()
+
+
+def publisher_summary(creator, organisation, aggregation_type):
+    """Return ``creator(organisation, aggregation_type).summary.summary()``
+    (``creator`` being one of the ``summary.*SummaryCreator``
+    classes), from the cache if possible."""
+    key = (creator.__name__, organisation.id, aggregation_type,
+           summary_generation(), summary_version(organisation.id))
+    return get_cache().get(
+        key, lambda: creator(organisation, aggregation_type).summary.summary())
@@ -0,0 +1,19 @@
+@iati-activity
+Feature: Basic activity tests
+
+  Scenario: Title is present
+    Given an IATI activity
+     Then `title/narrative` should be present
+
+  Scenario: Description has 40 characters
+    Given an IATI activity
+      And `activity-status/@code` is not 5
+     Then `description/narrative/text()` should have at least 40 characters
+
+  Scenario: Sector uses a valid code
+    Given an IATI activity
+     Then every `sector[@vocabulary="1" or not(@vocabulary)]/@code` should be on the Sector codelist
+
+  Scenario: Country is valid
+    Given an IATI activity
+     Then at least one `recipient-country/@code` should be on the Country codelist
@@ -0,0 +1,6 @@
+@iati-organisation
+Feature: Organisation tests
+
+  Scenario: Total budget
+    Given file is an organisation file
+     Then `total-budget` should be present
@@ -0,0 +1,6 @@
+@iati-activity
+Feature: Current data
+
+  Scenario: Current data
+    Given an IATI activity
+     Then `activity-status[@code="2"]` should be present
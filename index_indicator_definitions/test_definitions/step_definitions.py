@@ -0,0 +1,26 @@
+# Scratch shim: the in-repo step definitions predate steps returning
+# their input, and expect `today` as a date.
+from datetime import datetime
+import os
+import importlib.util
+from bdd_tester import utils
+
+spec = importlib.util.spec_from_file_location(
+    'repo_step_definitions', os.path.join(os.getcwd(), 'tests', 'step_definitions.py'))
+mod = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(mod)
+
+
+def _wrap(fn):
+    def wrapped(xml, *args, **kwargs):
+        today = kwargs.get('today')
+        if isinstance(today, str):
+            kwargs['today'] = datetime.strptime(today, '%Y-%m-%d').date()
+        fn(xml, *args, **kwargs)
+        return xml
+    wrapped.__wrapped__ = fn
+    return wrapped
+
+
+for pattern, (regex, fn, loop) in list(utils.store.items()):
+    utils.store[pattern] = (regex, _wrap(fn), loop)
@@ -3,6 +3,8 @@ import re
 
 from bdd_tester import given, then, StepException
 
+from beta.xpath_cache import xpath
+
 
 @given(r'file is an organisation file')
 def given_org_file(xml, **kwargs):
@@ -32,7 +34,7 @@ def then_skip_it(xml, **kwargs):
 # NB the original PWYF test also checked non-empty
 @then(r'`([^`]+)` should be present')
 def then_is_present(xml, xpath_expression, **kwargs):
-    vals = xml.xpath(xpath_expression)
+    vals = xpath(xml, xpath_expression)
     if len(vals) == 0:
         msg = '`{}` not found'.format(xpath_expression)
         raise StepException(xml, msg)
@@ -40,7 +42,7 @@ def then_is_present(xml, xpath_expression, **kwargs):
 
 @then(r'`([^`]+)` should be present and of non-zero value')
 def then_is_present_and_nonzero(xml, xpath_expression, **kwargs):
-    els = xml.xpath(xpath_expression)
+    els = xpath(xml, xpath_expression)
     if len(els) == 0:
         msg = '`{}` not found'.format(xpath_expression)
         raise StepException(xml, msg)
@@ -63,13 +65,13 @@ def then_is_present_and_nonzero(xml, xpath_expression, **kwargs):
 
 @then(r'every `([^`]+)` should be on the ([^ ]+) codelist')
 def then_every_on_codelist(xml, xpath_expression, codelist, **kwargs):
-    vals = xml.xpath(xpath_expression)
+    vals = xpath(xml, xpath_expression)
 
     if len(vals) == 0:
         msg = '`{}` not found'.format(xpath_expression)
         raise StepException(xml, msg)
 
-    codes = kwargs.get('codelists', {}).get(codelist, [])
+    codes = kwargs.get('codelists', {}).get(codelist, frozenset())
 
     invalid_vals = []
     success = True
@@ -93,13 +95,13 @@ def then_every_on_codelist(xml, xpath_expression, codelist, **kwargs):
 
 @then(r'at least one `([^`]+)` should be on the ([^ ]+) codelist')
 def then_at_least_one_on_codelist(xml, xpath_expression, codelist, **kwargs):
-    vals = xml.xpath(xpath_expression)
+    vals = xpath(xml, xpath_expression)
 
     if len(vals) == 0:
         msg = '`{}` not found'.format(xpath_expression)
         raise StepException(xml, msg)
 
-    codes = kwargs.get('codelists', {}).get(codelist, [])
+    codes = kwargs.get('codelists', {}).get(codelist, frozenset())
 
     for val in vals:
         if val in codes:
@@ -146,7 +148,7 @@ def given_activity_is_current(xml, **kwargs):
                  'transaction[transaction-type/@code="2"] |' + \
                  'transaction[transaction-type/@code="3"] |' + \
                  'transaction[transaction-type/@code="4"]'
-    transactions = xml.xpath(xpath_expr)
+    transactions = xpath(xml, xpath_expr)
     for transaction in transactions:
         transaction_date = 'transaction-date/@iso-date'
         try:
@@ -163,7 +165,7 @@ def given_activity_is_current(xml, **kwargs):
 @then(r'`([^`]+)` should have at least (\d+) characters')
 def then_at_least_x_chars(xml, xpath_expression, reqd_chars, **kwargs):
     reqd_chars = int(reqd_chars)
-    vals = xml.xpath(xpath_expression)
+    vals = xpath(xml, xpath_expression)
     if len(vals) == 0:
         msg = '`{}` not found'.format(xpath_expression)
         raise StepException(xml, msg)
@@ -183,7 +185,7 @@ def then_at_least_x_chars(xml, xpath_expression, reqd_chars, **kwargs):
 @given(r'`([^`]+)` is one of ((?:\w+, )*\w+ or \w+)')
 def given_is_one_of_consts(xml, xpath_expression, consts, **kwargs):
     consts_list = re.split(r', | or ', consts)
-    vals = xml.xpath(xpath_expression)
+    vals = xpath(xml, xpath_expression)
     if len(vals) == 0:
         # explain = '{vals_explain} should be one of {const_explain}. ' + \
         #           'However, the activity doesn\'t contain that element'
@@ -206,7 +208,7 @@ def given_is_one_of_consts(xml, xpath_expression, consts, **kwargs):
 @given(r'`([^`]+)` is not any of ((?:\w+, )*\w+ or \w+)')
 def given_is_not_one_of_consts(xml, xpath_expression, consts, **kwargs):
     consts_list = re.split(r', | or ', consts)
-    vals = xml.xpath(xpath_expression)
+    vals = xpath(xml, xpath_expression)
     if len(vals) == 0:
         assert(True)
         return
@@ -232,7 +234,7 @@ def mkdate(date_str):
 @given(r'`([^`]+)` is at least (\d+) months ahead')
 def given_at_least_x_months_ahead(xml, xpath_expression,
                                   months_ahead, **kwargs):
-    dates = xml.xpath(xpath_expression)
+    dates = xpath(xml, xpath_expression)
     months_ahead = int(months_ahead)
 
     if len(dates) == 0:
@@ -281,7 +283,7 @@ def given_at_least_x_months_ahead(xml, xpath_expression,
 @given(r'`([^`]+)` is less than (\d+) months ago')
 def given_is_less_than_x_months_ago(xml, xpath_expression,
                                     months_ago, **kwargs):
-    dates = xml.xpath(xpath_expression)
+    dates = xpath(xml, xpath_expression)
 
     if len(dates) == 0:
         msg = '{xpath_expression} is not present, so assuming it is ' + \
@@ -329,7 +331,7 @@ def given_is_less_than_x_months_ago(xml, xpath_expression,
 
 @given(r'`([^`]+)` is not ([^ ]+)')
 def given_is_not_const(xml, xpath_expression, const, **kwargs):
-    vals = xml.xpath(xpath_expression)
+    vals = xpath(xml, xpath_expression)
     for val in vals:
         if val == const:
             msg = '`{}` is {}'.format(
@@ -342,7 +344,7 @@ def given_is_not_const(xml, xpath_expression, const, **kwargs):
 
 @given(r'`([^`]+)` is ([^ ]+)')
 def given_is_const(xml, xpath_expression, const, **kwargs):
-    vals = xml.xpath(xpath_expression)
+    vals = xpath(xml, xpath_expression)
     if len(vals) == 0:
         msg = '{} was not found'.format(xpath_expression)
     else:
@@ -360,7 +362,7 @@ def given_is_const(xml, xpath_expression, const, **kwargs):
 
 @then(r'`([^`]+)` should be available forward (annually|quarterly)')
 def then_is_available_forward(xml, xpath_expression, period, **kwargs):
-    vals = xml.xpath(xpath_expression)
+    vals = xpath(xml, xpath_expression)
 
     # Window start is from the reference date onwards.
     # We're only interested in budgets that start or end
@@ -374,14 +376,14 @@ def then_is_available_forward(xml, xpath_expression, period, **kwargs):
     # if there are no dates
 
     def check_after(element, today):
-        dates = element.xpath('period-start/@iso-date | period-end/@iso-date')
+        dates = xpath(element, 'period-start/@iso-date | period-end/@iso-date')
         dates = list([x for x in [mkdate(d) for d in dates] if x is not None])
         return any([date >= today for date in dates])
 
     def max_budget_length(element, max_budget_length):
         try:
-            start = mkdate(element.xpath('period-start/@iso-date')[0])
-            end = mkdate(element.xpath('period-end/@iso-date')[0])
+            start = mkdate(xpath(element, 'period-start/@iso-date')[0])
+            end = mkdate(xpath(element, 'period-end/@iso-date')[0])
             within_length = ((end-start).days <= max_budget_length)
         except TypeError:
             return False
@@ -414,7 +416,7 @@ def then_is_available_forward(xml, xpath_expression, period, **kwargs):
 @then(r'`([^`]+)` should be available (\d+) years? forward')
 def then_is_available_x_years_forward(xml, xpath_expression,
                                       years, **kwargs):
-    budgets = xml.xpath(xpath_expression)
+    budgets = xpath(xml, xpath_expression)
     today = kwargs.get('today')
     years = int(years)
 
@@ -440,7 +442,7 @@ def then_is_available_x_years_forward(xml, xpath_expression,
 @then(r'`([^`]+)` should start with either `([^`]+)` or `([^`]+)`')
 def then_should_start_with_either(xml, xpath_expression1, xpath_expression2,
                                   xpath_expression3, **kwargs):
-    vals = xml.xpath(xpath_expression1)
+    vals = xpath(xml, xpath_expression1)
 
     if len(vals) == 0:
         msg = '`{}` not found'.format(xpath_expression1)
@@ -449,8 +451,8 @@ def then_should_start_with_either(xml, xpath_expression1, xpath_expression2,
     target = vals[0]
 
     prefixes = []
-    for xpath in [xpath_expression2, xpath_expression3]:
-        prefix = xml.xpath(xpath)
+    for prefix_expression in [xpath_expression2, xpath_expression3]:
+        prefix = xpath(xml, prefix_expression)
         if len(prefix) > 0 and len(prefix[0]) > 0:
             prefixes.append(prefix[0])
 
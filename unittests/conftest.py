@@ -0,0 +1,166 @@
+from datetime import datetime
+import json
+
+import iatikit
+import pytest
+
+import iatidataquality  # noqa: F401
+from iatidataquality import app, db
+from beta import test_plan
+
+
+STEP_DEFINITIONS = '''from bdd_tester import given, then, StepException
+
+
+@given(r'an IATI activity')
+def given_an_activity(xml, **kwargs):
+    return xml
+
+
+@given(r'an IATI organisation')
+def given_an_organisation(xml, **kwargs):
+    return xml
+
+
+@then(r'`([^`]+)` should be present')
+def then_is_present(xml, xpath_expression, **kwargs):
+    if not xml.xpath(xpath_expression):
+        raise StepException('`{}` not found'.format(xpath_expression))
+    return xml
+
+
+@then(r'`([^`]+)` should be today or later')
+def then_is_today_or_later(xml, xpath_expression, **kwargs):
+    dates = xml.xpath(xpath_expression)
+    if not dates or max(dates) < kwargs['today']:
+        raise StepException('`{}` is in the past'.format(xpath_expression))
+    return xml
+'''
+
+CURRENT_DATA_FEATURE = '''@iati-activity
+Feature: Current data
+
+  Scenario: Current data
+    Given an IATI activity
+     Then `activity-date/@iso-date` should be today or later
+'''
+
+ACTIVITY_FEATURE = '''@iati-activity
+Feature: Activity tests
+
+  Scenario: Title is present
+    Given an IATI activity
+     Then `title/narrative` should be present
+
+  Scenario: Sector is present
+    Given an IATI activity
+     Then `sector` should be present
+'''
+
+ORGANISATION_FEATURE = '''@iati-organisation
+Feature: Organisation tests
+
+  Scenario: Total budget is present
+    Given an IATI organisation
+     Then `total-budget` should be present
+'''
+
+
+@pytest.fixture
+def index_tests(tmpdir, monkeypatch):
+    """A small set of index test definitions, including a current
+    data test that depends on the snapshot date."""
+    # The definitions are found next to the app's package directory.
+    monkeypatch.setattr(app, 'root_path', str(tmpdir.join('iatidataquality')))
+    base_path = tmpdir.mkdir('index_indicator_definitions').mkdir(
+        'test_definitions')
+    base_path.join('step_definitions.py').write(STEP_DEFINITIONS)
+    base_path.join('current_data.feature').write(CURRENT_DATA_FEATURE)
+    basic_path = base_path.mkdir('basic')
+    basic_path.join('activity.feature').write(ACTIVITY_FEATURE)
+    basic_path.join('organisation.feature').write(ORGANISATION_FEATURE)
+    monkeypatch.setitem(app.config, 'TEST_PLAN_CACHE_FILENAME',
+                        str(tmpdir.join('cache.pickle')))
+    test_plan._tester.clear()
+    test_plan._cache.clear()
+    with app.app_context():
+        yield base_path
+    test_plan._tester.clear()
+    test_plan._cache.clear()
+
+
+ACTIVITY = '''<iati-activity{hierarchy}>
+  <iati-identifier>{identifier}</iati-identifier>
+  {title}
+  <sector code="11110"/>
+  <activity-date type="end-planned" iso-date="{end}"/>
+ </iati-activity>'''
+
+TITLE = '<title><narrative>Title</narrative></title>'
+
+
+def activities_xml(activities):
+    return ('<iati-activities version="2.03">\n {}\n</iati-activities>\n'
+            .format('\n '.join(
+                ACTIVITY.format(
+                    identifier=identifier,
+                    hierarchy=(' hierarchy="{}"'.format(hierarchy)
+                               if hierarchy else ''),
+                    title=TITLE if title else '',
+                    end=end)
+                for identifier, hierarchy, title, end in activities)))
+
+
+ORGANISATIONS_XML = '''<iati-organisations version="2.03">
+ <iati-organisation>
+  <organisation-identifier>XM-1</organisation-identifier>
+  <total-budget><value>100</value></total-budget>
+ </iati-organisation>
+ <iati-organisation>
+  <organisation-identifier>XM-1-B</organisation-identifier>
+ </iati-organisation>
+</iati-organisations>
+'''
+
+
+@pytest.fixture
+def registry(tmpdir):
+    """The path to a registry snapshot, with a single publisher
+    ("fixture-pub"). It has two activity datasets, an organisation
+    dataset, and a dataset of invalid XML."""
+    path = tmpdir.mkdir('registry')
+    path.join('metadata.json').write(json.dumps({
+        'updated_at': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')}))
+    data_path = path.mkdir('data').mkdir('fixture-pub')
+    path.mkdir('metadata')
+    # (identifier, hierarchy, has a title, planned end date)
+    data_path.join('fixture-pub-1.xml').write(activities_xml([
+        ('XM-1-A', '1', True, '2021-06-30'),
+        ('XM-1-B', '2', False, '2023-01-01'),
+        ('XM-1-C', None, True, '2019-01-01'),
+    ]))
+    data_path.join('fixture-pub-2.xml').write(activities_xml([
+        ('XM-1-D', '1', True, '2030-01-01'),
+        ('XM-1-E', '2', True, '2018-01-01'),
+    ]))
+    data_path.join('fixture-pub-bad.xml').write(
+        '<iati-activities version="2.03"><iati-activity>')
+    data_path.join('fixture-pub-org.xml').write(ORGANISATIONS_XML)
+    return str(path)
+
+
+@pytest.fixture
+def publisher(registry):
+    return iatikit.data(registry).publishers.get('fixture-pub')
+
+
+@pytest.fixture
+def database(tmpdir, monkeypatch):
+    """An empty SQLite database, with all the tables created."""
+    monkeypatch.setitem(app.config, 'SQLALCHEMY_DATABASE_URI',
+                        'sqlite:///' + str(tmpdir.join('iatidq.sqlite')))
+    with app.app_context():
+        db.create_all()
+        yield db
+        db.session.remove()
+        db.engine.dispose()
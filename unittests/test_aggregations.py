@@ -0,0 +1,99 @@
+import itertools
+
+import pytest
+
+import iatidataquality  # noqa: F401
+from beta import benchmarks
+from iatidq import aggregations
+
+
+# (test, status, hierarchy, count, package, organisation)
+DATA = [
+    (1, 1, 0, 3, 10, 100),
+    (1, 0, 0, 1, 10, 100),
+    (2, 1, 0, 2, 10, 100),
+    (1, 1, 1, 5, 11, None),
+    # Not relevant; ignored
+    (1, 2, 1, 9, 11, None),
+    (3, 2, 0, 4, 11, None),
+    # No results
+    (3, 1, 1, 0, 10, 100),
+]
+
+
+def _key(aresult):
+    return (aresult['package_id'], aresult['test_id'],
+            aresult['hierarchy'], aresult.get('organisation_id'))
+
+
+def _cartesian_percentages(data, dims):
+    """The old ``aggregations._aggregate_percentages``, which visits
+    every combination of the values of each dimension."""
+    dims_dict = dict(dims)
+    dim_names = [name for name, _ in dims]
+    dimension_lists = [set(map(dims_dict[name], data))
+                       for name in dim_names]
+    d = dict(((x[aggregations.FIELD_STATUS],) +
+              tuple(dims_dict[name](x) for name in dim_names),
+              x[aggregations.FIELD_RESULT]) for x in data)
+
+    out = []
+    for dimensions in itertools.product(*dimension_lists):
+        fail = d.get((aggregations.RESULT_FAILURE,) + dimensions, 0)
+        success = d.get((aggregations.RESULT_SUCCESS,) + dimensions, 0)
+        if fail + success:
+            out.append(aggregations._percentage(
+                dim_names, dimensions, fail, success))
+    return out
+
+
+@pytest.fixture(params=['sparse', 'numpy'])
+def numpy_threshold(request, monkeypatch):
+    if request.param == 'numpy':
+        if aggregations.numpy is None:
+            pytest.skip('numpy not installed')
+        monkeypatch.setattr(aggregations, 'NUMPY_THRESHOLD', 0)
+
+
+def test_aggregate_percentages_org(numpy_threshold):
+    out = sorted(aggregations.aggregate_percentages_org(DATA), key=_key)
+    assert out == [
+        {'package_id': 10, 'test_id': 1, 'hierarchy': 0,
+         'organisation_id': 100, 'percentage_passed': 75.,
+         'total_results': 4},
+        {'package_id': 10, 'test_id': 2, 'hierarchy': 0,
+         'organisation_id': 100, 'percentage_passed': 100.,
+         'total_results': 2},
+        {'package_id': 11, 'test_id': 1, 'hierarchy': 1,
+         'organisation_id': None, 'percentage_passed': 100.,
+         'total_results': 5},
+    ]
+
+
+def test_aggregate_percentages(numpy_threshold):
+    data = DATA + [(2, 0, 0, 2, 10, 101)]
+    out = sorted(aggregations.aggregate_percentages(data), key=_key)
+    assert [(_key(x), x['percentage_passed'], x['total_results'])
+            for x in out] == [
+        ((10, 1, 0, None), 75., 4),
+        ((10, 2, 0, None), 50., 4),
+        ((11, 1, 1, None), 100., 5),
+    ]
+
+
+def test_no_results(numpy_threshold):
+    assert aggregations.aggregate_percentages_org([]) == []
+    assert aggregations.aggregate_percentages_org(
+        [(1, 2, 0, 1, 10, 100)]) == []
+
+
+def test_same_as_cartesian(numpy_threshold):
+    data = benchmarks.synthetic_results(40, tests=10, organisations=5)
+    dims = [
+        ("package_id", lambda x: x[aggregations.FIELD_PACKAGE]),
+        ("test_id", lambda x: x[aggregations.FIELD_TEST]),
+        ("hierarchy", lambda x: x[aggregations.FIELD_HIERARCHY]),
+        ("organisation_id", lambda x: x[aggregations.FIELD_ORGANISATION]),
+    ]
+    out = sorted(aggregations.aggregate_percentages_org(data), key=_key)
+    assert out == sorted(_cartesian_percentages(data, dims), key=_key)
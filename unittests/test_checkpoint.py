@@ -0,0 +1,50 @@
+from os import listdir
+
+import pytest
+
+import iatidataquality  # noqa: F401
+from beta import checkpoint
+
+
+def test_atomic_write(tmpdir):
+    filepath = str(tmpdir.join('results.csv'))
+    with checkpoint.atomic_write(filepath) as handler:
+        handler.write('dataset,identifier\n')
+        assert listdir(str(tmpdir)) == ['results.csv.partial']
+    assert listdir(str(tmpdir)) == ['results.csv']
+    with open(filepath) as handler:
+        assert handler.read() == 'dataset,identifier\n'
+
+
+def test_atomic_write_failure(tmpdir):
+    filepath = str(tmpdir.join('results.csv'))
+    with pytest.raises(RuntimeError):
+        with checkpoint.atomic_write(filepath) as handler:
+            handler.write('dataset,identifier\n')
+            raise RuntimeError
+    assert listdir(str(tmpdir)) == []
+
+
+def test_markers(tmpdir):
+    output_path = str(tmpdir.join('AA-1'))
+    checkpoint.start(output_path)
+    assert not checkpoint.is_complete(output_path, 'Title is present')
+    assert not checkpoint.organisation_is_complete(output_path)
+    checkpoint.mark_complete(output_path, 'Title is present')
+    assert checkpoint.is_complete(output_path, 'Title is present')
+    assert not checkpoint.is_complete(output_path, 'Current data')
+    checkpoint.mark_organisation_complete(output_path)
+    assert checkpoint.organisation_is_complete(output_path)
+
+
+def test_results_without_markers(tmpdir):
+    assert checkpoint.organisation_is_complete(str(tmpdir))
+
+
+def test_current_only_marker(tmpdir):
+    output_path = str(tmpdir.join('AA-1'))
+    checkpoint.start(output_path)
+    assert not checkpoint.is_current_only(output_path)
+    output_path = str(tmpdir.join('AA-2'))
+    checkpoint.start(output_path, current_only=True)
+    assert checkpoint.is_current_only(output_path)
@@ -0,0 +1,180 @@
+from collections import namedtuple
+import json
+from os.path import join
+
+from kombu import Connection
+
+from iatidataquality import app
+from beta import distributed, results
+from beta.masks import DatasetMasks
+from beta.runner import OrgUnit
+
+
+FakeDataset = namedtuple('FakeDataset', ['name'])
+FakePublisher = namedtuple('FakePublisher', ['datasets'])
+
+
+class RecordingWorker(distributed.Worker):
+    def __init__(self, connection):
+        super(RecordingWorker, self).__init__(connection, [], {})
+        self.bodies = []
+
+    def run_unit(self, body):
+        self.bodies.append(body)
+
+
+def test_dispatch_and_consume(tmpdir):
+    orgs = [OrgUnit('Org A', 'AA-1', 'pub-a', None),
+            OrgUnit('Org B', 'BB-2', 'pub-b', None)]
+    publishers = {
+        'pub-a': FakePublisher([FakeDataset('pub-a-1'),
+                                FakeDataset('pub-a-2')]),
+        'pub-b': FakePublisher([]),
+    }
+    with app.app_context():
+        with Connection('memory://') as connection:
+            total = distributed.dispatch(
+                connection, orgs, publishers, str(tmpdir), '2026-10-01',
+                'fingerprint')
+            worker = RecordingWorker(connection)
+            processed, failed = worker.run(burst=True, timeout=0.1)
+    assert total == 3
+    assert (processed, failed) == (3, 0)
+    units = sorted((body['organisation']['organisation_code'],
+                    body['shard'], body['dataset'])
+                   for body in worker.bodies)
+    assert units == [('AA-1', 0, 'pub-a-1'), ('AA-1', 1, 'pub-a-2'),
+                     ('BB-2', 0, None)]
+    with open(join(str(tmpdir), 'AA-1', 'shards', 'units.json')) as handler:
+        assert json.load(handler)['datasets'] == ['pub-a-1', 'pub-a-2']
+
+
+class FlakyWorker(RecordingWorker):
+    """Fails once on the first dataset, and always on the second."""
+
+    def run_unit(self, body):
+        self.bodies.append(body)
+        if body['dataset'] == 'pub-a-2' or (
+                body['dataset'] == 'pub-a-1' and len(self.bodies) == 1):
+            raise ValueError('Broken dataset')
+
+
+def test_dispatch_clears_stale_shards(tmpdir):
+    org = OrgUnit('Org A', 'AA-1', 'pub-a', None)
+    publishers = {'pub-a': FakePublisher([FakeDataset('pub-a-1')])}
+    stale_path = tmpdir.mkdir('AA-1').mkdir('shards')
+    stale_path.mkdir('0').join('complete').write('')
+    stale_path.join('finalizing').write('')
+    with app.app_context():
+        with Connection('memory://') as connection:
+            distributed.dispatch(connection, [org], publishers,
+                                 str(tmpdir), '2026-10-01', None)
+            worker = RecordingWorker(connection)
+            assert worker.run(burst=True, timeout=0.1) == (1, 0)
+    assert sorted(x.basename for x in stale_path.listdir()) == [
+        'units.json']
+
+
+def test_failed_units_retried_then_marked(tmpdir, monkeypatch):
+    org = OrgUnit('Org A', 'AA-1', 'pub-a', None)
+    publishers = {'pub-a': FakePublisher([FakeDataset('pub-a-1'),
+                                          FakeDataset('pub-a-2')])}
+    monkeypatch.setitem(app.config, 'IATI_RESULT_PATH', str(tmpdir))
+    root_output_path = join(str(tmpdir), '2026-10-01')
+    with app.app_context():
+        with Connection('memory://') as connection:
+            distributed.dispatch(connection, [org], publishers,
+                                 root_output_path, '2026-10-01', None)
+            worker = FlakyWorker(connection)
+            processed, failed = worker.run(burst=True, timeout=0.1)
+    assert (processed, failed) == (2, 1)
+    attempts = sorted(body['dataset'] for body in worker.bodies)
+    assert attempts == ['pub-a-1', 'pub-a-1'] + ['pub-a-2'] * 3
+    assert worker.failures == [('AA-1', 'pub-a-2')]
+    assert distributed.failed_units(root_output_path, org) == {1: 'pub-a-2'}
+    shard_path = join(distributed.shards_path(root_output_path, org), '1')
+    with open(join(shard_path, 'failed')) as handler:
+        assert 'Broken dataset' in handler.read()
+
+
+class FlakyFinalizeWorker(distributed.Worker):
+    """Fails the first time it merges an organisation."""
+
+    def __init__(self, connection, publishers):
+        super(FlakyFinalizeWorker, self).__init__(connection, [], {})
+        self._publishers['2026-10-01'] = publishers
+        self.finalized = 0
+
+    def finalize(self, org, publisher, root_output_path, snapshot_date):
+        self.finalized += 1
+        if self.finalized == 1:
+            raise ValueError('Broken merge')
+
+
+def test_failed_finalize_retried(tmpdir, monkeypatch):
+    org = OrgUnit('Org A', 'AA-1', 'pub-a', None)
+    publishers = {'pub-a': FakePublisher([])}
+    monkeypatch.setitem(app.config, 'IATI_RESULT_PATH', str(tmpdir))
+    root_output_path = join(str(tmpdir), '2026-10-01')
+    with app.app_context():
+        with Connection('memory://') as connection:
+            distributed.dispatch(connection, [org], publishers,
+                                 root_output_path, '2026-10-01', None)
+            worker = FlakyFinalizeWorker(connection, publishers)
+            processed, failed = worker.run(burst=True, timeout=0.1)
+    assert (processed, failed) == (1, 0)
+    assert worker.finalized == 2
+    assert worker.failures == []
+
+
+def _write_shard(output_path, rows):
+    with results.ResultStoreWriter(output_path) as store:
+        writer = store.writer('Test')
+        for dataset, idx in rows:
+            writer.writerow({'dataset': dataset, 'identifier': 'x',
+                             'index': idx, 'result': 'pass',
+                             'hierarchy': '1', 'explanation': ''})
+
+
+def test_merge_shards(tmpdir):
+    shard_a = str(tmpdir.mkdir('a'))
+    shard_b = str(tmpdir.mkdir('b'))
+    shard_c = str(tmpdir.mkdir('c'))
+    _write_shard(shard_a, [('dataset-a', 0), ('dataset-a', 1)])
+    _write_shard(shard_b, [])
+    _write_shard(shard_c, [('dataset-c', 0)])
+    merged = str(tmpdir.mkdir('merged'))
+    distributed.merge_shards([shard_a, shard_b, shard_c], merged, ['Test'])
+
+    rows = list(results.open_results(merged).rows('Test'))
+    assert [(row['dataset'], row['index']) for row in rows] == [
+        ('dataset-a', 0), ('dataset-a', 1), ('dataset-c', 0)]
+    assert rows[0]['result'] == 'pass'
+
+
+def test_merge_shard_masks(tmpdir):
+    shard_paths = []
+    for shard, dataset in enumerate(['dataset-a', 'dataset-b']):
+        masks = DatasetMasks()
+        masks.set(dataset, shard, True)
+        shard_path = tmpdir.mkdir(str(shard))
+        distributed.save_shard_masks(str(shard_path),
+                                     {'iati-activity': masks})
+        shard_paths.append(str(shard_path))
+    merged = distributed.merge_shard_masks(shard_paths)
+    assert sorted(merged['iati-activity']) == ['dataset-a', 'dataset-b']
+    assert merged['iati-activity'].get('dataset-b', 1) is True
+
+
+def test_claim_finalize(tmpdir):
+    org = OrgUnit('Org A', 'AA-1', 'pub-a', None)
+    shards_path = tmpdir.mkdir('AA-1').mkdir('shards')
+    shards_path.join('units.json').write(
+        json.dumps({'datasets': ['pub-a-1', 'pub-a-2'],
+                    'fingerprint': None}))
+    shards_path.mkdir('0').join('complete').write('')
+    assert not distributed.claim_finalize(str(tmpdir), org)
+    shards_path.mkdir('1').join('complete').write('')
+    assert distributed.claim_finalize(str(tmpdir), org)
+    # Only one worker gets to finalize.
+    assert not distributed.claim_finalize(str(tmpdir), org)
@@ -0,0 +1,101 @@
+import random
+
+import iatidataquality  # noqa: F401
+from iatidq import aggregations, dqprocessing, models
+
+
+def _old_aggregate_results_orgs(db, runtime, package_id, agg_type):
+    """The aggregate results of a package, as ``aggregate_results_orgs``
+    used to work them out: loading the ids of the relevant results,
+    then counting passes and failures in Python."""
+    Result = models.Result
+    if agg_type.test_id is not None:
+        identifiers = db.session.query(
+            db.distinct(Result.result_identifier)).filter(
+            Result.test_id == agg_type.test_id,
+            Result.result_data == aggregations.RESULT_SUCCESS)
+    else:
+        identifiers = db.session.query(db.distinct(Result.result_identifier))
+    identifiers = [row[0] for row in identifiers.filter(
+        Result.runtime_id == runtime,
+        Result.package_id == package_id)]
+    result_ids = set(row[0] for row in db.session.query(Result.id).filter(
+        Result.runtime_id == runtime,
+        Result.package_id == package_id,
+        db.or_(Result.result_identifier.in_(identifiers),
+               Result.result_identifier == None)))  # noqa: E711
+
+    data = db.session.query(
+        models.Test.id,
+        Result.result_data,
+        Result.result_hierarchy,
+        db.func.count(Result.id),
+        Result.package_id,
+        Result.organisation_id,
+    ).join(Result, models.Test.id == Result.test_id
+    ).filter(Result.runtime_id == runtime,
+             Result.package_id == package_id,
+             Result.id.in_(result_ids)
+    ).group_by(Result.package_id, Result.result_hierarchy,
+               Result.organisation_id, models.Test.id,
+               Result.result_data).all()
+    return aggregations.aggregate_percentages_org(data)
+
+
+def _key(aresult):
+    # (Some results have no organisation)
+    return (aresult['package_id'], aresult['test_id'],
+            aresult['hierarchy'], aresult['organisation_id'] or 0)
+
+
+def test_aggregate_results_orgs_same_as_before(database):
+    db = database
+    rng = random.Random(0)
+    organisation_ids = [1, 2, 3]
+    with db.session.begin():
+        for test_id in range(1, 5):
+            db.session.add(models.Test(
+                id=test_id, name='Test {}'.format(test_id),
+                description='Test {}'.format(test_id), test_level=1))
+        for organisation_id in organisation_ids:
+            db.session.add(models.Organisation(
+                id=organisation_id,
+                organisation_name='Org {}'.format(organisation_id),
+                organisation_code='XM-{}'.format(organisation_id)))
+        # Test 1 is the "current" test
+        agg_types = [
+            models.AggregationType(id=1, name='All data', test_result=1),
+            models.AggregationType(id=2, name='Current data', test_id=1,
+                                   test_result=1),
+        ]
+        db.session.add_all(agg_types)
+        db.session.execute(models.Result.__table__.insert(), [{
+            'runtime_id': rng.choice([1, 2]),
+            'package_id': rng.choice([10, 11]),
+            'organisation_id': rng.choice(organisation_ids + [None]),
+            'test_id': rng.randint(1, 4),
+            # Failures, successes, and something else
+            'result_data': rng.choice([0, 1, 1, 2]),
+            'result_identifier': rng.choice(
+                [None] + ['act-{}'.format(x) for x in range(40)]),
+            'result_hierarchy': rng.choice([0, 1, 2]),
+        } for _ in range(600)])
+
+    for agg_type in agg_types:
+        expected = sorted(
+            _old_aggregate_results_orgs(db, 1, 10, agg_type), key=_key)
+        data = dqprocessing.aggregate_results_orgs(
+            1, 10, organisation_ids, agg_type)['data']
+        assert sorted(data, key=_key) == expected
+        assert len(expected) > 20
+
+        saved = sorted(({
+            'package_id': a.package_id,
+            'test_id': a.test_id,
+            'hierarchy': a.result_hierarchy,
+            'organisation_id': a.organisation_id,
+            'percentage_passed': a.results_data,
+            'total_results': a.results_num,
+        } for a in models.AggregateResult.query.filter_by(
+            aggregateresulttype_id=agg_type.id)), key=_key)
+        assert saved == expected
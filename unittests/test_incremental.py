@@ -0,0 +1,139 @@
+from collections import namedtuple
+import csv
+from functools import wraps
+from os.path import join
+
+import iatidataquality  # noqa: F401
+from iatidataquality import app
+from beta import checkpoint, incremental, results, runner
+from beta.utils import RESULT_FIELDNAMES
+
+
+FakeStep = namedtuple('FakeStep', ['expr_fn'])
+FakeTest = namedtuple('FakeTest', ['name', 'steps'])
+
+
+def _is_present(xml, xpath_expression, **kwargs):
+    return xml
+
+
+def _is_recent(xml, **kwargs):
+    return kwargs.get('today')
+
+
+def _calls_is_recent(xml, **kwargs):
+    return _is_recent(xml, **kwargs)
+
+
+def _wrapper(fn):
+    @wraps(fn)
+    def wrapped(xml, *args, **kwargs):
+        return fn(xml, *args, **kwargs)
+    return wrapped
+
+
+def test_date_independent_test():
+    test = FakeTest('present', [FakeStep(_is_present)])
+    assert not incremental.is_date_dependent(test)
+
+
+def test_date_dependent_test():
+    test = FakeTest('recent', [FakeStep(_is_present), FakeStep(_is_recent)])
+    assert incremental.is_date_dependent(test)
+
+
+def test_date_dependent_helper_function():
+    test = FakeTest('recent', [FakeStep(_calls_is_recent)])
+    assert incremental.is_date_dependent(test)
+
+
+def test_wrapped_step_function():
+    test = FakeTest('recent', [FakeStep(_wrapper(_is_recent))])
+    assert incremental.is_date_dependent(test)
+    test = FakeTest('present', [FakeStep(_wrapper(_is_present))])
+    assert not incremental.is_date_dependent(test)
+
+
+def test_previous_rows(tmpdir):
+    test = FakeTest('Title is present', [FakeStep(_is_present)])
+    rows = [
+        ('dataset-a', 'a-1', 0), ('dataset-a', 'a-2', 1),
+        ('dataset-b', 'b-1', 0),
+        ('dataset-c', 'c-1', 0), ('dataset-c', 'c-2', 1),
+    ]
+    with open(str(tmpdir.join('title_is_present.csv')), 'w') as handler:
+        writer = csv.DictWriter(handler, fieldnames=RESULT_FIELDNAMES)
+        writer.writeheader()
+        for dataset, identifier, idx in rows:
+            writer.writerow({'dataset': dataset, 'identifier': identifier,
+                             'index': idx, 'result': 'pass',
+                             'hierarchy': '1', 'explanation': ''})
+    manifest = {'datasets': [['dataset-a', 'x'], ['dataset-b', 'y'],
+                             ['dataset-c', 'z']]}
+    previous = incremental.PreviousResults(
+        str(tmpdir), manifest, {'dataset-a', 'dataset-c'}, {})
+    try:
+        reused = [row['identifier']
+                  for row in previous.rows(test, 'dataset-a')]
+        assert reused == ['a-1', 'a-2']
+        reused = [row['identifier']
+                  for row in previous.rows(test, 'dataset-c')]
+        assert reused == ['c-1', 'c-2']
+    finally:
+        previous.close()
+
+
+FakeOrganisation = namedtuple('FakeOrganisation', ['id', 'organisation_code'])
+
+
+def test_results_hash(tmpdir):
+    org = FakeOrganisation(1, 'XM-1')
+    tmpdir.mkdir('XM-1').join('title.csv').write('a\n')
+    path = str(tmpdir)
+    before = incremental.results_hash(org, path, {'Title': 1})
+    assert incremental.results_hash(org, path, {'Title': 1}) == before
+    # the test IDs are part of the hash
+    assert incremental.results_hash(org, path, {'Title': 2}) != before
+    tmpdir.join('XM-1', 'title.csv').write('b\n')
+    assert incremental.results_hash(org, path, {'Title': 1}) != before
+
+
+def test_aggregated_round_trip(tmpdir):
+    path = str(tmpdir)
+    assert incremental.load_aggregated(path) == {}
+    incremental.save_aggregated(path, {'XM-1': 'abc'})
+    assert incremental.load_aggregated(path) == {'XM-1': 'abc'}
+
+
+def _all_rows(output_path):
+    reader = results.open_results(output_path)
+    return {test_name: list(reader.rows(test_name)) for test_name in reader}
+
+
+def test_current_only_reuse_after_date_change(index_tests, publisher,
+                                              tmpdir, monkeypatch):
+    org = runner.OrgUnit('Fixture', 'XM-1', 'fixture-pub', None)
+    all_tests = runner.load_all_tests()
+    fingerprint = incremental.tests_fingerprint({}, current_only=True)
+
+    def run(result_path, snapshot_date, previous_result_path=None):
+        monkeypatch.setitem(app.config, 'IATI_RESULT_PATH', result_path)
+        root_output_path = join(result_path, snapshot_date)
+        stats = runner.run_organisation(
+            org, publisher, all_tests, root_output_path, snapshot_date, {},
+            fingerprint=fingerprint,
+            previous_result_path=previous_result_path, current_only=True)
+        return stats, _all_rows(join(root_output_path, 'XM-1'))
+
+    result_path = str(tmpdir.mkdir('results'))
+    run(result_path, '2020-01-01')
+    # XM-1-A was current in 2020, but isn't by 2022.
+    stats, reused = run(result_path, '2022-01-01',
+                        join(result_path, '2020-01-01'))
+    assert stats['reused'] == 4
+    _, fresh = run(str(tmpdir.mkdir('fresh')), '2022-01-01')
+    assert reused == fresh
+    assert [row['result'] for row in fresh['Title is present']] == [
+        'skipped', 'fail', 'skipped', 'pass', 'skipped']
+    assert checkpoint.is_current_only(
+        join(result_path, '2022-01-01', 'XM-1'))
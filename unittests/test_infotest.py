@@ -0,0 +1,92 @@
+from collections import namedtuple
+from datetime import date
+
+import lxml.etree
+
+import iatidataquality  # noqa: F401
+from beta.infotest import CountryIndex, budget_available, budget_index
+from beta.masks import DatasetMasks
+
+
+Item = namedtuple('Item', ['id', 'etree'])
+Dataset = namedtuple('Dataset', ['name'])
+
+
+class Publisher(object):
+    datasets = [Dataset('pub-1'), Dataset('pub-org')]
+
+
+def activity(identifier, countries, mou=False):
+    xml = '<iati-activity>{}{}</iati-activity>'.format(
+        ''.join('<recipient-country code="{}"/>'.format(c)
+                for c in countries),
+        '<document-link><category code="A09"/></document-link>'
+        if mou else '')
+    return Item(identifier, lxml.etree.fromstring(xml))
+
+
+def build_index():
+    index = CountryIndex()
+    for filetype in ('activity', 'organisation'):
+        for dataset in Publisher.datasets:
+            index.add_dataset(filetype, dataset.name)
+    for idx, item in enumerate([
+            activity('a-0', ['TZ', 'KE'], mou=True),
+            activity('a-1', ['MW']),
+            activity('a-2', ['UG'], mou=True)]):
+        index.add('activity', 'pub-1', idx, item)
+    index.add('organisation', 'pub-org', 0, Item('org', lxml.etree.fromstring(
+        '<iati-organisation><document-link><category code="B13"/>'
+        '<recipient-country code="MW"/></document-link>'
+        '</iati-organisation>')))
+    index.fill(Publisher())
+    return index
+
+
+def current_data_results(current):
+    masks = DatasetMasks()
+    for idx, value in enumerate(current):
+        masks.set('pub-1', idx, value)
+    return masks
+
+
+def test_current_countries():
+    index = build_index()
+    current_data = current_data_results([True, True, False])
+    assert index.current_countries(current_data) == ['TZ', 'KE', 'MW']
+
+
+def test_country_strategies():
+    index = build_index()
+    current_data = current_data_results([True, True, False])
+    strategies = index.country_strategies(current_data)
+    assert sorted(strategies) == ['KE', 'MW', 'TZ']
+    assert strategies['TZ']['identifier'] == 'a-0'
+    assert strategies['TZ']['explanation'] == 'A09 found for {}'
+    assert strategies['MW']['dataset'] == 'pub-org'
+    assert strategies['MW'] is not strategies['KE']
+
+
+def test_budget_index():
+    etree = lxml.etree.fromstring(
+        '<iati-organisation>'
+        '<recipient-country-budget><recipient-country code="KE"/>'
+        '<period-end iso-date="2028-12-31"/><value>20</value>'
+        '</recipient-country-budget>'
+        '<recipient-country-budget><recipient-country code="KE"/>'
+        '<period-end iso-date="2027-12-31"/><value>10</value>'
+        '</recipient-country-budget>'
+        '<recipient-country-budget><recipient-country code="UG"/>'
+        '<period-end iso-date="not a date"/>'
+        '</recipient-country-budget>'
+        '</iati-organisation>')
+    assert budget_index(etree) == {
+        'KE': [(date(2027, 12, 31), '10'), (date(2028, 12, 31), '20')]}
+
+
+def test_budget_available():
+    budgets = [(date(2027, 6, 30), '10')]
+    today = date(2026, 10, 1)
+    assert budget_available(budgets, 1, today)
+    assert not budget_available(budgets, 2, today)
+    assert not budget_available([], 1, today)
@@ -0,0 +1,60 @@
+from beta.masks import DatasetMasks
+
+
+def test_set_and_get():
+    masks = DatasetMasks()
+    masks.set('dataset-a', 0, True)
+    masks.set('dataset-a', 9, True)
+    masks.set('dataset-a', 3, False)
+    assert masks.get('dataset-a', 0) is True
+    assert masks.get('dataset-a', 3) is False
+    assert masks.get('dataset-a', 9) is True
+    assert masks.length('dataset-a') == 10
+    assert masks.count('dataset-a') == 2
+
+
+def test_defaults_for_unknown_items():
+    masks = DatasetMasks()
+    masks.set('dataset-a', 2, True)
+    assert masks.get('dataset-a', 3) is None
+    assert masks.get('dataset-b', 0, 'missing') == 'missing'
+
+
+def test_clearing_a_bit():
+    masks = DatasetMasks()
+    masks.set('dataset-a', 5, True)
+    masks.set('dataset-a', 5, False)
+    assert masks.get('dataset-a', 5) is False
+
+
+def test_round_trip():
+    masks = DatasetMasks()
+    for idx in range(0, 100, 3):
+        masks.set('dataset-a', idx, True)
+    masks.set('dataset-b', 0, False)
+    assert DatasetMasks.from_dict(masks.as_dict()) == masks
+
+
+def test_update_copies_one_dataset():
+    previous = DatasetMasks()
+    previous.set('dataset-a', 1, True)
+    previous.set('dataset-b', 0, True)
+    masks = DatasetMasks()
+    masks.update(previous, 'dataset-a')
+    masks.update(previous, 'dataset-c')
+    assert list(masks) == ['dataset-a']
+    assert masks.get('dataset-a', 1) is True
+    masks.set('dataset-a', 1, False)
+    assert previous.get('dataset-a', 1) is True
+
+
+def test_decode():
+    masks = DatasetMasks()
+    for idx in (0, 9, 10):
+        masks.set('dataset-a', idx, True)
+    masks.set('dataset-a', 3, False)
+    decoded = masks.decode('dataset-a')
+    assert decoded == [masks.get('dataset-a', idx) or False
+                       for idx in range(11)]
+    assert [idx for idx, bit in enumerate(decoded) if bit] == [0, 9, 10]
+    assert masks.decode('dataset-b') == []
@@ -0,0 +1,68 @@
+import lxml.etree
+
+import iatidataquality  # noqa: F401
+from beta import profiling, xpath_cache
+
+
+def test_timings_summary():
+    timings = profiling.Timings()
+    timings.add('fast', [0.001] * 99 + [1.0])
+    row = timings.summary()[0]
+    assert row['calls'] == 100
+    assert abs(row['total'] - 1.099) < 1e-9
+    # percentiles are accurate to within a bucket
+    assert 0.001 <= row['p50'] <= 0.001 * profiling.BUCKET_RATIO
+    assert 0.001 <= row['p99'] <= 0.001 * profiling.BUCKET_RATIO
+
+
+def test_merge_and_round_trip():
+    profile = profiling.Profile()
+    profile.sections['steps'].add('a step', [0.5])
+    other = profiling.Profile.from_dict(profile.as_dict())
+    other.merge(profile)
+    row = other.sections['steps'].summary()[0]
+    assert row['calls'] == 2
+    assert row['total'] == 1.0
+
+
+def test_timed_xpath():
+    activity = lxml.etree.fromstring('<iati-activity><title/></iati-activity>')
+    try:
+        xpath_cache.set_factory(profiling.timed_xpath)
+        # nothing is recorded until profiling starts
+        xpath_cache.xpath(activity, 'title')
+        profiling.start()
+        assert len(xpath_cache.xpath(activity, 'title')) == 1
+        profile = profiling.stop()
+        rows = profile.sections['xpaths'].summary()
+        assert [(row['key'], row['calls']) for row in rows] == [('title', 1)]
+        xpath_cache.xpath(activity, 'title')
+        assert profiling.stop().sections['xpaths'].summary() == []
+    finally:
+        xpath_cache.set_factory(lxml.etree.XPath)
+
+
+def test_durations_binned_as_recorded():
+    record = profiling._recorder(('tests', 'a test'))
+    profiling.start()
+    for _ in range(1000):
+        record(0.001)
+    calls, total, buckets = profiling._timings['tests', 'a test']
+    # Only the counts are kept, not every duration.
+    assert calls == 1000
+    assert list(buckets.values()) == [1000]
+    row = profiling.stop().sections['tests'].summary()[0]
+    assert row['calls'] == 1000
+    assert abs(row['total'] - 1.0) < 1e-9
+    assert profiling._timings['tests', 'a test'] == [0, 0., {}]
+
+
+def test_format_table_sorts_descending():
+    profile = profiling.Profile()
+    profile.sections['tests'].add('slow', [2.0])
+    profile.sections['tests'].add('quick', [0.1, 0.1])
+    lines = profile.format_table(sort='calls').splitlines()
+    assert lines[2].endswith('quick')
+    assert lines[3].endswith('slow')
+    lines = profile.format_table(sort='total').splitlines()
+    assert lines[2].endswith('slow')
@@ -0,0 +1,155 @@
+import itertools
+import json
+import random
+
+import iatidataquality  # noqa: F401
+from beta import benchmarks
+from beta.benchmarks import SyntheticCondition
+from iatidq import models, summary
+
+
+def _old_reform_dict(d):
+    """The old ``summary.reform_dict``, which scans every key once for
+    each hierarchy."""
+    def inner(hier):
+        matches_first = lambda ht: ht[0] == hier
+        return dict([(test, d[(hier, test)]) for test in
+                     [ht[1] for ht in filter(matches_first, list(d.keys()))]])
+
+    return dict([(hier, inner(hier))
+                 for hier in set(hier for hier, test in list(d.keys()))])
+
+
+def _product_summaries(hierarchies, tests, data, summary_f, conditions):
+    """The old ``PublisherSummary.summarise_results``, which visits
+    every combination of hierarchy and test."""
+    def tdata(h, t):
+        out = summary_f(h, t) if (h, t) in data else {}
+        if conditions.has_condition(t, h):
+            out["condition"] = conditions.get_condition(t, h)
+        return out
+
+    tmp_out = dict([((h, t), tdata(h, t))
+                    for h, t in itertools.product(hierarchies, tests)])
+    return summary.remove_empty_dicts(_old_reform_dict(tmp_out))
+
+
+def test_reform_dict():
+    d = {(1, 'b'): {'n': 1}, (0, 'a'): {'n': 2}, (1, 'a'): {'n': 3},
+         (0, 'c'): {}}
+    out = summary.reform_dict(d)
+    assert out == {0: {'a': {'n': 2}, 'c': {}},
+                   1: {'b': {'n': 1}, 'a': {'n': 3}}}
+    assert json.dumps(out) == json.dumps(_old_reform_dict(d))
+    assert summary.remove_empty_dicts(out) == {
+        0: {'a': {'n': 2}}, 1: {'b': {'n': 1}, 'a': {'n': 3}}}
+
+
+def test_nest_summaries():
+    conditions = summary.OrgConditions(0, [
+        SyntheticCondition(20, 'activity hierarchy', '1', 0, 'Not relevant'),
+        SyntheticCondition(10, 'activity hierarchy', '2', 1, 'Relevant'),
+        # Not one of the tests or hierarchies
+        SyntheticCondition(30, 'activity hierarchy', '1', 0, 'Not relevant'),
+        SyntheticCondition(10, 'activity hierarchy', '3', 0, 'Not relevant'),
+    ])
+    data = {(1, 10): 50.0, (1, 20): 25.0, (1, 30): 75.0}
+    out = summary.nest_summaries(
+        [1, 2], [20, 10], data, lambda h, t: {'pct': data[(h, t)]},
+        conditions)
+    assert out == {
+        1: {20: {'pct': 25.0, 'condition': (0, 'Not relevant')},
+            10: {'pct': 50.0}},
+        2: {10: {'condition': (1, 'Relevant')}},
+    }
+    # In the order of the tests given
+    assert list(out[1]) == [20, 10]
+    assert summary.nest_summaries([1, 2], [], data, None, conditions) == {}
+
+
+def test_nest_summaries_same_as_product():
+    for seed in range(5):
+        args = benchmarks.synthetic_summary(
+            6, 50, filled=0.3, conditions=0.1, seed=seed)
+        assert json.dumps(summary.nest_summaries(*args)) == \
+            json.dumps(_product_summaries(*args))
+
+
+def _add_summary_data(db):
+    """Tests, indicators and aggregate results for three
+    organisations: one with conditions and sampling failures, one
+    without either, and one without any results."""
+    rng = random.Random(0)
+    with db.session.begin():
+        db.session.add(models.IndicatorGroup(id=1, name='2018index'))
+        for indicator_id in (1, 2, 3):
+            db.session.add(models.Indicator(
+                id=indicator_id, name='Indicator {}'.format(indicator_id),
+                indicatorgroup_id=1, indicator_order=indicator_id,
+                indicator_weight=1.0))
+        for test_id in range(1, 9):
+            db.session.add(models.Test(
+                id=test_id, name='Test {}'.format(test_id),
+                description='Test {}'.format(test_id), test_group='g',
+                test_level=1))
+            # Test 8 isn't part of any indicator
+            if test_id < 8:
+                db.session.add(models.IndicatorTest(
+                    indicator_id=test_id % 3 + 1, test_id=test_id))
+        for organisation_id in (1, 2, 3):
+            db.session.add(models.Organisation(
+                id=organisation_id,
+                organisation_name='Org {}'.format(organisation_id),
+                organisation_code='XM-{}'.format(organisation_id)))
+        for organisation_id in (1, 2):
+            for package in ('pkg-a', 'pkg-b', 'pkg-c'):
+                for test_id in rng.sample(range(1, 9), 6):
+                    for hierarchy in (1, 2):
+                        for aggregation_type in (1, 2):
+                            db.session.add(models.AggregateResult(
+                                package_name=package,
+                                organisation_id=organisation_id,
+                                aggregateresulttype_id=aggregation_type,
+                                test_id=test_id,
+                                result_hierarchy=hierarchy,
+                                results_data=rng.random() * 100,
+                                results_num=rng.randint(1, 500)))
+        db.session.add_all([
+            models.SamplingFailure(organisation_id=1, test_id=2),
+            models.SamplingFailure(organisation_id=1, test_id=5),
+        ])
+        # Hierarchy 2 isn't relevant for tests 1 and 3, and test 4 is
+        # flagged (but still relevant) at hierarchy 1. Hierarchy 3 has
+        # no results, so its condition is left out.
+        for test_id, operation, hierarchy in ((1, 0, '2'), (3, 0, '2'),
+                                              (4, 1, '1'), (6, 0, '3')):
+            db.session.add(models.OrganisationCondition(
+                organisation_id=1, test_id=test_id, operation=operation,
+                condition='activity hierarchy', condition_value=hierarchy,
+                description='Condition on test {}'.format(test_id)))
+
+
+def test_batch_same_as_per_organisation(database):
+    _add_summary_data(database)
+    organisations = models.Organisation.query.order_by(
+        models.Organisation.id).all()
+    for aggregation_type in (1, 2):
+        batch = summary.BatchPublisherSummary(
+            [organisation.id for organisation in organisations],
+            aggregation_type)
+        summaries = []
+        for organisation in organisations:
+            expected = summary.PublisherIndicatorsSummaryCreator(
+                organisation, aggregation_type).summary.summary()
+            assert batch.summary(organisation.id) == expected
+            summaries.append(expected)
+        with_conditions, without_conditions, without_results = summaries
+        assert with_conditions and without_conditions
+        assert without_results == {}
+        assert sorted(with_conditions) == [1, 2, 3]
+        sampling_ok = dict(
+            (test['test']['id'], test['sampling_ok'])
+            for indicator in with_conditions.values()
+            for test in indicator['tests'])
+        assert sorted(test_id for test_id, ok in sampling_ok.items()
+                      if not ok) == [2, 5]
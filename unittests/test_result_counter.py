@@ -0,0 +1,45 @@
+from collections import namedtuple
+
+import iatidataquality  # noqa: F401
+from beta.pipeline import ResultCounter
+
+
+Organisation = namedtuple('Organisation', ['id'])
+
+
+def row(idx, result, hierarchy='1'):
+    return {'dataset': 'pub-1', 'identifier': 'a-{}'.format(idx),
+            'index': idx, 'result': result, 'hierarchy': hierarchy,
+            'explanation': ''}
+
+
+def test_counts_both_aggregations():
+    counter = ResultCounter('Current data')
+    counter.writer('Current data').writerows(
+        [row(0, 'pass'), row(1, 'fail'), row(2, 'pass')])
+    # reused rows have string indexes
+    counter.writer('Title').writerows(
+        [row(0, 'pass'), row('1', 'pass'), row(2, 'fail'),
+         row(3, 'not relevant'), row(4, 'skipped')])
+    rows = counter.summary_rows(Organisation(5), {'Title': 7})
+    assert [(r['aggregateresulttype_id'], r['results_num'],
+             r['results_data']) for r in rows] == [(1, 3, 200. / 3),
+                                                   (2, 2, 50.)]
+    assert [counter.current_data_results.get('pub-1', idx)
+            for idx in range(4)] == [True, False, True, None]
+    # Without "All data", only the current data aggregation
+    rows = counter.summary_rows(Organisation(5), {'Title': 7},
+                                all_data=False)
+    assert [r['aggregateresulttype_id'] for r in rows] == [2]
+
+
+def test_passes_rows_on():
+    written = []
+
+    class Writer(object):
+        def writerow(self, row):
+            written.append(row)
+
+    counter = ResultCounter('Current data')
+    counter.writer('Title', Writer()).writerow(row(0, 'pass'))
+    assert written == [row(0, 'pass')]
@@ -0,0 +1,107 @@
+import json
+import struct
+
+import iatidataquality  # noqa: F401
+from beta import results
+from beta.utils import RESULT_FIELDNAMES
+
+
+def _row(dataset, index, result='pass', explanation=''):
+    return {'dataset': dataset, 'identifier': 'id-{}'.format(index),
+            'index': index, 'result': result, 'hierarchy': '1',
+            'explanation': explanation}
+
+
+def test_round_trip(tmpdir):
+    output_path = str(tmpdir)
+    with results.ResultStoreWriter(output_path) as store:
+        writer = store.writer('Test A')
+        writer.writerow(_row('pub-1', 0))
+        writer.writerow(_row('pub-1', 1, 'fail', 'Not found'))
+        writer.writerow(_row('pub-2', 0, 'not relevant', None))
+        writer.writerow(_row('pub-2', 1, 'unknown'))
+        store.writer('Test B')
+
+    reader = results.open_results(output_path)
+    assert isinstance(reader, results.ResultStore)
+    assert sorted(reader) == ['Test A', 'Test B']
+    assert len(reader) == 2
+    assert 'Test C' not in reader
+    assert list(reader.rows('Test A')) == [
+        _row('pub-1', 0),
+        _row('pub-1', 1, 'fail', 'Not found'),
+        _row('pub-2', 0, 'not relevant'),
+        _row('pub-2', 1, ''),
+    ]
+    assert list(reader.rows('Test B')) == []
+    # Each distinct string is only stored once.
+    assert sorted(reader.strings()) == [
+        '', '1', 'Not found', 'id-0', 'id-1', 'pub-1', 'pub-2']
+
+
+def test_little_endian(tmpdir):
+    output_path = str(tmpdir)
+    with results.ResultStoreWriter(output_path) as store:
+        writer = store.writer('Test A')
+        writer.writerow(_row('pub-1', 0x01020304))
+        writer.writerow(_row('pub-1', 5, 'fail'))
+
+    data = tmpdir.join(results.RESULTS_FILENAME).read_binary()
+    header_length, = struct.unpack_from('<Q', data, 8)
+    header = json.loads(data[16:16 + header_length].decode('utf-8'))
+    body = 16 + header_length
+    strings = header['strings']
+    offsets = struct.unpack_from('<{}Q'.format(strings + 1), data, body)
+    # 'pub-1', 'id-16909060', '1', '', 'id-5'
+    assert offsets == (0, 5, 16, 17, 17, 21)
+    (_, position, rows), = header['tables']
+    # The index column follows the dataset column.
+    indexes = struct.unpack_from('<{}I'.format(rows), data,
+                                 body + position + 4 * rows)
+    assert indexes == (0x01020304, 5)
+
+
+def test_replace_table(tmpdir):
+    output_path = str(tmpdir)
+    with results.ResultStoreWriter(output_path) as store:
+        store.writer('Test A').writerow(_row('pub-1', 0))
+        store.writer('Test B').writerow(_row('pub-1', 0, 'fail'))
+    with results.ResultStoreWriter(output_path) as store:
+        store.writer('Test B').writerows([_row('pub-2', 0), _row('pub-2', 1)])
+
+    reader = results.open_results(output_path)
+    assert list(reader.rows('Test A')) == [_row('pub-1', 0)]
+    assert list(reader.rows('Test B')) == [_row('pub-2', 0), _row('pub-2', 1)]
+
+
+def test_not_saved_on_error(tmpdir):
+    output_path = str(tmpdir)
+    try:
+        with results.ResultStoreWriter(output_path) as store:
+            store.writer('Test A').writerow(_row('pub-1', 0))
+            raise RuntimeError
+    except RuntimeError:
+        pass
+    assert not tmpdir.join(results.RESULTS_FILENAME).exists()
+
+
+def test_csv_fallback_and_export(tmpdir):
+    output_path = str(tmpdir)
+    with results.ResultStoreWriter(output_path) as store:
+        store.writer('Test A').writerows([
+            _row('pub-1', 0), _row('pub-1', 1, 'fail', 'Not, found')])
+    old_path = tmpdir.mkdir('old')
+    results.export_csv(results.open_results(output_path), 'Test A',
+                       str(old_path.join('test_a.csv')))
+
+    with open(str(old_path.join('test_a.csv'))) as handler:
+        assert handler.readline().strip() == ','.join(RESULT_FIELDNAMES)
+    reader = results.open_results(str(old_path))
+    assert isinstance(reader, results.CsvResults)
+    assert 'Test A' in reader
+    assert 'Test B' not in reader
+    rows = list(reader.rows('Test A'))
+    assert [row['explanation'] for row in rows] == ['', 'Not, found']
+    assert [row['index'] for row in rows] == ['0', '1']
+    assert results.result_filepaths(str(old_path)) == [
+        str(old_path.join('test_a.csv'))]
@@ -0,0 +1,101 @@
+from os import listdir
+from os.path import isfile, join
+import shutil
+
+import iatikit
+import lxml.etree
+import pytest
+
+import iatidataquality  # noqa: F401
+from iatidataquality import app, db
+from iatidq.models import Organisation, Test
+from beta import profiling, runner, utils, xpath_cache
+
+
+def test_parallel_same_as_serial(index_tests, registry, database, tmpdir,
+                                 monkeypatch):
+    snapshot_date = '2022-01-01'
+    # A second publisher, with the same data
+    shutil.copytree(join(registry, 'data', 'fixture-pub'),
+                    join(registry, 'data', 'fixture-pub-b'))
+    data_path = str(tmpdir.mkdir('data'))
+    snapshot_xml_path = join(data_path, snapshot_date)
+    shutil.copytree(registry, snapshot_xml_path)
+    monkeypatch.setitem(app.config, 'IATI_DATA_PATH', data_path)
+    publishers = iatikit.data(snapshot_xml_path).publishers
+    all_tests = runner.load_all_tests()
+    with db.session.begin():
+        orgs = [Organisation(organisation_name='Fixture',
+                             organisation_code='XM-1',
+                             registry_slug='fixture-pub'),
+                Organisation(organisation_name='Fixture B',
+                             organisation_code='XM-2',
+                             registry_slug='fixture-pub-b',
+                             condition='@hierarchy="1"|')]
+        db.session.add_all(orgs)
+        db.session.add_all([Test(name=test.name, description=test.name,
+                                 test_level=1)
+                            for test in all_tests])
+    units = [runner.org_unit(org) for org in orgs]
+
+    serial_path = str(tmpdir.mkdir('serial'))
+    monkeypatch.setitem(app.config, 'IATI_RESULT_PATH', serial_path)
+    for unit in units:
+        runner.run_organisation(
+            unit, publishers.get(unit.registry_slug), all_tests,
+            join(serial_path, snapshot_date), snapshot_date, {})
+
+    parallel_path = str(tmpdir.mkdir('parallel'))
+    monkeypatch.setitem(app.config, 'IATI_RESULT_PATH', parallel_path)
+    outcomes = list(runner.run_organisations_parallel(
+        app, units, snapshot_xml_path, join(parallel_path, snapshot_date),
+        snapshot_date, {}, 2))
+    assert sorted(unit.organisation_code for unit, _, _ in outcomes) == [
+        'XM-1', 'XM-2']
+    assert [error for _, error, _ in outcomes] == [None, None]
+
+    for org in orgs:
+        serial_org_path = join(serial_path, snapshot_date,
+                               org.organisation_code)
+        parallel_org_path = join(parallel_path, snapshot_date,
+                                 org.organisation_code)
+        def result_files(org_path):
+            return sorted(filename for filename in listdir(org_path)
+                          if isfile(join(org_path, filename)))
+        filenames = result_files(serial_org_path)
+        assert filenames
+        assert result_files(parallel_org_path) == filenames
+        for filename in filenames:
+            with open(join(serial_org_path, filename), 'rb') as f:
+                serial = f.read()
+            with open(join(parallel_org_path, filename), 'rb') as f:
+                assert f.read() == serial
+
+        def aggregates(result_path):
+            snapshot_result_path = join(result_path, snapshot_date)
+            current_data_results = utils.load_current_data_results(
+                org, snapshot_result_path)
+            return (utils.summarize_results(
+                org, snapshot_result_path, all_tests) +
+                utils.summarize_results(
+                    org, snapshot_result_path, all_tests,
+                    current_data_results))
+        serial = aggregates(serial_path)
+        assert serial
+        assert aggregates(parallel_path) == serial
+
+
+def test_profiling_stopped_on_error(index_tests, publisher, tmpdir,
+                                    monkeypatch):
+    def fail(*args, **kwargs):
+        raise ValueError('Broken info test')
+    monkeypatch.setattr(runner, 'run_infotests', fail)
+    org = runner.OrgUnit('Fixture', 'XM-1', 'fixture-pub', None)
+    try:
+        with pytest.raises(ValueError):
+            runner.run_organisation(
+                org, publisher, runner.load_all_tests(), str(tmpdir),
+                '2022-01-01', {}, profile=True)
+        assert not profiling._active
+    finally:
+        xpath_cache.set_factory(lxml.etree.XPath)
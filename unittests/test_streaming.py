@@ -0,0 +1,51 @@
+import json
+from os import makedirs
+from os.path import join
+
+import iatikit
+
+import iatidataquality  # noqa: F401
+from beta.streaming import iter_dataset
+
+
+def _summary(items):
+    return [(idx, item.id, item.etree.get('hierarchy'))
+            for idx, item in enumerate(items)]
+
+
+def _iatikit_items(dataset, filetype):
+    if filetype == 'activity':
+        return dataset.activities
+    return dataset.organisations
+
+
+def test_same_items_as_iatikit(publisher):
+    found = {}
+    for dataset in publisher.datasets:
+        for filetype in ('activity', 'organisation'):
+            streamed = _summary(iter_dataset(dataset, filetype))
+            assert streamed == _summary(_iatikit_items(dataset, filetype))
+            found[dataset.name, filetype] = streamed
+    assert found['fixture-pub-1', 'activity'] == [
+        (0, 'XM-1-A', '1'), (1, 'XM-1-B', '2'), (2, 'XM-1-C', None)]
+    assert found['fixture-pub-org', 'organisation'] == [
+        (0, 'XM-1', None), (1, 'XM-1-B', None)]
+    # Datasets of the other filetype are skipped.
+    assert found['fixture-pub-1', 'organisation'] == []
+    assert found['fixture-pub-org', 'activity'] == []
+    # As is invalid XML.
+    assert found['fixture-pub-bad', 'activity'] == []
+    assert found['fixture-pub-bad', 'organisation'] == []
+
+
+def test_filetype_from_metadata(registry):
+    # The registry metadata takes precedence over the XML root.
+    metadata_path = join(registry, 'metadata', 'fixture-pub')
+    makedirs(metadata_path)
+    with open(join(metadata_path, 'fixture-pub-2.json'), 'w') as handler:
+        json.dump({'extras': [{'key': 'filetype',
+                               'value': 'organisation'}]}, handler)
+    publisher = iatikit.data(registry).publishers.get('fixture-pub')
+    dataset = publisher.datasets.get('fixture-pub-2')
+    assert list(iter_dataset(dataset, 'activity')) == []
+    assert list(dataset.activities) == []
@@ -0,0 +1,40 @@
+from collections import namedtuple
+
+import iatidataquality  # noqa: F401
+from beta import results, utils
+
+
+Organisation = namedtuple('Organisation', ['id'])
+
+
+def test_summary_rows():
+    rows = list(utils.summary_rows(
+        'pub-1', {'1': {'pass': 3, 'fail': 1}, '2': {'pass': 0, 'fail': 0}},
+        7, Organisation(5), 2))
+    assert rows == [{
+        'package_name': 'pub-1',
+        'organisation_id': 5,
+        'aggregateresulttype_id': 2,
+        'test_id': 7,
+        'result_hierarchy': '1',
+        'results_data': 75.,
+        'results_num': 4,
+    }]
+    assert set(rows[0]) == set(utils.AGGREGATE_RESULT_COLUMNS)
+
+
+def test_load_current_data_results(tmpdir, monkeypatch):
+    CurrentDataTest = namedtuple('CurrentDataTest', ['name'])
+    monkeypatch.setattr(utils, 'load_current_data_test',
+                        lambda: CurrentDataTest('Current data'))
+    with results.ResultStoreWriter(str(tmpdir.mkdir('AA-1'))) as store:
+        store.writer('Current data').writerows([
+            {'dataset': 'pub-1', 'identifier': 'a-{}'.format(idx),
+             'index': idx, 'result': result, 'hierarchy': '1',
+             'explanation': ''}
+            for idx, result in enumerate(['pass', 'fail', 'not relevant'])])
+    org = namedtuple('Org', ['organisation_code'])('AA-1')
+    current_data = utils.load_current_data_results(org, str(tmpdir))
+    assert [current_data.get('pub-1', idx) for idx in range(4)] == [
+        True, False, False, None]
+    assert current_data.get('pub-2', 0) is None
@@ -0,0 +1,124 @@
+import iatidataquality  # noqa: F401
+from iatidq import dqtests, models, summary_cache
+from iatidq.summary_cache import SummaryCache
+
+
+def _builder(calls, value):
+    def build():
+        calls.append(value)
+        return value
+    return build
+
+
+def test_memory_hits_return_copies():
+    cache = SummaryCache(size=2)
+    calls = []
+    first = cache.get(('PublisherSummaryCreator', 1, 2, 0),
+                      _builder(calls, {'a': [1]}))
+    first['a'].append(2)
+    second = cache.get(('PublisherSummaryCreator', 1, 2, 0),
+                       _builder(calls, {'a': [3]}))
+    assert second == {'a': [1]}
+    assert len(calls) == 1
+    stats = cache.stats()
+    assert (stats['memory_hits'], stats['disk_hits'], stats['misses']) == \
+        (1, 0, 1)
+    assert stats['hit_rate'] == 50.0
+
+
+def test_least_recently_used_evicted():
+    cache = SummaryCache(size=2)
+    calls = []
+    for org in (1, 2, 1, 3):
+        cache.get(('PublisherSummaryCreator', org, 2, 0),
+                  _builder(calls, org))
+    assert calls == [1, 2, 3]
+    # Organisation 2 was used least recently, so made way for 3.
+    cache.get(('PublisherSummaryCreator', 2, 2, 0), _builder(calls, 2))
+    assert calls == [1, 2, 3, 2]
+    assert cache.stats()['memory_entries'] == 2
+
+
+def test_new_version_rebuilds():
+    cache = SummaryCache()
+    calls = []
+    cache.get(('PublisherSummaryCreator', 1, 2, 0), _builder(calls, 'old'))
+    value = cache.get(('PublisherSummaryCreator', 1, 2, 1),
+                      _builder(calls, 'new'))
+    assert value == 'new'
+    assert calls == ['old', 'new']
+
+
+def test_disk_shared_between_caches(tmpdir):
+    path = str(tmpdir.join('cache'))
+    calls = []
+    SummaryCache(path=path).get(('PublisherSummaryCreator', 1, 2, 0),
+                                _builder(calls, 'old'))
+    SummaryCache(path=path).get(('PublisherSummaryCreator', 1, 2, 1),
+                                _builder(calls, 'new'))
+    # Only the latest version is kept on disk.
+    assert [f.basename for f in tmpdir.join('cache').listdir()] == [
+        'PublisherSummaryCreator-1-2-1.pickle']
+
+    cache = SummaryCache(size=0, path=path)
+    value = cache.get(('PublisherSummaryCreator', 1, 2, 1),
+                      _builder(calls, 'rebuilt'))
+    assert value == 'new'
+    assert calls == ['old', 'new']
+    stats = cache.stats()
+    assert (stats['memory_hits'], stats['disk_hits'], stats['misses']) == \
+        (0, 1, 0)
+    assert stats['disk_entries'] == 1
+
+    cache.clear()
+    assert cache.stats()['disk_entries'] == 0
+    value = cache.get(('PublisherSummaryCreator', 1, 2, 1),
+                      _builder(calls, 'rebuilt'))
+    assert value == 'rebuilt'
+
+
+def test_generation_rebuilds_everything(database, monkeypatch):
+    db = database
+    monkeypatch.setattr(summary_cache, '_cache', SummaryCache())
+    with db.session.begin():
+        orgs = [models.Organisation(organisation_name='Org {}'.format(x),
+                                    organisation_code='XM-{}'.format(x))
+                for x in (1, 2)]
+        test = models.Test(name='Test', description='Test', test_level=1)
+        db.session.add_all(orgs + [test])
+    calls = []
+
+    class Summary(object):
+        def __init__(self, organisation_id):
+            self.organisation_id = organisation_id
+
+        def summary(self):
+            return {'organisation': self.organisation_id}
+
+    class Creator(object):
+        def __init__(self, organisation, aggregation_type):
+            calls.append(organisation.id)
+            self.summary = Summary(organisation.id)
+
+    def summaries():
+        return [summary_cache.publisher_summary(Creator, org, 2)
+                for org in orgs]
+
+    summaries()
+    summaries()
+    assert len(calls) == 2
+    # Only the organisation whose version is bumped is rebuilt.
+    with db.session.begin():
+        summary_cache.bump_versions([orgs[0].id])
+    summaries()
+    assert len(calls) == 3
+    # Editing a test rebuilds every organisation's summaries.
+    dqtests.updateTest({'id': test.id, 'description': 'Edited'})
+    assert [x['organisation'] for x in summaries()] == [
+        org.id for org in orgs]
+    assert len(calls) == 5
+    # As does clearing the cache.
+    with db.session.begin():
+        summary_cache.bump_generation()
+    summaries()
+    assert len(calls) == 7
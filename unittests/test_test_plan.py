@@ -0,0 +1,40 @@
+from os import utime
+
+from beta import test_plan
+
+
+def test_load_feature(index_tests):
+    feature = test_plan.load_feature(
+        str(index_tests.join('basic', 'activity.feature')))
+    assert feature.name == 'Activity tests'
+    assert [test.name for test in feature.tests] == [
+        'Title is present', 'Sector is present']
+    assert [step.text for step in feature.tests[0].steps] == [
+        'an IATI activity', '`title/narrative` should be present']
+
+
+def test_cached_on_disk(index_tests, tmpdir, monkeypatch):
+    filepath = str(index_tests.join('basic', 'activity.feature'))
+    test_plan.load_feature(filepath)
+    assert tmpdir.join('cache.pickle').check()
+
+    # A new process reads the parsed feature from disk, without
+    # parsing it again.
+    test_plan._cache.clear()
+
+    def parse(feature_txt):
+        raise AssertionError('Feature parsed again')
+    monkeypatch.setattr(test_plan.get_tester().gherkinparser, 'parse', parse)
+    feature = test_plan.load_feature(filepath)
+    assert feature.name == 'Activity tests'
+    assert filepath in test_plan._cache['files']
+
+
+def test_modified_feature_is_parsed_again(index_tests):
+    feature_file = index_tests.join('basic', 'activity.feature')
+    test_plan.load_feature(str(feature_file))
+    feature_file.write(feature_file.read().replace(
+        'Feature: Activity tests', 'Feature: Basic activity tests'))
+    utime(str(feature_file), ns=(0, 0))
+    feature = test_plan.load_feature(str(feature_file))
+    assert feature.name == 'Basic activity tests'
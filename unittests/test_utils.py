@@ -0,0 +1,62 @@
+import iatidataquality  # noqa: F401
+from beta import results, runner, utils
+
+
+def _run_test_one_at_a_time(test, publisher, test_condition, **kwargs):
+    """The results of a single test, as they used to be found:
+    walking all of the publisher's data for each test."""
+    tags = test.tags + test.feature.tags
+    rows = []
+    prev_dataset = None
+    if 'iati-activity' in tags:
+        items = publisher.activities
+    else:
+        items = publisher.organisations
+    for item in items:
+        if item.dataset.name != prev_dataset:
+            idx = 0
+        prev_dataset = item.dataset.name
+        if test_condition:
+            activity_condition, org_condition = test_condition.split('|')
+            if 'iati-activity' in tags:
+                if not item.etree.xpath(activity_condition):
+                    idx += 1
+                    continue
+            if org_condition.strip() and 'iati-organisation' in tags:
+                if not item.etree.xpath(org_condition):
+                    idx += 1
+                    continue
+        result, explanation = test(item.etree, bdd_verbose=True, **kwargs)
+        hierarchy = item.etree.get('hierarchy')
+        if not hierarchy:
+            hierarchy = '1'
+        rows.append({
+            'dataset': item.dataset.name,
+            'identifier': item.id,
+            'index': idx,
+            'result': utils.RESULT_LOOKUP.get(result),
+            'hierarchy': hierarchy,
+            'explanation': str(explanation) if not result else '',
+        })
+        idx += 1
+    return rows
+
+
+def test_single_pass_same_as_one_test_at_a_time(index_tests, publisher,
+                                                tmpdir):
+    all_tests = runner.load_all_tests()
+    conditions = [
+        None,
+        '@hierarchy="1"|',
+        '@hierarchy="1"|organisation-identifier="XM-1"',
+    ]
+    for pos, test_condition in enumerate(conditions):
+        output_path = str(tmpdir.mkdir(str(pos)))
+        utils.run_tests(all_tests, publisher, output_path, test_condition,
+                        codelists={}, today='2022-01-01')
+        reader = results.open_results(output_path)
+        for test in all_tests:
+            expected = _run_test_one_at_a_time(
+                test, publisher, test_condition, codelists={},
+                today='2022-01-01')
+            assert list(reader.rows(test.name)) == expected
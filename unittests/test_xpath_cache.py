@@ -0,0 +1,35 @@
+import lxml.etree
+
+from beta import xpath_cache
+
+
+ACTIVITY = '''<iati-activity xmlns:x="http://example.org/x">
+  <title><narrative>A title</narrative></title>
+  <x:extra code="1"/>
+</iati-activity>'''
+
+
+def test_xpath_matches_lxml():
+    activity = lxml.etree.fromstring(ACTIVITY)
+    expr = 'title/narrative/text()'
+    assert xpath_cache.xpath(activity, expr) == activity.xpath(expr)
+
+
+def test_compiled_once():
+    xpath_cache.clear()
+    activity = lxml.etree.fromstring(ACTIVITY)
+    for _ in range(5):
+        xpath_cache.xpath(activity, 'title')
+    stats = xpath_cache.stats()
+    assert stats['misses'] == 1
+    assert stats['hits'] == 4
+
+
+def test_namespaces_are_part_of_key():
+    xpath_cache.clear()
+    activity = lxml.etree.fromstring(ACTIVITY)
+    nsmap = {'x': 'http://example.org/x'}
+    assert xpath_cache.xpath(activity, 'x:extra/@code', nsmap) == ['1']
+    assert xpath_cache.xpath(activity, 'x:extra/@code',
+                             {'x': 'http://example.org/y'}) == []
+    assert xpath_cache.stats()['misses'] == 2